@@ -21,15 +21,18 @@ URL = "http://hostinfo/api"
 def get_hosts(logger):
     hosts = []
 
-    endpoint = URL + '/host/'
-    host_list = requests.get(endpoint)
-
-    if host_list.status_code != 200:
-        logger.error("Unable to contact %s, received %d", endpoint, host_list.status_code)
-        sys.exit(1)
-
-    for host in host_list.json()['hosts']:
-        hosts.append(host.get('hostname'))
+    endpoint = URL + '/host/?limit=1000'
+    while endpoint:
+        host_list = requests.get(endpoint)
+
+        if host_list.status_code != 200:
+            logger.error("Unable to contact %s, received %d", endpoint, host_list.status_code)
+            sys.exit(1)
+
+        page = host_list.json()
+        for host in page['hosts']:
+            hosts.append(host.get('hostname'))
+        endpoint = page['next']
 
     return hosts
 
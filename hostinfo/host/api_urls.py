@@ -7,8 +7,10 @@ from .rest_views import (
     HostLinkRest,
     HostDetail,
     KeyListRest,
+    KeyStatsRest,
 )
 from .rest_views import HostQuery, HostList, KeyDetail, KValDetail, AliasList
+from .rest_views import BatchRest
 
 hostspec = r'((?P<hostpk>[0-9]+?)|(?P<hostname>\S+?))'
 aliasspec = r'((?P<aliaspk>[0-9]+?)|(?P<alias>\S*?))'
@@ -18,6 +20,7 @@ linkspec = r'((?P<linkpk>[0-9]+?)|(?P<tagname>\S*?))'
 
 urlpatterns = [
     path("alias/", AliasList),
+    path("batch/", BatchRest),
     re_path(f"host/{hostspec}/alias/{aliasspec}/$", HostAliasRest, name='hostaliasrest'),
     re_path(f"host/{hostspec}/alias/$", HostAliasRest, name="hostaliasrest"),
     re_path(
@@ -42,6 +45,8 @@ urlpatterns = [
     path("kval/<int:pk>/", KValDetail, name="restkval"),
     re_path(r"query/(?P<query>\S+?)/$", HostQuery),
     re_path(rf"keylist/{akeyspec}/(?P<query>\S+?/)?$", KeyListRest),
+    path("keystats/", KeyStatsRest),
+    re_path(f"keystats/{akeyspec}/$", KeyStatsRest),
 ]
 
 # EOF
@@ -26,7 +26,7 @@ from .views import hostData, hostCount
 
 
 ################################################################################
-def getConfLinks(hostid=None, hostname=None):  # pylint: disable=unused-argument
+def getConfLinks(hostid=None, hostname=None, links=None):  # pylint: disable=unused-argument
     """Linker"""
     return []
 
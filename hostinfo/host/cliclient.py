@@ -0,0 +1,128 @@
+"""Client side of the hostinfo command server - see cliserver.py
+
+This is imported before django is set up so it mustn't import anything
+from django or the rest of hostinfo
+"""
+#
+# Written by Dougal Scott <dougal.scott@gmail.com>
+#
+#    Copyright (C) 2025 Dougal Scott
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import socket
+import struct
+import sys
+
+DEFAULT_SOCKET = "/var/run/hostinfo/cli.sock"
+HEADER = struct.Struct("!I")
+
+
+################################################################################
+def socketPath():
+    """Where the command server listens - $HOSTINFO_SOCKET overrides the
+    default and setting it to an empty string turns the server off"""
+    return os.environ.get("HOSTINFO_SOCKET", DEFAULT_SOCKET)
+
+
+################################################################################
+def sendFrame(sock, msg):
+    """Send a message as a length prefixed lump of json"""
+    data = json.dumps(msg).encode("utf-8")
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+################################################################################
+def readFrame(sock):
+    """Return the next message, or None if the other end has gone"""
+    header = readExactly(sock, HEADER.size)
+    if header is None:
+        return None
+    data = readExactly(sock, HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return json.loads(data.decode("utf-8"))
+
+
+################################################################################
+def readExactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 16))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+################################################################################
+def connect(path):
+    """Return a socket connected to the server, or None if there isn't one"""
+    if not path or not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+################################################################################
+def serverRunning(path):
+    sock = connect(path)
+    if sock is None:
+        return False
+    sock.close()
+    return True
+
+
+################################################################################
+def runRemote(argv, path=None):
+    """Run the command in the command server and return its exit code.
+    Return None if there is no server, or the server wants the command run
+    by the client, so that it can be run locally"""
+    sock = connect(socketPath() if path is None else path)
+    if sock is None:
+        return None
+    with sock:
+        sendFrame(sock, {"argv": list(argv)})
+        while True:
+            msg = readFrame(sock)
+            if msg is None:
+                sys.stdout.flush()
+                sys.stderr.write("Lost connection to the hostinfo server\n")
+                return 255
+            if "stdout" in msg:
+                sys.stdout.write(msg["stdout"])
+            elif "stderr" in msg:
+                sys.stdout.flush()
+                sys.stderr.write(msg["stderr"])
+                sys.stderr.flush()
+            elif "stdin" in msg:
+                # Only read stdin when the command asks for it, so it isn't
+                # taken from scripts that are feeding their own loops
+                sendFrame(sock, {"stdin": sys.stdin.read()})
+            elif "local" in msg:
+                return None
+            elif "exit" in msg:
+                sys.stdout.flush()
+                return msg["exit"]
+
+
+# EOF
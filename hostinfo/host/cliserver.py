@@ -0,0 +1,236 @@
+"""A long running server for the hostinfo commands
+
+Starting python and django takes far longer than most of the commands do.
+./manage.py cli_server keeps a process with django set up, the key caches
+warm and the database connection open, and bin/hostinfo hands commands to
+it over a unix socket when it is running. Commands are run one at a time,
+so a client that stops answering for CLIENT_TIMEOUT seconds is dropped
+rather than holding up everyone else. Each command checks that the key
+metadata and parsed qualifiers are still current, as a web request does.
+
+Commands are done as the user the kernel says is at the other end of the
+socket. Commands that read or write files named by the client are sent
+back to be run by the client itself so that they can only get at the
+files it can.
+"""
+#
+# Written by Dougal Scott <dougal.scott@gmail.com>
+#
+#    Copyright (C) 2025 Dougal Scott
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import pwd
+import socket
+import socketserver
+import struct
+import sys
+import traceback
+from django.conf import settings
+from django.db import connections, reset_queries
+
+from .cliclient import readFrame, sendFrame
+from .models import _clientuser, expireKeyMetadata, keyMetadata, run_from_cmdline
+
+FLUSH_SIZE = 1 << 16
+CLIENT_TIMEOUT = 60
+PEERCRED = struct.Struct("3i")  # pid, uid, gid
+LOCAL_COMMANDS = {"hostinfo_import"}
+# Settings that only work if the Django cache is shared between processes
+SHARED_CACHE_SETTINGS = ("HOSTINFO_VALUE_INDEX_MEMORY", "HOSTINFO_QUERY_CACHE_TIMEOUT")
+
+
+###############################################################################
+class CommandOutput(io.TextIOBase):
+    """Send what a command writes back to the client"""
+
+    def __init__(self, sock, name, before=None, flushsize=FLUSH_SIZE):
+        self.sock = sock
+        self.name = name
+        self.before = before
+        self.flushsize = flushsize
+        self.pending = []
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if self.before:  # Keep stdout and stderr in order
+            self.before.flush()
+        self.pending.append(text)
+        self.size += len(text)
+        if self.size >= self.flushsize:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if not self.pending:
+            return
+        data = "".join(self.pending)
+        self.pending = []
+        self.size = 0
+        if self.sock is None:
+            return
+        try:
+            sendFrame(self.sock, {self.name: data})
+        except OSError:  # The client has gone - finish the command anyway
+            self.sock = None
+
+
+###############################################################################
+class CommandInput(io.TextIOBase):
+    """Get the client's stdin, but only if the command reads it"""
+
+    def __init__(self, sock, before=None):
+        self.sock = sock
+        self.before = before
+        self.data = None
+
+    def readable(self):
+        return True
+
+    def fetch(self):
+        if self.data is None:
+            if self.before:
+                self.before.flush()
+            sendFrame(self.sock, {"stdin": True})
+            msg = readFrame(self.sock) or {}
+            self.data = io.StringIO(msg.get("stdin", ""))
+        return self.data
+
+    def read(self, size=-1):
+        return self.fetch().read(size)
+
+    def readline(self, size=-1):
+        return self.fetch().readline(size)
+
+
+###############################################################################
+def exitCode(code):
+    """What the process would have exited with for sys.exit(code)"""
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    sys.stderr.write("%s\n" % code)
+    return 1
+
+
+###############################################################################
+def peerUser(sock):
+    """The login of the user at the other end of the socket. This comes
+    from the kernel as anything the client says about itself can't be
+    trusted."""
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED.size)
+    _, uid, _ = PEERCRED.unpack(creds)
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return str(uid)
+
+
+###############################################################################
+def unsharedCacheSettings():
+    """Return the settings that are turned on but need a shared cache when
+    the cache is only seen by this process. The server would never see
+    the changes made through the web interface or other commands."""
+    backend = settings.CACHES["default"]["BACKEND"]
+    if not backend.endswith(".LocMemCache"):
+        return []
+    return [name for name in SHARED_CACHE_SETTINGS if getattr(settings, name, 0)]
+
+
+###############################################################################
+def runLocally(argv):
+    """Does the command have to be run by the client"""
+    return os.path.basename(argv[0]) in LOCAL_COMMANDS
+
+
+###############################################################################
+def runCommand(sock, request, user):
+    """Run a command as bin/hostinfo would have for user and return its
+    exit code"""
+    stdout = CommandOutput(sock, "stdout")
+    stderr = CommandOutput(sock, "stderr", before=stdout, flushsize=0)
+    stdin = CommandInput(sock, before=stdout)
+    saved = (sys.argv, sys.stdin, sys.stdout, sys.stderr)
+    token = _clientuser.set(user)
+    sys.argv = request["argv"]
+    sys.stdin, sys.stdout, sys.stderr = stdin, stdout, stderr
+    try:
+        retval = run_from_cmdline()
+    except SystemExit as exc:
+        retval = exitCode(exc.code)
+    except Exception:
+        traceback.print_exc()
+        retval = 1
+    finally:
+        stdout.flush()
+        sys.argv, sys.stdin, sys.stdout, sys.stderr = saved
+        _clientuser.reset(token)
+    return retval
+
+
+###############################################################################
+def closeBrokenConnections():
+    """Keep the database connections between commands unless they have
+    stopped working"""
+    for conn in connections.all():
+        if conn.connection is not None and not conn.is_usable():
+            conn.close()
+
+
+###############################################################################
+class CommandHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.request.settimeout(self.server.clienttimeout)
+        try:
+            request = readFrame(self.request)
+            if not request or not request.get("argv"):
+                return
+            if runLocally(request["argv"]):
+                sendFrame(self.request, {"local": True})
+                return
+        except OSError:
+            return
+        reset_queries()
+        closeBrokenConnections()
+        expireKeyMetadata()  # Like the start of a request
+        retval = runCommand(self.request, request, peerUser(self.request))
+        try:
+            sendFrame(self.request, {"exit": retval})
+        except OSError:
+            pass
+
+
+###############################################################################
+class CommandServer(socketserver.UnixStreamServer):
+    def __init__(self, path, mode=0o660, clienttimeout=CLIENT_TIMEOUT):
+        if os.path.exists(path):  # Left behind by a server that died
+            os.unlink(path)
+        super().__init__(path, CommandHandler)
+        os.chmod(path, mode)
+        self.clienttimeout = clienttimeout
+        keyMetadata()
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+# EOF
@@ -18,11 +18,25 @@
 import sys
 import time
 from collections import defaultdict
+from itertools import groupby
+from operator import attrgetter
 
-from host.models import AllowedKey, KeyValue, parseQualifiers
+from host.models import AllowedKey, HostAlias, KeyValue, parseQualifiers
 from host.models import getMatches, getAK, Host, getHost
-from host.models import getAliases, RestrictedValue
-from host.models import HostinfoCommand, HostinfoException
+from host.models import getAliases, getRevAK, RestrictedValue
+from host.models import HostinfoCommand, HostinfoException, valueFrequencies
+
+# Above this many matching hosts the printed values are read for all hosts
+# rather than a chunk of hosts at a time
+PRINTOUT_IN_LIMIT = 5000
+PRINTOUT_CHUNK = 500
+
+# --showall works through the hosts in batches of between these many hosts,
+# aiming for this many values in each batch
+SHOWALL_FIRST_BATCH = 50
+SHOWALL_MAX_BATCH = 500
+SHOWALL_BATCH_VALUES = 20000
+SHOWALL_CURSOR_CHUNK = 2000
 
 
 ###############################################################################
@@ -110,6 +124,17 @@ class Command(HostinfoCommand):
 
     ###########################################################################
     def handle(self, namespace):
+        output, retval = self.stream(namespace)
+        return "".join(output), retval
+
+    ###########################################################################
+    def over_handle(self):
+        # Let run_from_cmdline() print the output as it is generated
+        return self.stream(self.namespace)
+
+    ###########################################################################
+    def stream(self, namespace):
+        """Return a generator of the output and the exit code"""
         global _hostcache
         self.namespace = namespace
         self.printout = namespace.printout
@@ -135,7 +160,7 @@ class Command(HostinfoCommand):
 
     ###########################################################################
     def Display(self, matches):
-        """Display the list of hosts that matched the criteria"""
+        """Generate the display of the hosts that matched the criteria"""
         # Sort the hosts alphabetically
         tmpl = [(_hostcache[id].hostname, id) for id in matches]
         tmpl.sort()
@@ -159,34 +184,26 @@ class Command(HostinfoCommand):
     ###########################################################################
     def DisplayCount(self, matches):
         """Display a count of matching hosts"""
-        return "%s" % len(matches)
+        yield "%s" % len(matches)
 
     ###########################################################################
     def DisplayValuereport(self, matches):
         """Display a report about the values a key has and how many hosts have
         that particular value
         """
-        # TODO: Migrate to using calcKeylistVals
-        outstr = ""
         values = defaultdict(int)
-        hostids = set()  # hostids that match the criteria
         key = getAK(self.namespace.valuereport[0])
         total = len(matches)
         if total == 0:
-            return ""
-        nummatch = 0
-        kvlist = KeyValue.objects.filter(
-            keyid__key=self.namespace.valuereport[0]
-        ).values_list("hostid", "value", "numvalue")
-
-        for hostid, value, numvalue in kvlist:
-            hostids.add(hostid)
+            return
+        # Counted by the database for just the matching hosts
+        counts, nummatch = valueFrequencies(key, matches)
+        for (value, numvalue), uses in counts.items():
             if key.numericFlag and numvalue is not None:
-                values[numvalue] += 1
+                values[numvalue] += uses
             else:
-                values[value] += 1
-        nummatch = len(hostids)  # Number of hosts that match
-        numundef = total - len(hostids)
+                values[value] += uses
+        numundef = total - nummatch
 
         tmpvalues = []
         for k, v in values.items():
@@ -195,42 +212,81 @@ class Command(HostinfoCommand):
 
         tmpvalues.sort()
 
-        outstr += "%s set: %d %0.2f%%\n" % (
+        yield "%s set: %d %0.2f%%\n" % (
             self.namespace.valuereport[0],
             nummatch,
             100.0 * nummatch / total,
         )
-        outstr += "%s unset: %d %0.2f%%\n" % (
+        yield "%s unset: %d %0.2f%%\n" % (
             self.namespace.valuereport[0],
             numundef,
             100.0 * numundef / total,
         )
-        outstr += "\n"
+        yield "\n"
         for k, v, p in tmpvalues:
-            outstr += "%s %d %0.2f%%\n" % (k, v, p)
-        return outstr
+            yield "%s %d %0.2f%%\n" % (k, v, p)
 
     ###########################################################################
     def DisplayShowall(self, matches):
         """Display all the known information about the matched hosts"""
-        revcache = {}
-        outputs = []
-        for aks in AllowedKey.objects.all():
-            revcache[aks.id] = aks.key
-
-        batchsize = 10
-        batches = []
-        for b in range(0, len(matches), batchsize):
-            batches.append(matches[b : b + batchsize])
-
-        for batch in batches:
-            kvs = KeyValue.objects.filter(hostid__in=batch)
+        revcache = getRevAK()
+        aliases = {}
+        sep = ""
+        start = 0
+        # Start small so the first hosts come out straight away then grow
+        # the batches, keeping the number of values in each one bounded
+        batchsize = SHOWALL_FIRST_BATCH
+        while start < len(matches):
+            batch = matches[start : start + batchsize]
+            start += len(batch)
+            kvs = self.showallValues(batch)
+            if self.namespace.aliases:
+                aliases = self.showallAliases(batch)
             for host in batch:
-                outputs.append(self.gen_host(host, kvs, revcache))
-        return "\n".join(outputs)
+                yield sep + self.gen_host(host, kvs[host], revcache, aliases)
+                sep = "\n"
+            perhost = max(1, sum(len(v) for v in kvs.values()) // len(batch))
+            batchsize = max(
+                SHOWALL_FIRST_BATCH,
+                min(batchsize * 2, SHOWALL_MAX_BATCH, SHOWALL_BATCH_VALUES // perhost),
+            )
 
     ###########################################################################
-    def gen_host(self, host, kvs, revcache):
+    def showallValues(self, batch):
+        """Return {hostid: [values]} for the hosts in a single pass over
+        their values ordered by host and key"""
+        kvs = defaultdict(list)
+        rows = (
+            KeyValue.objects.filter(hostid__in=batch)
+            .order_by("hostid", "keyid", "id")
+            .values_list(
+                "hostid",
+                "keyid",
+                "value",
+                "origin",
+                "createdate",
+                "modifieddate",
+                named=True,
+            )
+        )
+        for hostid, hostrows in groupby(
+            rows.iterator(chunk_size=SHOWALL_CURSOR_CHUNK), key=attrgetter("hostid")
+        ):
+            kvs[hostid] = list(hostrows)
+        return kvs
+
+    ###########################################################################
+    def showallAliases(self, batch):
+        """Return {hostid: [aliases]} for the hosts"""
+        aliases = defaultdict(list)
+        rows = HostAlias.objects.filter(hostid__in=batch).order_by("id")
+        for hostid, alias in rows.values_list("hostid", "alias"):
+            aliases[hostid].append(alias)
+        return aliases
+
+    ###########################################################################
+    def gen_host(self, host, kvs, revcache, aliases):
+        """Generate the output of a host from all of its values"""
         outstr = ""
         output = []
         keyvals = {}
@@ -240,9 +296,7 @@ class Command(HostinfoCommand):
 
         # Get all the keyvalues for this host
         for k in kvs:
-            if k.hostid_id != host:
-                continue
-            keyname = revcache[k.keyid_id]
+            keyname = revcache[k.keyid]
             if keyname not in keyvals:
                 keyvals[keyname] = []
             keyvals[keyname].append(k.value)
@@ -290,8 +344,7 @@ class Command(HostinfoCommand):
         if self.namespace.aliases:
             output.insert(
                 0,
-                "    [Aliases: %s]"
-                % (", ".join(getAliases(_hostcache[host].hostname))),
+                "    [Aliases: %s]" % (", ".join(aliases.get(host, []))),
             )
 
         outstr += "\n".join(output)
@@ -302,38 +355,38 @@ class Command(HostinfoCommand):
         """Display hosts and other printables in XML format"""
         from xml.sax.saxutils import escape, quoteattr
 
-        outstr = ""
-
         if self.namespace.showall:
             columns = [k.key for k in AllowedKey.objects.all()]
             columns.sort()
         else:
             columns = self.printout[:]
 
-        cache = self.loadPrintoutCache(columns, matches)
-        outstr += "<hostinfo>\n"
-        outstr += '  <query date="%s">%s</query>\n' % (
+        cache = self.loadPrintoutCache(columns, matches, self.printoutFields())
+        yield "<hostinfo>\n"
+        yield '  <query date="%s">%s</query>\n' % (
             time.ctime(),
             escape(" ".join(sys.argv)),
         )
         for key in columns:
             k = getAK(key)
-            outstr += "  <key>\n"
-            outstr += "    <name>%s</name>\n" % escape(key)
-            outstr += "    <type>%s</type>\n" % k.get_validtype_display()
-            outstr += "    <readonlyFlag>%s</readonlyFlag>\n" % k.readonlyFlag
-            outstr += "    <auditFlag>%s</auditFlag>\n" % k.auditFlag
-            outstr += "    <numericFlag>%s</numericFlag>\n" % k.numericFlag
-            outstr += "    <docpage>%s</docpage>\n" % k.docpage
-            outstr += "    <desc>%s</desc>\n" % k.desc
+            out = ["  <key>\n"]
+            out.append("    <name>%s</name>\n" % escape(key))
+            out.append("    <type>%s</type>\n" % k.get_validtype_display())
+            out.append("    <readonlyFlag>%s</readonlyFlag>\n" % k.readonlyFlag)
+            out.append("    <auditFlag>%s</auditFlag>\n" % k.auditFlag)
+            out.append("    <numericFlag>%s</numericFlag>\n" % k.numericFlag)
+            out.append("    <docpage>%s</docpage>\n" % k.docpage)
+            out.append("    <desc>%s</desc>\n" % k.desc)
             if k.restrictedFlag:
-                outstr += "    <restricted>\n"
+                out.append("    <restricted>\n")
                 rvlist = RestrictedValue.objects.filter(keyid__key=key)
                 for rv in rvlist:
-                    outstr += "        <value>%s</value>\n" % escape(rv.value)
-                outstr += "    </restricted>\n"
-            outstr += "  </key>\n"
+                    out.append("        <value>%s</value>\n" % escape(rv.value))
+                out.append("    </restricted>\n")
+            out.append("  </key>\n")
+            yield "".join(out)
 
+        # One lump of output per host
         for host in matches:
             if self.namespace.aliases:
                 aliaslist = getAliases(_hostcache[host].hostname)
@@ -348,39 +401,34 @@ class Command(HostinfoCommand):
                 )
             else:
                 hostdates = ""
-            outstr += '  <host docpage="%s" %s%s>\n' % (
-                _hostcache[host].docpage,
-                hostorigin,
-                hostdates,
-            )
-            outstr += "    <hostname>%s</hostname>\n" % escape(
-                _hostcache[host].hostname
+            out = [
+                '  <host docpage="%s" %s%s>\n'
+                % (_hostcache[host].docpage, hostorigin, hostdates)
+            ]
+            out.append(
+                "    <hostname>%s</hostname>\n" % escape(_hostcache[host].hostname)
             )
             if self.namespace.aliases and aliaslist:
-                outstr += "    <aliaslist>\n"
+                out.append("    <aliaslist>\n")
                 for alias in aliaslist:
-                    outstr += "      <alias>%s</alias>\n" % escape(alias)
-                outstr += "    </aliaslist>\n"
-            outstr += "    <data>\n"
+                    out.append("      <alias>%s</alias>\n" % escape(alias))
+                out.append("    </aliaslist>\n")
+            out.append("    <data>\n")
             for p in columns:
-                if host not in cache[p] or len(cache[p][host]) == 0:
-                    pass
-                else:
-                    for c in cache[p][host]:
-                        outstr += '      <confitem key="%s"' % p
-                        if self.namespace.origin:
-                            outstr += " origin=%s" % quoteattr(c["origin"])
-                        if self.namespace.times:
-                            outstr += ' modified="%s" created="%s"' % (
-                                c["modifieddate"],
-                                c["createdate"],
-                            )
-                        outstr += ">%s</confitem>\n" % escape(c["value"])
-
-            outstr += "    </data>\n"
-            outstr += "  </host>\n"
-        outstr += "</hostinfo>\n"
-        return outstr
+                for c in cache[p].get(host, []):
+                    out.append('      <confitem key="%s"' % p)
+                    if self.namespace.origin:
+                        out.append(" origin=%s" % quoteattr(c.origin))
+                    if self.namespace.times:
+                        out.append(
+                            ' modified="%s" created="%s"'
+                            % (c.modifieddate, c.createdate)
+                        )
+                    out.append(">%s</confitem>\n" % escape(c.value))
+            out.append("    </data>\n")
+            out.append("  </host>\n")
+            yield "".join(out)
+        yield "</hostinfo>\n"
 
     ###########################################################################
     def DisplayJson(self, matches):
@@ -395,78 +443,100 @@ class Command(HostinfoCommand):
 
         cache = self.loadPrintoutCache(columns, matches)
 
-        data = {}
+        # The same as json.dumps() of the whole lot but a host at a time
+        sep = "{"
         for host in matches:
-            hname = _hostcache[host].hostname
-            data[hname] = {}
+            data = {}
             for p in columns:
-                if host not in cache[p] or len(cache[p][host]) == 0:
-                    pass
-                else:
-                    data[hname][p] = []
-                    for c in cache[p][host]:
-                        data[hname][p].append(c["value"])
-
-        return json.dumps(data)
+                if cache[p].get(host):
+                    data[p] = [c.value for c in cache[p][host]]
+            yield "%s%s: %s" % (
+                sep,
+                json.dumps(_hostcache[host].hostname),
+                json.dumps(data),
+            )
+            sep = ", "
+        yield "{}" if sep == "{" else "}"
 
     ###########################################################################
     def DisplayCSV(self, matches):
         """Display hosts and other printables in CSV format"""
-        output = []
         if self.namespace.showall:
             columns = [k.key for k in AllowedKey.objects.all()]
             columns.sort()
         else:
             columns = self.printout[:]
+        sep = self.namespace.sep[0]
 
         cache = self.loadPrintoutCache(columns, matches)
 
+        eol = ""
         if self.namespace.header:
-            output.append(
-                "hostname%s%s"
-                % (self.namespace.sep[0], self.namespace.sep[0].join(columns))
-            )
+            yield "hostname%s%s" % (sep, sep.join(columns))
+            eol = "\n"
 
         for host in matches:
-            outline = "%s" % _hostcache[host].hostname
+            row = [_hostcache[host].hostname]
             for p in columns:
-                outline += self.namespace.sep[0]
-                if host not in cache[p] or len(cache[p][host]) == 0:
-                    pass
+                vals = sorted(c.value for c in cache[p].get(host, []))
+                if vals:
+                    row.append('"%s"' % sep.join(vals).replace('"', '""'))
                 else:
-                    vals = sorted(cache[p][host], key=lambda x: x["value"])
-                    outline += '"%s"' % (
-                        self.namespace.sep[0].join([c["value"] for c in vals])
-                    )
+                    row.append("")
+            yield eol + sep.join(row)
+            eol = "\n"
 
-            output.append(outline)
-        return "\n".join(output)
+    ###########################################################################
+    def printoutFields(self):
+        """The KeyValue fields that the options want printed"""
+        fields = ["value"]
+        if self.namespace.origin:
+            fields.append("origin")
+        if self.namespace.times:
+            fields.extend(["createdate", "modifieddate"])
+        return fields
 
     ###########################################################################
-    def loadPrintoutCache(self, columns, matches=None):
-        # Load all the information that we have been requested into a cache
-        cache = {}
-        for p in columns:
-            getAK(p)
-            cache[p] = {}
-            allv = KeyValue.objects.filter(keyid=getAK(p).id).values()
-            for val in allv:
-                hostid = val["hostid_id"]
-                if matches and hostid not in matches:
+    def loadPrintoutCache(self, columns, matches=None, fields=("value",)):
+        """Load the values of the columns for the matching hosts in one go.
+        Return {key: {hostid: [rows with the fields]}}"""
+        cache = {p: {} for p in columns}
+        keys = {getAK(p).id: p for p in columns}
+        if not keys or (matches is not None and not matches):
+            return cache
+        kvs = KeyValue.objects.filter(keyid__in=keys).order_by("id")
+        kvs = kvs.values_list("hostid", "keyid", *fields, named=True)
+        if matches is None:
+            querysets = [kvs]
+            wanted = None
+        elif len(matches) <= PRINTOUT_IN_LIMIT:
+            # Only ask for the matching hosts
+            ids = sorted(matches)
+            querysets = [
+                kvs.filter(hostid__in=ids[start : start + PRINTOUT_CHUNK])
+                for start in range(0, len(ids), PRINTOUT_CHUNK)
+            ]
+            wanted = None
+        else:
+            # Most of the hosts - cheaper to read the lot and skip the others
+            querysets = [kvs]
+            wanted = set(matches)
+        for queryset in querysets:
+            for row in queryset:
+                if wanted is not None and row.hostid not in wanted:
                     continue
-                try:
-                    cache[p][hostid].append(val)
-                except KeyError:
-                    cache[p][hostid] = [val]
+                cache[keys[row.keyid]].setdefault(row.hostid, []).append(row)
         return cache
 
     ###########################################################################
     def DisplayNormal(self, matches):
         """Display hosts and other printables to stdout in human readable format"""
-        cache = self.loadPrintoutCache(self.printout, matches)
-        outstr = ""
+        cache = self.loadPrintoutCache(self.printout, matches, self.printoutFields())
 
+        line = None
         for host in matches:
+            if line is not None:
+                yield line
             output = "%s\t" % _hostcache[host].hostname
 
             # Generate the output for the hostname
@@ -483,22 +553,24 @@ class Command(HostinfoCommand):
                 if host not in cache[p]:
                     val = ""
                 else:
-                    for kv in sorted(cache[p][host], key=lambda x: x["value"]):
-                        val += "%s" % kv["value"]
+                    for kv in sorted(cache[p][host], key=lambda x: x.value):
+                        val += "%s" % kv.value
                         if self.namespace.origin:
-                            val += "[Origin: %s]" % kv["origin"]
+                            val += "[Origin: %s]" % kv.origin
                         if self.namespace.times:
                             val += "[Created: %s, Modified: %s]" % (
-                                kv["createdate"],
-                                kv["modifieddate"],
+                                kv.createdate,
+                                kv.modifieddate,
                             )
                         val += self.namespace.sep[0]
                 output += "%s=%s\t" % (p, val[:-1])
 
-            outstr += "%s%s" % (output.rstrip(), self.namespace.hsep[0])
-        if outstr and not outstr.endswith("\n"):
-            outstr = "%s%s" % (outstr[:-1], "\n")
-        return outstr
+            line = "%s%s" % (output.rstrip(), self.namespace.hsep[0])
+        # The output always finishes with a newline
+        if line is not None:
+            if not line.endswith("\n"):
+                line = "%s%s" % (line[:-1], "\n")
+            yield line
 
 
 # EOF
@@ -19,7 +19,8 @@
 import os
 import re
 import sys
-from host.models import addKeytoHost
+from django.db import transaction
+from host.models import KeyValueBatch
 from host.models import RestrictedValueException
 from host.models import ReadonlyValueException, HostinfoException
 from host.models import HostinfoCommand
@@ -55,34 +56,33 @@ class Command(HostinfoCommand):
         value = m.group("value").lower()
         if not namespace.origin:
             namespace.origin = os.path.basename(sys.argv[0])
+        # Do all the hosts at once so tagging a fleet is a handful of queries
+        batch = KeyValueBatch(
+            origin=namespace.origin, readonlychange=namespace.readonlyupdate
+        )
         for host in namespace.host:
-            host = host.lower().strip()
-            try:
-                addKeytoHost(
-                    host=host,
-                    key=key,
-                    value=value,
-                    origin=namespace.origin,
-                    readonlyFlag=namespace.readonlyupdate,
-                    updateFlag=namespace.update,
-                    appendFlag=namespace.append,
-                )
-            except RestrictedValueException:
+            batch.add(
+                host.lower().strip(),
+                key,
+                value,
+                update=namespace.update,
+                append=namespace.append,
+            )
+        with transaction.atomic():
+            results = batch.apply()
+        for result in results:
+            if isinstance(result, RestrictedValueException):
                 raise RestrictedValueException(
                     "Cannot add %s=%s to a restricted key" % (key, value),
                     key=key,
                     retval=2,
                 )
-            except ReadonlyValueException:
+            if isinstance(result, ReadonlyValueException):
                 raise ReadonlyValueException(
                     "Cannot add %s=%s to a readonly key" % (key, value), retval=3
                 )
-            except HostinfoException as err:
-                raise
-            except TypeError as err:  # pragma: nocover
-                raise HostinfoException(
-                    "Couldn't add value %s to %s - %s" % (value, host, err)
-                )
+            if isinstance(result, HostinfoException):
+                raise result
         return None, 0
 
 
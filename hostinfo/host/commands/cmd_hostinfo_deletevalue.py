@@ -17,8 +17,9 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
-from host.models import HostinfoException, KeyValue, getAK
-from host.models import HostinfoCommand, getHost, ReadonlyValueException
+from django.db import transaction
+from host.models import HostinfoException, KeyValueBatch, getAK
+from host.models import HostinfoCommand, ReadonlyValueException
 
 
 ###############################################################################
@@ -46,25 +47,17 @@ class Command(HostinfoCommand):
         else:
             key = namespace.keyvalue.lower()
             value = ""
-        keyid = getAK(key)
+        getAK(key)  # Complain about a bad key before any bad hosts
+        batch = KeyValueBatch(readonlychange=namespace.readonlyupdate)
         for host in namespace.host:
-            hostid = getHost(host)
-            if not hostid:
-                raise HostinfoException("Unknown host: %s" % host)
-            if value:
-                kvlist = KeyValue.objects.filter(
-                    hostid=hostid, keyid=keyid, value=value
-                )
-            else:
-                kvlist = KeyValue.objects.filter(hostid=hostid, keyid=keyid)
-            if not kvlist:
-                raise HostinfoException("Host %s doesn't have key %s" % (host, key))
-            else:
-                for kv in kvlist:
-                    try:
-                        kv.delete(readonlychange=namespace.readonlyupdate)
-                    except ReadonlyValueException:
-                        raise HostinfoException("Cannot delete a readonly value")
+            batch.delete(host, key, value or None)
+        with transaction.atomic():
+            results = batch.apply()
+        for result in results:
+            if isinstance(result, ReadonlyValueException):
+                raise HostinfoException("Cannot delete a readonly value")
+            if isinstance(result, HostinfoException):
+                raise result
         return None, 0
 
 
@@ -15,15 +15,21 @@
 
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import json
+import os
 import sys
+import time
 import xml.etree.ElementTree
-from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from host.models import HostinfoCommand
 from host.models import HostinfoException
 from host.models import RestrictedValueException, RestrictedValue
-from host.models import Host, AllowedKey, KeyValue
+from host.models import Host, HostAlias, AllowedKey, KeyValueBatch, UndoLog
+from host.models import BATCH_CHUNK, getAK, getUser, hostsChanged
 
-_akcache = {}
+IMPORT_BATCH = 500
+ACTIONS = {"created": "Creating", "appended": "Appending", "updated": "Replacing"}
 
 
 ###############################################################################
@@ -48,33 +54,116 @@ class Command(HostinfoCommand):
             action="store_true",
             default=False,
         )
+        parser.add_argument(
+            "--progress",
+            help="Report how many hosts have been imported as it goes",
+            action="store_true",
+            default=False,
+        )
+        parser.add_argument(
+            "--batch",
+            help="How many hosts to import in each transaction (default %(default)s)",
+            type=int,
+            default=IMPORT_BATCH,
+        )
+        parser.add_argument(
+            "--checkpoint",
+            help="File to record how far the import has got, so that an "
+            "interrupted import carries on from there when run again",
+        )
         parser.add_argument("xmlfile", help="The file to import from")
 
     ###########################################################################
     def handle(self, namespace):
         """ handle the call """
         self.namespace = namespace
+        self.skip = self.readCheckpoint()
+        self.hostnum = 0  # How many hosts have been read from the file
+        self.imported = self.skip  # How many of those are in the database
+        self.pending = []
+        self.retval = 0
+        self.starttime = time.time()
+        for elem in self.parse(namespace.xmlfile):
+            if elem.tag == "key":
+                self.flush()  # Keep the changes in the order of the file
+                self.handleKey(elem)
+            elif elem.tag == "host":
+                self.handleHost(elem)
+        self.flush()
+        checkpoint = namespace.checkpoint
+        if checkpoint and not namespace.kiddingFlag and os.path.exists(checkpoint):
+            os.unlink(checkpoint)
+        return None, self.retval
+
+    ###########################################################################
+    def parse(self, xmlfile):
+        """Yield the elements under the root of the file. Each one is
+        thrown away once it has been handled, so the memory used doesn't
+        depend on the size of the file."""
         try:
-            xmltree = xml.etree.ElementTree.parse(namespace.xmlfile)
+            events = xml.etree.ElementTree.iterparse(xmlfile, events=("start", "end"))
         except IOError as exc:
             if exc.errno == 2:
-                raise HostinfoException("File %s doesn't exist" % namespace.xmlfile)
+                raise HostinfoException("File %s doesn't exist" % xmlfile)
             else:
                 raise HostinfoException(
-                    "File %s not readable (errno=%d)" % (namespace.xmlfile, exc.errno)
+                    "File %s not readable (errno=%d)" % (xmlfile, exc.errno)
                 )
-
-        for key in xmltree.findall("key"):
-            self.handleKey(key)
-        for host in xmltree.findall("host"):
-            self.handleHost(host)
-        return None, 0
+        root = None
+        depth = 0
+        try:
+            for event, elem in events:
+                if event == "start":
+                    if root is None:
+                        root = elem
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 1:
+                    yield elem
+                    root.clear()
+        except xml.etree.ElementTree.ParseError as exc:
+            raise HostinfoException("Couldn't parse %s: %s" % (xmlfile, exc))
 
     ###########################################################################
     def verbose(self, msg):
         if self.namespace.verboseFlag:
             sys.stderr.write("%s\n" % msg)
 
+    ###########################################################################
+    def readCheckpoint(self):
+        """Return how many hosts an earlier run has already imported"""
+        checkpoint = self.namespace.checkpoint
+        if not checkpoint or not os.path.exists(checkpoint):
+            return 0
+        try:
+            with open(checkpoint) as cpfh:
+                state = json.load(cpfh)
+        except (OSError, ValueError) as exc:
+            raise HostinfoException(
+                "Couldn't read checkpoint %s: %s" % (checkpoint, exc)
+            )
+        if state.get("xmlfile") != os.path.abspath(self.namespace.xmlfile):
+            raise HostinfoException(
+                "Checkpoint %s is for %s" % (checkpoint, state.get("xmlfile"))
+            )
+        self.verbose("Skipping the %d hosts already imported" % state["hosts"])
+        return state["hosts"]
+
+    ###########################################################################
+    def writeCheckpoint(self):
+        checkpoint = self.namespace.checkpoint
+        if not checkpoint or self.namespace.kiddingFlag:
+            return
+        state = {
+            "xmlfile": os.path.abspath(self.namespace.xmlfile),
+            "hosts": self.imported,
+        }
+        tmpfile = "%s.tmp" % checkpoint
+        with open(tmpfile, "w") as cpfh:
+            json.dump(state, cpfh)
+        os.replace(tmpfile, checkpoint)
+
     ###########################################################################
     def validateKeytype(self, keytype):
         # Work out which type it should be
@@ -177,10 +266,9 @@ class Command(HostinfoCommand):
         else:
             change = False
             if ak.validtype != keytype:
-                sys.stderr.write(
-                    "Changing key types currently unsupported: %s\n" % name
+                raise HostinfoException(
+                    "Changing key types currently unsupported: %s" % name
                 )
-                sys.exit(1)
             if ak.restrictedFlag != restrictedFlag:
                 self.verbose(
                     "Changing %s: restrictedFlag from %s to %s"
@@ -229,6 +317,9 @@ class Command(HostinfoCommand):
 
           <host docpage="None"  origin="explorer2hostinfo.py by w86765"  modified="2008-03-20" created="2008-03-20" >
            <hostname>zone_161.117.101.190</hostname>
+           <aliaslist>
+            <alias>zone161</alias>
+           </aliaslist>
            <data>
             <confitem key="os" origin="w86765" modified="2008-08-19" created="2008-08-19">solaris</confitem>
             <confitem key="type" origin="..." modified="2008-07-02" created="2008-03-20">virtual</confitem>
@@ -236,71 +327,205 @@ class Command(HostinfoCommand):
             <confitem key="zonename" origin="..." modified="2008-03-20" created="2008-03-20">app04</confitem>
            </data>
           </host>
+
+        Hosts are queued up and written a batch at a time by flush()
         """
-        hostname = hosttree.find("hostname").text
+        self.hostnum += 1
+        if self.hostnum <= self.skip:  # Done by an earlier run
+            return
+        hostname = hosttree.find("hostname").text.lower().strip()
         self.verbose(hostname)
-        try:
-            host = Host.objects.get(hostname=hostname)
-        except ObjectDoesNotExist:
+        aliases = [a.text.lower().strip() for a in hosttree.iterfind("aliaslist/alias")]
+        values = []
+        for data in hosttree.iterfind("data/confitem"):
+            origin = data.attrib.get("origin", "unknown")
+            values.append((data.attrib["key"], data.text or "", origin))
+        self.pending.append(
+            {
+                "hostname": hostname,
+                "docpage": hosttree.attrib.get("docpage", None),
+                "origin": hosttree.attrib.get("origin", "unknown - import"),
+                "aliases": aliases,
+                "values": values,
+            }
+        )
+        if len(self.pending) >= self.namespace.batch:
+            self.flush()
+
+    ###########################################################################
+    def flush(self):
+        """Import the queued hosts, their aliases and values in one
+        transaction"""
+        if not self.pending:
+            return
+        with transaction.atomic():
+            hostids = self.createHosts(self.pending)
+            self.createAliases(self.pending, hostids)
+            self.importValues(self.pending, hostids)
+        self.imported += len(self.pending)
+        self.pending = []
+        self.writeCheckpoint()
+        if self.namespace.progress:
+            sys.stderr.write(
+                "Imported %d hosts in %0.1f seconds\n"
+                % (self.imported, time.time() - self.starttime)
+            )
+
+    ###########################################################################
+    def createHosts(self, pending):
+        """Create the hosts that don't exist yet and return {hostname: id}
+        of all of the hosts"""
+        names = list(set(h["hostname"] for h in pending))
+        hostids = self.hostIds(names)
+        new = {}
+        for h in pending:
+            if h["hostname"] in hostids or h["hostname"] in new:
+                continue
             host = Host(
-                hostname=hostname,
-                docpage=hosttree.attrib.get("docpage", None),
-                origin=hosttree.attrib.get("origin", "unknown - import"),
+                hostname=h["hostname"], docpage=h["docpage"], origin=h["origin"]
             )
             self.verbose("New host %s" % repr(host))
-            if not self.namespace.kiddingFlag:
-                host.save()
+            new[h["hostname"]] = host
+        if not new or self.namespace.kiddingFlag:
+            return hostids
+        hosts = list(new.values())
+        Host.objects.bulk_create(hosts, batch_size=BATCH_CHUNK)
+        if hosts[0].id is None:  # Database can't return the ids
+            ids = self.hostIds(list(new))
+            for host in hosts:
+                host.id = ids[host.hostname]
+        Host.history.bulk_history_create(hosts, batch_size=BATCH_CHUNK)
+        user = getUser()
+        UndoLog.objects.bulk_create(
+            [
+                UndoLog(user=user, action="hostinfo_deletehost --lethal %s" % h)
+                for h in new
+            ],
+            batch_size=BATCH_CHUNK,
+        )
+        hostsChanged()
+        hostids.update((host.hostname, host.id) for host in hosts)
+        return hostids
 
-        for data in hosttree.find("data").findall("confitem"):
-            key = data.attrib["key"]
-            if "origin" in data.attrib:
-                origin = data.attrib["origin"]
-            else:
-                origin = "unknown"
-            value = data.text
-            try:
-                self.handleValue(host, key, origin, value)
-            except RestrictedValueException:
+    ###########################################################################
+    @staticmethod
+    def hostIds(names):
+        hostids = {}
+        for start in range(0, len(names), BATCH_CHUNK):
+            hostids.update(
+                Host.objects.filter(
+                    hostname__in=names[start : start + BATCH_CHUNK]
+                ).values_list("hostname", "id")
+            )
+        return hostids
+
+    ###########################################################################
+    def createAliases(self, pending, hostids):
+        """Add the aliases that the hosts don't already have"""
+        wanted = {}
+        for h in pending:
+            for alias in h["aliases"]:
+                wanted[alias] = h["hostname"]
+        if not wanted:
+            return
+        names = list(wanted)
+        used = {name: name for name in self.hostIds(names)}  # Can't be hostnames
+        for start in range(0, len(names), BATCH_CHUNK):
+            used.update(
+                HostAlias.objects.filter(
+                    alias__in=names[start : start + BATCH_CHUNK]
+                ).values_list("alias", "hostid__hostname")
+            )
+        new = []
+        for alias, hostname in wanted.items():
+            if alias in used:
+                if used[alias] != hostname:
+                    sys.stderr.write(
+                        "Alias %s of %s is already used by %s - ignoring\n"
+                        % (alias, hostname, used[alias])
+                    )
+                continue
+            self.verbose("New alias %s -> %s" % (alias, hostname))
+            if hostname in hostids:
+                new.append(HostAlias(hostid_id=hostids[hostname], alias=alias))
+        if not new or self.namespace.kiddingFlag:
+            return
+        HostAlias.objects.bulk_create(new, batch_size=BATCH_CHUNK)
+        if new[0].id is None:  # Database can't return the ids
+            ids = dict(
+                HostAlias.objects.filter(
+                    alias__in=[ha.alias for ha in new]
+                ).values_list("alias", "id")
+            )
+            for ha in new:
+                ha.id = ids[ha.alias]
+        HostAlias.history.bulk_history_create(new, batch_size=BATCH_CHUNK)
+        hostsChanged()
+
+    ###########################################################################
+    def importValues(self, pending, hostids):
+        """Add or replace the values of the hosts. Values that can't be set
+        are reported and skipped."""
+        ops = []
+        for h in pending:
+            if h["hostname"] not in hostids:  # Only when kidding
+                for key, value, origin in h["values"]:
+                    self.verbose("Creating %s: %s=%s" % (h["hostname"], key, value))
+                continue
+            for key, value, origin in h["values"]:
+                ops.append((h["hostname"], key, value, origin))
+        # Skipping values can change how the others go, so keep checking
+        # until everything that is left can be done
+        while ops:
+            batch = self.valueBatch(ops)
+            results = batch.apply(write=False)
+            failed = [
+                (op, result)
+                for op, result in zip(ops, results)
+                if isinstance(result, HostinfoException)
+            ]
+            if not failed:
+                break
+            self.reportFailures(failed)
+            failedops = set(id(op) for op, _ in failed)
+            ops = [op for op in ops if id(op) not in failedops]
+        if not ops:
+            return
+        for (hostname, key, value, _), result in zip(ops, results):
+            if result in ACTIONS:
+                self.verbose("%s %s: %s=%s" % (ACTIONS[result], hostname, key, value))
+        if not self.namespace.kiddingFlag:
+            batch.write()
+
+    ###########################################################################
+    def reportFailures(self, failed):
+        """Say which values can't be set"""
+        for (hostname, key, value, _), exc in failed:
+            if isinstance(exc, RestrictedValueException):
                 sys.stderr.write(
                     "Trying to change a restricted value: %s:%s=%s - ignoring\n"
                     % (hostname, key, value)
                 )
+            else:
+                sys.stderr.write(
+                    "Couldn't set %s:%s=%s: %s - ignoring\n"
+                    % (hostname, key, value, exc.msg)
+                )
+                self.retval = 1
 
     ###########################################################################
-    def getAllowedKey(self, key):
-        if key in _akcache:
-            return _akcache[key]
-        _akcache[key] = AllowedKey.objects.get(key=key)
-        return _akcache[key]
-
-    ###########################################################################
-    def handleValue(self, host, key, origin, value):
+    def valueBatch(self, ops):
         # We allow changes to readonly keys as that is the whole point
-        ak = self.getAllowedKey(key)
-        if ak.get_validtype_display() == "list":
+        batch = KeyValueBatch(readonlychange=True)
+        for hostname, key, value, origin in ops:
             try:
-                kv = KeyValue.objects.get(hostid=host.id, keyid__key=key, value=value)
-            except ObjectDoesNotExist:
-                kv = KeyValue(hostid=host, keyid=ak, value=value, origin=origin)
-                self.verbose("Appending %s: %s=%s" % (host.hostname, key, value))
-                if not self.namespace.kiddingFlag:
-                    kv.save(readonlychange=True)
-            except MultipleObjectsReturned:
-                pass
-        else:
-            try:
-                kv = KeyValue.objects.get(hostid=host.id, keyid__key=key)
-            except ObjectDoesNotExist:
-                kv = KeyValue(hostid=host, keyid=ak, value=value, origin=origin)
-                self.verbose("Creating %s: %s=%s" % (host.hostname, key, value))
-                if not self.namespace.kiddingFlag:
-                    kv.save(readonlychange=True)
-            else:
-                kv.value = value
-                kv.origin = origin
-                self.verbose("Replacing %s: %s=%s" % (host.hostname, key, value))
-                if not self.namespace.kiddingFlag:
-                    kv.save(readonlychange=True)
+                listkey = getAK(key).get_validtype_display() == "list"
+            except HostinfoException:
+                listkey = False  # apply() will complain about it
+            batch.add(
+                hostname, key, value, update=not listkey, append=listkey, origin=origin
+            )
+        return batch
 
 
 # EOF
@@ -16,8 +16,7 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from host.models import UndoLog
-from host.models import HostinfoCommand
-import os
+from host.models import HostinfoCommand, getLogin
 import datetime
 
 
@@ -55,7 +54,7 @@ class Command(HostinfoCommand):
             user = namespace.user[0]
         else:
             try:
-                user = os.getlogin()
+                user = getLogin()
             except OSError:  # pragma: no cover
                 user = "unknown"
         ulog = UndoLog.objects.filter(user=user, actiondate__gte=then)
@@ -0,0 +1,81 @@
+""" Serve the hostinfo commands over a unix socket """
+#
+# Written by Dougal Scott <dougal.scott@gmail.com>
+#
+#    Copyright (C) 2025 Dougal Scott
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import signal
+import socket
+from django.core.management.base import BaseCommand, CommandError
+
+from host.cliclient import serverRunning, socketPath
+from host.cliserver import CLIENT_TIMEOUT, CommandServer, unsharedCacheSettings
+
+
+###############################################################################
+class Command(BaseCommand):
+    help = (
+        "Run the hostinfo commands for bin/hostinfo in this process so that "
+        "they don't have to start django each time"
+    )
+
+    ###########################################################################
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--socket", default=socketPath(), help="Unix socket to listen on"
+        )
+        parser.add_argument(
+            "--mode", default="660", help="Permissions of the socket (octal)"
+        )
+        parser.add_argument(
+            "--timeout",
+            type=int,
+            default=CLIENT_TIMEOUT,
+            help="Seconds to wait for a client before dropping it "
+            "(default %(default)s)",
+        )
+
+    ###########################################################################
+    def handle(self, *args, **options):
+        path = options["socket"]
+        if not path:
+            raise CommandError("No socket to listen on")
+        try:
+            mode = int(options["mode"], 8)
+        except ValueError:
+            raise CommandError("Bad socket mode %s" % options["mode"])
+        if not hasattr(socket, "SO_PEERCRED"):
+            raise CommandError("Can't tell who clients are on this platform")
+        unshared = unsharedCacheSettings()
+        if unshared:
+            raise CommandError("%s need a shared CACHES" % ", ".join(unshared))
+        if serverRunning(path):
+            raise CommandError("Already running on %s" % path)
+        signal.signal(signal.SIGTERM, self.stop)
+        with CommandServer(path, mode, options["timeout"]) as server:
+            self.stdout.write("Listening on %s" % path)
+            self.stdout.flush()
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+
+    ###########################################################################
+    def stop(self, signum, frame):
+        raise KeyboardInterrupt
+
+
+# EOF
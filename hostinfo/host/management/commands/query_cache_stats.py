@@ -0,0 +1,47 @@
+""" Show how well the query cache is working """
+#
+# Written by Dougal Scott <dougal.scott@gmail.com>
+#
+#    Copyright (C) 2025 Dougal Scott
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+
+from host.models import queryCacheStats, resetQueryCacheStats
+
+
+###############################################################################
+class Command(BaseCommand):
+    help = "Show the hits and misses of the query cache"
+
+    ###########################################################################
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--reset", action="store_true", help="Start counting again afterwards"
+        )
+
+    ###########################################################################
+    def handle(self, *args, **options):
+        stats = queryCacheStats()
+        total = stats["hits"] + stats["misses"]
+        ratio = 100.0 * stats["hits"] / total if total else 0.0
+        self.stdout.write(
+            f"hits {stats['hits']} misses {stats['misses']} ({ratio:.1f}% hits)"
+        )
+        if options["reset"]:
+            resetQueryCacheStats()
+
+
+# EOF
@@ -0,0 +1,48 @@
+""" Rebuild the index used for approximate (key@value) matching """
+#
+# Written by Dougal Scott <dougal.scott@gmail.com>
+#
+#    Copyright (C) 2025 Dougal Scott
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand, CommandError
+
+from host.models import ApproxIndex, HostinfoException, getAK
+
+
+###############################################################################
+class Command(BaseCommand):
+    help = (
+        "Rebuild the approximate match index - needed if "
+        "HOSTINFO_APPROX_DISTANCE changes"
+    )
+
+    ###########################################################################
+    def add_arguments(self, parser):
+        parser.add_argument("keys", nargs="*", help="Only rebuild these keys")
+
+    ###########################################################################
+    def handle(self, *args, **options):
+        if not options["keys"]:
+            ApproxIndex.rebuild()
+            return
+        for key in options["keys"]:
+            try:
+                ApproxIndex.rebuild(keyid=getAK(key).id)
+            except HostinfoException as exc:
+                raise CommandError(exc.msg)
+
+
+# EOF
@@ -0,0 +1,48 @@
+""" Recount the values of the keys used by the value reports """
+#
+# Written by Dougal Scott <dougal.scott@gmail.com>
+#
+#    Copyright (C) 2025 Dougal Scott
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand, CommandError
+
+from host.models import KeyStats, HostinfoException, getAK
+
+
+###############################################################################
+class Command(BaseCommand):
+    help = (
+        "Recount how many hosts have each value of each key - needed if "
+        "the values have been changed directly in the database"
+    )
+
+    ###########################################################################
+    def add_arguments(self, parser):
+        parser.add_argument("keys", nargs="*", help="Only recount these keys")
+
+    ###########################################################################
+    def handle(self, *args, **options):
+        if not options["keys"]:
+            KeyStats.rebuild()
+            return
+        for key in options["keys"]:
+            try:
+                KeyStats.rebuild(keyid=getAK(key).id)
+            except HostinfoException as exc:
+                raise CommandError(exc.msg)
+
+
+# EOF
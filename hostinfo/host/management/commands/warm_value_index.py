@@ -0,0 +1,54 @@
+""" Load the value index postings into the shared cache """
+#
+# Written by Dougal Scott <dougal.scott@gmail.com>
+#
+#    Copyright (C) 2025 Dougal Scott
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand, CommandError
+
+from host.models import AllowedKey, HostinfoException, ValueIndex, getAK
+
+
+###############################################################################
+class Command(BaseCommand):
+    help = (
+        "Build the value index for keys and share it through the cache so "
+        "that the web and cli processes can answer queries from memory"
+    )
+
+    ###########################################################################
+    def add_arguments(self, parser):
+        parser.add_argument("keys", nargs="*", help="Only warm these keys")
+
+    ###########################################################################
+    def handle(self, *args, **options):
+        if options["keys"]:
+            try:
+                keys = [getAK(key) for key in options["keys"]]
+            except HostinfoException as exc:
+                raise CommandError(exc.msg)
+        else:
+            keys = AllowedKey.objects.all()
+        for ak in keys:
+            postings, gen = ValueIndex.publish(ak.id)
+            if gen is None:
+                raise CommandError("The cache can't hold the value index")
+            size = ValueIndex.postingsSize(postings)
+            if options["verbosity"] > 1:
+                self.stdout.write(f"{ak.key}: {len(postings)} values {size} bytes")
+
+
+# EOF
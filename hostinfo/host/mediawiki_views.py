@@ -20,18 +20,17 @@
 from django.http import HttpResponse
 from django.shortcuts import render
 
-from .models import KeyValue
 from .models import RestrictedValue, HostinfoException
 
 from .views import criteriaFromWeb, getHostList
-from .views import orderHostList, hostData, getLinks
+from .views import orderHostList, hostData, getLinks, materializeHosts
 
 
 ################################################################################
-def getWikiLinks(hostid=None, hostname=None):
+def getWikiLinks(hostid=None, hostname=None, links=None):
     """ Links """
     wikilinks = []
-    for url, tag in getLinks(hostid, hostname):
+    for url, tag in getLinks(hostid, hostname, links):
         wikilinks.append(f"[{url} {tag}]")
     return wikilinks
 
@@ -76,22 +75,18 @@ def hosttable(request, criturl, options=None):
     if order:
         hl = orderHostList(hl, order)
     else:
-        hl.sort()  # Sort by hostname
+        hl.sort(key=lambda h: h.hostname)
     output += "!Hostname\n"
     for p in printers:
         output += f"!{p.title()}\n"
-    for host in hl:
+    for host, hostview, _, _ in materializeHosts(hl, printers=printers):
         output += "|-\n"
         output += f"| [[Host:{host.hostname}|{host.hostname}]]\n"
-    for p in printers:
-        kv = KeyValue.objects.filter(keyid__key=p, hostid=host.id)
-        if len(kv) == 0:
-            val = ""
-        elif len(kv) == 1:
-            val = kv[0].value
-        else:
-            val = ",".join([key.value for key in kv])
-        output += f"| {val}\n"
+        if not printers:
+            continue
+        for _, kvs in hostview:
+            val = ",".join([kv.value for kv in kvs])
+            output += f"| {val}\n"
     output += "|}\n"
     return HttpResponse(output)
 
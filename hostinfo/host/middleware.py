@@ -0,0 +1,39 @@
+"""Middleware for hostinfo"""
+#
+# Written by Dougal Scott <dougal.scott@gmail.com>
+#
+#    Copyright (C) 2025 Dougal Scott
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from .models import bypassQueryCache
+
+
+###############################################################################
+def QueryCacheMiddleware(get_response):
+    """Skip the query cache for requests that ask for fresh answers with
+    a "Cache-Control: no-cache" header or a nocache parameter"""
+
+    def middleware(request):
+        if "nocache" in request.GET or "no-cache" in request.headers.get(
+            "Cache-Control", ""
+        ):
+            with bypassQueryCache():
+                return get_response(request)
+        return get_response(request)
+
+    return middleware
+
+
+# EOF
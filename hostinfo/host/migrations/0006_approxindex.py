@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:58
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def build_index(apps, schema_editor):
+    """Populate the approximate match index from the existing values"""
+    KeyValue = apps.get_model("host", "KeyValue")
+    ApproxIndex = apps.get_model("host", "ApproxIndex")
+    distance = getattr(settings, "HOSTINFO_APPROX_DISTANCE", 1)
+    entries = []
+    for keyid, value in KeyValue.objects.order_by().values_list("keyid", "value").distinct():
+        variants = {value}
+        current = {value}
+        for _ in range(distance):
+            current = {v[:i] + v[i + 1:] for v in current for i in range(len(v))}
+            variants |= current
+        for variant in variants:
+            entries.append(ApproxIndex(keyid_id=keyid, variant=variant, value=value))
+        if len(entries) > 10000:
+            ApproxIndex.objects.bulk_create(entries, ignore_conflicts=True)
+            entries = []
+    ApproxIndex.objects.bulk_create(entries, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('host', '0005_alter_historicalallowedkey_options_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ApproxIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('variant', models.CharField(max_length=200)),
+                ('value', models.CharField(max_length=200)),
+                ('keyid', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='host.allowedkey')),
+            ],
+            options={
+                'unique_together': {('keyid', 'variant', 'value')},
+            },
+        ),
+        migrations.RunPython(build_index, migrations.RunPython.noop),
+    ]
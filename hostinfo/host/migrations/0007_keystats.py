@@ -0,0 +1,65 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_values(apps, schema_editor):
+    """Populate the key statistics from the existing values"""
+    KeyValue = apps.get_model("host", "KeyValue")
+    KeyStats = apps.get_model("host", "KeyStats")
+    stats = []
+    rows = KeyValue.objects.order_by().values_list("keyid", "value")
+    for keyid, value, uses in rows.annotate(uses=Count("id")):
+        try:
+            numvalue = float(value)
+        except ValueError:
+            numvalue = None
+        stats.append(
+            KeyStats(keyid_id=keyid, value=value, numvalue=numvalue, uses=uses)
+        )
+    KeyStats.objects.bulk_create(stats, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("host", "0006_approxindex"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="KeyStats",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("value", models.CharField(max_length=200)),
+                ("numvalue", models.FloatField(null=True)),
+                ("uses", models.IntegerField(default=0)),
+                (
+                    "keyid",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="host.allowedkey",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["keyid", "-uses"], name="host_keysta_keyid_i_a73d9a_idx"
+                    )
+                ],
+                "unique_together": {("keyid", "value")},
+            },
+        ),
+        migrations.RunPython(count_values, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:22
+
+from django.db import migrations, models
+
+
+def create_generations(apps, schema_editor):
+    """Start the host generation off so it doesn't have to be created
+    by whatever first changes a host"""
+    Generation = apps.get_model("host", "Generation")
+    Generation.objects.create(name="hostinfo:hostgeneration")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("host", "0007_keystats"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Generation",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100, unique=True)),
+                ("value", models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_generations, migrations.RunPython.noop),
+    ]
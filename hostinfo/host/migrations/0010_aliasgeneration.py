@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+def create_generation(apps, schema_editor):
+    """Start the alias generation off so it doesn't have to be created by
+    whatever first changes an alias"""
+    Generation = apps.get_model("host", "Generation")
+    Generation.objects.get_or_create(name="hostinfo:aliasgeneration")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("host", "0009_akgeneration"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_generation, migrations.RunPython.noop),
+    ]
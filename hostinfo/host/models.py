@@ -18,21 +18,53 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import hashlib
 import os
+import random
 import re
 import sys
 import time
+from array import array
+from bisect import bisect_left
 from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date, datetime, timezone
+from functools import lru_cache
 from operator import itemgetter
-from django.db import models, connection
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db import models, connection, transaction
+from django.db.models import Count, Exists, F, OuterRef, Q, Sum, Window
+from django.db.models.functions import RowNumber
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
+from django.utils import timezone as django_timezone
 from simple_history.models import HistoricalRecords
 
-_akcache = {None: None}
-_all_hosts = None
-_all_hosts_cache_time = None
+_akcache = {}
+_akchecked = False  # Has the generation of _akcache been checked lately
+AK_GENERATION = "hostinfo:akgeneration"
+AK_METADATA = "hostinfo:akmetadata"
+AK_METADATA_TIMEOUT = 24 * 60 * 60
+_hostindex = None
+HOST_GENERATION = "hostinfo:hostgeneration"
+_valueindex = None
+VALUE_GENERATION = "hostinfo:valuegeneration:%d"
+VALUE_POSTINGS = "hostinfo:valuepostings:%d:%d"
+DATA_GENERATION = "hostinfo:datageneration"
+DATA_MODIFIED = "hostinfo:datamodified"
+KEY_GENERATION = "hostinfo:keygeneration:%d"
+ALIAS_GENERATION = "hostinfo:aliasgeneration"
+QUERY_CACHE = "hostinfo:query:%s"
+QUERY_CACHE_STATS = "hostinfo:querycache:%s"
+BATCH_CHUNK = 500
+_querycache_bypass = ContextVar("querycache_bypass", default=False)
+# The login of whoever is running a command through the command server
+_clientuser = ContextVar("clientuser", default=None)
 
 
 ################################################################################
@@ -82,6 +114,14 @@ class HostinfoInternalException(HostinfoException):  # pragma: no cover
         self.retval = retval
 
 
+################################################################################
+def getLogin():
+    """The login of whoever is running the command - the client of the
+    command server if that is what is running it. Raises OSError like
+    os.getlogin() if there isn't one."""
+    return _clientuser.get() or os.getlogin()
+
+
 ################################################################################
 def getUser(instance=None):
     """Get the user for the audittrail
@@ -89,7 +129,7 @@ def getUser(instance=None):
     """
     username = user = None
     try:
-        username = os.getlogin()
+        username = getLogin()
     except OSError:
         username = "unknown"
     if username and user is None:
@@ -117,7 +157,6 @@ class Host(models.Model):
 
     ############################################################################
     def save(self, user=None, **kwargs):
-        global _all_hosts
         if not user:
             user = getUser()
         self.hostname = self.hostname.lower()
@@ -127,17 +166,14 @@ class Host(models.Model):
             )
             undo.save()
         super().save(**kwargs)
-        _all_hosts = None
 
     ############################################################################
     def delete(self, user=None):
-        global _all_hosts
         if not user:
             user = getUser()
         undo = UndoLog(user=user, action="hostinfo_addhost %s" % self.hostname)
         undo.save()
         super(Host, self).delete()
-        _all_hosts = None
 
     ############################################################################
     def __str__(self):  # pragma: no cover
@@ -217,14 +253,10 @@ class KeyValue(models.Model):
         self.value = self.value.lower().strip()
         if not self.value:
             raise HostinfoException("Empty value not permitted")
-        try:
-            self.numvalue = float(self.value)
-        except ValueError:
-            self.numvalue = None
+        self.numvalue = numericValue(self.value)
         # Check to see if we are restricted
         if self.keyid.restrictedFlag:
-            rk = RestrictedValue.objects.filter(keyid=self.keyid, value=self.value)
-            if not rk:
+            if not permittedValue(self.keyid_id, self.value):
                 raise RestrictedValueException(
                     key=self.keyid, msg="%s is a restricted key" % self.keyid
                 )
@@ -236,6 +268,7 @@ class KeyValue(models.Model):
         if self.keyid.get_validtype_display() == "date":
             self.value = validateDate(self.value)
 
+        oldobj = None
         if self.id:  # Check for update
             oldobj = KeyValue.objects.get(id=self.id)
             undo = UndoLog(
@@ -255,7 +288,15 @@ class KeyValue(models.Model):
         # Actually do the saves
         if not self.keyid.auditFlag:
             self.skip_history_when_saving = True
+        self._previous_value = oldobj.value if oldobj else None
         super(KeyValue, self).save(**kwargs)
+        if oldobj is None or oldobj.value != self.value:
+            # Values that other hosts have are already in the index
+            others = KeyValue.objects.filter(keyid=self.keyid_id, value=self.value)
+            if not others.exclude(id=self.id).exists():
+                ApproxIndex.addValues(self.keyid_id, [self.value])
+        if oldobj and oldobj.value != self.value:
+            ApproxIndex.removeValues(self.keyid_id, [oldobj.value])
 
     ############################################################################
     def delete(self, user=None, readonlychange=False):
@@ -276,6 +317,7 @@ class KeyValue(models.Model):
         )
         undo.save()
         super(KeyValue, self).delete()
+        ApproxIndex.removeValues(self.keyid_id, [self.value])
 
     ############################################################################
     def __str__(self):  # pragma: no cover
@@ -348,6 +390,261 @@ class Links(models.Model):
         ordering = ["hostid", "tag"]
 
 
+################################################################################
+################################################################################
+################################################################################
+class ApproxIndex(models.Model):
+    """Deletion neighbourhood index of the values of each key used for
+    approximate matching. Every distinct value of a key is stored against
+    each of the strings that can be made by deleting up to
+    HOSTINFO_APPROX_DISTANCE characters from it. Two values within that
+    edit distance of each other will share at least one of these variants.
+
+    Entries for values that no longer exist are harmless as candidates
+    are always checked against KeyValue.
+    """
+
+    keyid = models.ForeignKey(AllowedKey, on_delete=models.CASCADE)
+    variant = models.CharField(max_length=200)
+    value = models.CharField(max_length=200)
+
+    ############################################################################
+    @classmethod
+    def addValues(cls, keyid, values):
+        """Add values of the key to the index"""
+        distance = approxDistance()
+        entries = [
+            cls(keyid_id=keyid, variant=variant, value=value)
+            for value in set(values)
+            for variant in deletionVariants(value, distance)
+        ]
+        cls.objects.bulk_create(entries, ignore_conflicts=True, batch_size=1000)
+
+    ############################################################################
+    @classmethod
+    def removeValues(cls, keyid, values):
+        """Remove values of the key from the index if nothing has that
+        value any more"""
+        inuse = KeyValue.objects.filter(keyid=keyid, value__in=values).values_list(
+            "value", flat=True
+        )
+        unused = set(values) - set(inuse)
+        if unused:
+            cls.objects.filter(keyid=keyid, value__in=unused).delete()
+
+    ############################################################################
+    @classmethod
+    def rebuild(cls, keyid=None):
+        """Recreate the index from the KeyValues"""
+        kvs = KeyValue.objects.order_by()
+        index = cls.objects.all()
+        if keyid is not None:
+            kvs = kvs.filter(keyid=keyid)
+            index = index.filter(keyid=keyid)
+        index.delete()
+        values = defaultdict(set)
+        for kid, value in kvs.values_list("keyid", "value").distinct():
+            values[kid].add(value)
+        for kid, vals in values.items():
+            cls.addValues(kid, vals)
+
+    ############################################################################
+    class Meta:
+        unique_together = (("keyid", "variant", "value"),)
+
+
+################################################################################
+################################################################################
+################################################################################
+class Generation(models.Model):
+    """Generations kept in the database for things that every process has
+    to see change straight away, even if the Django cache isn't shared
+    between them. Each bump sets a new random value rather than counting
+    up so that a bump that is rolled back can't be mistaken for a later
+    one. Bumping locks the row until the transaction commits, so these are
+    only for things that rarely change.
+    """
+
+    name = models.CharField(max_length=100, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    ############################################################################
+    @classmethod
+    def current(cls, name):
+        """Return the generation, or None if it has never been bumped"""
+        return cls.objects.filter(name=name).values_list("value", flat=True).first()
+
+    ############################################################################
+    @classmethod
+    def currentValues(cls, *names):
+        """Return the generations of each of the names with one query"""
+        gens = dict(cls.objects.filter(name__in=names).values_list("name", "value"))
+        return tuple(gens.get(name) for name in names)
+
+    ############################################################################
+    @classmethod
+    def bump(cls, name):
+        """Give the generation a new value, creating it if need be"""
+        value = random.getrandbits(63)
+        if not cls.objects.filter(name=name).update(value=value):
+            cls.objects.update_or_create(name=name, defaults={"value": value})
+
+
+################################################################################
+################################################################################
+################################################################################
+class KeyStats(models.Model):
+    """How many hosts have each value of each key. This is kept up to date
+    as the KeyValues change so that reports on all of the hosts can read
+    the counts rather than counting every KeyValue of the key.
+
+    If it gets out of step with the KeyValues (e.g. they have been changed
+    directly in the database) ./manage.py rebuild_keystats fixes it.
+    """
+
+    keyid = models.ForeignKey(AllowedKey, on_delete=models.CASCADE)
+    value = models.CharField(max_length=200)
+    numvalue = models.FloatField(null=True)
+    uses = models.IntegerField(default=0)
+
+    ############################################################################
+    @classmethod
+    def adjust(cls, changes):
+        """Apply {(keyid, value): change in the number of uses} to the
+        counts. Counts that reach zero are removed.
+
+        Counts for values that are new to a key are created at zero before
+        all of the counts are incremented in the database, so that two
+        transactions adding the same new value can't lose either count."""
+        bydelta = defaultdict(lambda: defaultdict(list))
+        for (keyid, value), delta in changes.items():
+            if delta:
+                bydelta[delta][keyid].append(value)
+        for delta, keys in bydelta.items():
+            for keyid, values in keys.items():
+                for start in range(0, len(values), BATCH_CHUNK):
+                    chunk = values[start : start + BATCH_CHUNK]
+                    if delta > 0:
+                        new = [
+                            cls(
+                                keyid_id=keyid,
+                                value=value,
+                                numvalue=numericValue(value),
+                                uses=0,
+                            )
+                            for value in chunk
+                        ]
+                        cls.objects.bulk_create(new, ignore_conflicts=True)
+                    stats = cls.objects.filter(keyid=keyid, value__in=chunk)
+                    stats.update(uses=F("uses") + delta)
+                    if delta < 0:
+                        stats.filter(uses__lte=0).delete()
+
+    ############################################################################
+    @classmethod
+    def frequencies(cls, ak):
+        """The same as valueFrequencies(ak) but read from the counts"""
+        rows = cls.objects.filter(keyid=ak.id, uses__gt=0).values_list(
+            "value", "numvalue", "uses"
+        )
+        counts = {
+            (value, numvalue if ak.numericFlag else None): uses
+            for value, numvalue, uses in rows
+        }
+        if ak.get_validtype_display() == "list":
+            numhosts = cls.hostCounts([ak])[ak.id]
+        else:
+            numhosts = sum(counts.values())
+        return counts, numhosts
+
+    ############################################################################
+    @classmethod
+    def hostCounts(cls, keys):
+        """Return {keyid: number of hosts that have the key} for the
+        AllowedKeys in keys"""
+        counts = {ak.id: 0 for ak in keys}
+        single = [ak.id for ak in keys if ak.get_validtype_display() != "list"]
+        multi = [ak.id for ak in keys if ak.get_validtype_display() == "list"]
+        if single:
+            rows = (
+                cls.objects.filter(keyid__in=single)
+                .values_list("keyid")
+                .annotate(hosts=Sum("uses"))
+                .order_by()
+            )
+            counts.update(rows)
+        if multi:  # Hosts can have more than one value of a list key
+            rows = (
+                KeyValue.objects.filter(keyid__in=multi)
+                .values_list("keyid")
+                .annotate(hosts=Count("hostid", distinct=True))
+                .order_by()
+            )
+            counts.update(rows)
+        return counts
+
+    ############################################################################
+    @classmethod
+    def topValues(cls, keyids, top=10):
+        """Return {keyid: [(value, uses), ...]} of the top most used values
+        of each key"""
+        rank = Window(
+            RowNumber(),
+            partition_by=F("keyid"),
+            order_by=[F("uses").desc(), F("value").asc()],
+        )
+        rows = (
+            cls.objects.filter(keyid__in=keyids, uses__gt=0)
+            .annotate(rank=rank)
+            .filter(rank__lte=top)
+            .order_by("keyid", "rank")
+            .values_list("keyid", "value", "uses")
+        )
+        ans = defaultdict(list)
+        for keyid, value, uses in rows:
+            ans[keyid].append((value, uses))
+        return ans
+
+    ############################################################################
+    @classmethod
+    def rebuild(cls, keyid=None):
+        """Recount the values from the KeyValues"""
+        kvs = KeyValue.objects.order_by()
+        stats = cls.objects.all()
+        if keyid is not None:
+            kvs = kvs.filter(keyid=keyid)
+            stats = stats.filter(keyid=keyid)
+        with transaction.atomic():
+            stats.delete()
+            rows = kvs.values_list("keyid", "value").annotate(uses=Count("id"))
+            cls.objects.bulk_create(
+                [
+                    cls(
+                        keyid_id=kid,
+                        value=value,
+                        numvalue=numericValue(value),
+                        uses=uses,
+                    )
+                    for kid, value, uses in rows
+                ],
+                batch_size=1000,
+            )
+
+    ############################################################################
+    class Meta:
+        unique_together = (("keyid", "value"),)
+        indexes = [models.Index(fields=["keyid", "-uses"])]
+
+
+################################################################################
+def numericValue(value):
+    """The numvalue of a value - None if it isn't a number"""
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
 ############################################################################
 def validateDate(datestr):
     """Convert the various dates to a single format: YYYY-MM-DD"""
@@ -389,54 +686,80 @@ def validateDate(datestr):
 
 
 ################################################################################
-def parseQualifiers(args):
-    """
-    Go through the supplied qualifiers and analyse them, generate
-    a list of qualifier tuples: operator, key, value
-    """
+# Table of all the operators:
+#    tag of operator, regexp, threepart (ie. has value)?
+QUALIFIER_OPTABLE = [
+    ("unequal", r"!=|\.ne\.", {"threeparts": True}),
+    ("equal", r"=|\.eq\.", {"threeparts": True}),  # Has to be after !=
+    ("lessthan", r"<|\.lt\.", {"threeparts": True}),
+    ("greaterthan", r">|\.gt\.", {"threeparts": True}),
+    ("contains", r"~|\.ss\.", {"threeparts": True}),
+    ("notcontains", r"%|\.ns\.", {"threeparts": True}),
+    ("approx", r"@|\.ap\.", {"threeparts": True}),
+    ("undef", r"\.undef|\.undefined|\.unset", {"threeparts": False}),
+    ("def", r"\.def|\.defined|\.set", {"threeparts": False}),
+    ("hostre", r"\.hostre", {"threeparts": False, "validkey": False}),
+    ("lenlt", r"\.lenlt\.", {"threeparts": True}),
+    ("leneq", r"\.leneq\.", {"threeparts": True}),
+    ("lengt", r"\.lengt\.", {"threeparts": True}),
+]
+
+# The operators are tried in the order of the table, each regexp finding
+# the last occurrence of its operator in the argument
+QUALIFIER_PATTERNS = [
+    (
+        op,
+        re.compile(
+            "(?P<key>.+)(%s)(?P<val>%s)" % (reg, ".+" if opts["threeparts"] else "")
+        ),
+        opts,
+    )
+    for op, reg, opts in QUALIFIER_OPTABLE
+]
 
-    # Table of all the operators:
-    #    tag of operator, regexp, threepart (ie. has value)?
-    optable = [
-        ("unequal", r"!=|\.ne\.", {"threeparts": True}),
-        ("equal", r"=|\.eq\.", {"threeparts": True}),  # Has to be after !=
-        ("lessthan", r"<|\.lt\.", {"threeparts": True}),
-        ("greaterthan", r">|\.gt\.", {"threeparts": True}),
-        ("contains", r"~|\.ss\.", {"threeparts": True}),
-        ("notcontains", r"%|\.ns\.", {"threeparts": True}),
-        ("approx", r"@|\.ap\.", {"threeparts": True}),
-        ("undef", r"\.undef|\.undefined|\.unset", {"threeparts": False}),
-        ("def", r"\.def|\.defined|\.set", {"threeparts": False}),
-        ("hostre", r"\.hostre", {"threeparts": False, "validkey": False}),
-        ("lenlt", r"\.lenlt\.", {"threeparts": True}),
-        ("leneq", r"\.leneq\.", {"threeparts": True}),
-        ("lengt", r"\.lengt\.", {"threeparts": True}),
-    ]
+# Anything without any of the operators in it is a hostname
+OPERATOR_RE = re.compile("|".join(reg for _, reg, _ in QUALIFIER_OPTABLE))
 
+# Number of distinct criteria to remember the parsed qualifiers for
+QUALIFIER_CACHE_SIZE = 1000
+
+
+################################################################################
+def knownHostnames(args):
+    """Return which of the arguments are the names or aliases of hosts
+    in a single query"""
+    names = set(arg.lower() for arg in args)
+    hosts = Host.objects.filter(hostname__in=names).order_by()
+    aliases = HostAlias.objects.filter(alias__in=names).order_by()
+    return set(
+        hosts.values_list("hostname", flat=True).union(
+            aliases.values_list("alias", flat=True)
+        )
+    )
+
+
+################################################################################
+def compileQualifiers(args):
+    """Convert the arguments into qualifiers - see parseQualifiers"""
+    # Check to make sure that the qualifier isn't actually a host with an
+    # embedded operator like subdomain - e.g. host.lt.example.com
+    hostnames = knownHostnames(args)
     qualifiers = []
     for arg in args:
-        if arg == "":
-            continue
-        matched = False
-        # Check to make sure that the qualifier isn't actually a host with an
-        # embedded operator like subdomain - e.g. host.lt.example.com
-        ishostname = Host.objects.filter(hostname=arg.lower())
-        if ishostname:
+        if arg.lower() in hostnames:
             qualifiers.append(("host", None, arg.lower()))
-            matched = True
             continue
-        for op, reg, opts in optable:
-            if opts["threeparts"]:
-                mo = re.match("(?P<key>.+)(%s)(?P<val>.+)" % reg, arg)
-            else:
-                mo = re.match("(?P<key>.+)(%s)(?P<val>)" % reg, arg)
-            if mo:
+        matched = False
+        if OPERATOR_RE.search(arg):
+            for op, pattern, opts in QUALIFIER_PATTERNS:
+                mo = pattern.match(arg)
+                if not mo:
+                    continue
                 key = mo.group("key").lower()
-                if opts.get("validkey", True):
-                    getAK(key)
                 val = mo.group("val").lower()
-                if opts["threeparts"]:
-                    if getAK(key).get_validtype_display() == "date":
+                if opts.get("validkey", True):
+                    ak = getAK(key)
+                    if opts["threeparts"] and ak.get_validtype_display() == "date":
                         val = validateDate(val)
                 qualifiers.append((op, key, val))
                 matched = True
@@ -454,38 +777,100 @@ def parseQualifiers(args):
     return qualifiers
 
 
+################################################################################
+@lru_cache(maxsize=QUALIFIER_CACHE_SIZE)
+def cachedQualifiers(args, hostgen, aliasgen, akgen, today):
+    """Remember the parsed qualifiers. The database generations are part
+    of the key so that changes to hosts, aliases or keys made by any process
+    get the arguments parsed again, and so is the date so that "today"
+    doesn't stay the day it was first parsed"""
+    # pylint: disable=unused-argument
+    return tuple(compileQualifiers(args))
+
+
+################################################################################
+def parseQualifiers(args):
+    """
+    Go through the supplied qualifiers and analyse them, generate
+    a list of qualifier tuples: operator, key, value
+    """
+    args = tuple(arg for arg in args if arg != "")
+    if not args:
+        return []
+    hostgen, aliasgen, akgen = Generation.currentValues(
+        HOST_GENERATION, ALIAS_GENERATION, AK_GENERATION
+    )
+    if hostgen is None or aliasgen is None or akgen is None:
+        return compileQualifiers(args)
+    today = validateDate("today")
+    return list(cachedQualifiers(args, hostgen, aliasgen, akgen, today))
+
+
+################################################################################
+def valueFrequencies(key, hostids=None):
+    """Count the values of a key with the database's GROUP BY, for the
+    hosts in hostids or all hosts if it is None. Return a dict of
+    {(value, numvalue): number of times it is used} and the number of
+    hosts that have the key. numvalue is None unless the key is numeric.
+
+    The counts for all hosts come from KeyStats. When most of the hosts
+    are wanted the values of the rest are counted and taken away from
+    those, so at most half of the hosts are ever sent to the database."""
+    ak = getAK(key)
+    fields = ["value", "numvalue"] if ak.numericFlag else ["value"]
+    kvs = KeyValue.objects.filter(keyid=ak.id)
+    if hostids is None:
+        return KeyStats.frequencies(ak)
+
+    wanted = set(hostids)
+    allids = getHostIndex().ids
+    if len(wanted) > len(allids) // 2:
+        counts, numhosts = KeyStats.frequencies(ak)
+        chunkids = [hostid for hostid in allids if hostid not in wanted]
+        sign = -1
+    else:
+        counts, numhosts = {}, 0
+        chunkids = sorted(wanted)
+        sign = 1
+    counts = defaultdict(int, counts)
+    for start in range(0, len(chunkids), BATCH_CHUNK):
+        chunk = kvs.filter(hostid__in=chunkids[start : start + BATCH_CHUNK])
+        chunkcounts, chunkhosts = groupValues(chunk, fields)
+        for val, uses in chunkcounts.items():
+            counts[val] += sign * uses
+        numhosts += sign * chunkhosts
+    return {val: uses for val, uses in counts.items() if uses}, numhosts
+
+
+################################################################################
+def groupValues(kvs, fields):
+    """Return {(value, numvalue): uses} and the number of hosts of the
+    KeyValues in the queryset"""
+    rows = kvs.values(*fields).annotate(uses=Count("id")).order_by()
+    counts = {(row["value"], row.get("numvalue")): row["uses"] for row in rows}
+    numhosts = kvs.aggregate(hosts=Count("hostid", distinct=True))["hosts"]
+    return counts, numhosts
+
+
 ################################################################################
 def calcKeylistVals(key, from_hostids=[]):
+    """Return the report of the values that key has on the hosts in
+    from_hostids (or all hosts if it is empty)"""
     keyid = getAK(key)
-    kvlist = KeyValue.objects.filter(keyid__key=key).values_list(
-        "hostid", "value", "numvalue"
-    )
-    if not from_hostids:
-        from_hostids = [v[0] for v in get_all_hosts().values_list("id")]
-    total = len(from_hostids)
-
-    # Calculate the number of times each value occurs
-    values = defaultdict(int)
-    hostids = set()
-    for hostid, value, numvalue in kvlist:
-        if hostid not in from_hostids:
-            continue
-        hostids.add(hostid)
-        if keyid.numericFlag:
-            values[(value, numvalue)] += 1
-        else:
-            values[(value, None)] += 1
-    numdef = len(hostids)
+    if from_hostids:
+        total = len(from_hostids)
+        values, numdef = valueFrequencies(keyid, from_hostids)
+    else:
+        total = len(getHostIndex().ids)
+        values, numdef = valueFrequencies(keyid)
 
     # Calculate for each distinct value the percentages
     tmpvalues = []
-    for k, v in list(values.items()):
-        p = 100.0 * v / numdef
-        tmpvalues.append((k[0], k[1], v, p))
-        # (strval, numval), count, pct
+    for (value, numvalue), count in values.items():
+        tmpvalues.append((value, numvalue, count, 100.0 * count / numdef))
 
     if keyid.numericFlag:
-        tv = sorted(tmpvalues, key=itemgetter(1, 0))
+        tv = sorted(tmpvalues, key=lambda v: (v[1] is None, v[1] or 0, v[0]))
     else:
         tv = sorted(tmpvalues, key=itemgetter(0))
     numundef = total - numdef
@@ -496,192 +881,648 @@ def calcKeylistVals(key, from_hostids=[]):
         "vallist": [(val, count, pct) for [val, numval, count, pct] in tv],
         "numvals": len(tmpvalues),
         "numdef": numdef,
-        "pctdef": 100.0 * numdef / total,
+        "pctdef": 100.0 * numdef / total if total else 0.0,
         "numundef": numundef,
-        "pctundef": 100.0 * numundef / total,
+        "pctundef": 100.0 * numundef / total if total else 0.0,
         "total": total,
     }
     return d
 
 
 ################################################################################
-def oneoff(val):
-    """Copied from norvig.com/spell-correct.html
-    A page of true awesomeness
-    """
-    import string
+def approxDistance():
+    """How many edits away a value can be and still be approximately
+    equal"""
+    return getattr(settings, "HOSTINFO_APPROX_DISTANCE", 1)
+
+
+################################################################################
+def deletionVariants(val, distance=1):
+    """Return all the strings that can be made by deleting up to distance
+    characters from val (including val itself)"""
+    variants = {val}
+    current = {val}
+    for _ in range(distance):
+        current = {v[:i] + v[i + 1 :] for v in current for i in range(len(v))}
+        variants |= current
+    return variants
+
 
-    alphabet = string.ascii_lowercase + string.digits
-    s = [(val[:i], val[i:]) for i in range(len(val) + 1)]
-    deletes = [a + b[1:] for a, b in s if b]
-    transposes = [a + b[1] + b[0] + b[2:] for a, b in s if len(b) > 1]
-    replaces = [a + c + b[1:] for a, b in s for c in alphabet if b]
-    inserts = [a + c + b for a, b in s for c in alphabet]
-    return set(deletes + transposes + replaces + inserts)
+################################################################################
+def editDistance(src, dst, maxdist=1):
+    """Optimal string alignment distance between src and dst - the number
+    of deletes, inserts, replaces and transposes needed to convert one to
+    the other. Gives up and returns maxdist + 1 once it is going to be
+    bigger than maxdist"""
+    if abs(len(src) - len(dst)) > maxdist:
+        return maxdist + 1
+    prevprev = None
+    prev = list(range(len(dst) + 1))
+    for i, sc in enumerate(src, 1):
+        row = [i] + [0] * len(dst)
+        for j, dc in enumerate(dst, 1):
+            cost = 0 if sc == dc else 1
+            row[j] = min(prev[j] + 1, row[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and sc == dst[j - 2] and src[i - 2] == dc:
+                row[j] = min(row[j], prevprev[j - 2] + 1)
+        # Transposes can skip a row so both have to be too big
+        if min(row) > maxdist and min(prev) > maxdist:
+            return maxdist + 1
+        prevprev, prev = prev, row
+    return prev[-1]
 
 
 ################################################################################
-def getApproxObjects(keyid, value):
+def getApproxObjects(keyid, value, hostids=None):
     """Return all of the hostids that have a value that is approximately
-    value
+    value. If hostids (a queryset of Host ids) is supplied then only
+    look at those hosts
+
+    Candidate values come from the ApproxIndex so we don't have to look at
+    every value the key has
     """
-    vals = KeyValue.objects.filter(keyid=keyid)
-    approxans = set()
-    approx = oneoff(value)
-    for v in vals:
-        if v.value in approx:
-            approxans.add(v)
-    ans = [{"hostid": v.hostid.id} for v in approxans]
-    return ans
+    distance = approxDistance()
+    candidates = ApproxIndex.objects.filter(
+        keyid=keyid, variant__in=deletionVariants(value, distance)
+    ).values_list("value", flat=True)
+    approx = [
+        v for v in set(candidates) if editDistance(value, v, distance) <= distance
+    ]
+    if not approx:
+        return []
+    vals = KeyValue.objects.filter(keyid=keyid, value__in=approx)
+    if hostids is not None:
+        vals = vals.filter(hostid__in=hostids)
+    return [{"hostid": hostid} for hostid in vals.values_list("hostid", flat=True)]
+
+
+################################################################################
+class HostIndex(object):
+    """Compact in memory copy of the ids and names of all the hosts
+
+    The ids are kept sorted in an array and the hostnames are stored
+    back to back in a single bytes object with an array of offsets into
+    it, so each host costs the length of its name plus 12 bytes.
+    E.g. about 3.8Mb for 100,000 hosts and 38Mb for 1,000,000 hosts
+    with 26 character hostnames.
+    """
+
+    ############################################################################
+    def __init__(self, rows=()):
+        """rows is an iterable of (id, hostname) sorted by id"""
+        self.ids = array("q")
+        self.offsets = array("I", [0])
+        names = bytearray()
+        for hostid, hostname in rows:
+            self.ids.append(hostid)
+            names.extend(hostname.encode("utf-8"))
+            self.offsets.append(len(names))
+        self.names = bytes(names)
+        self.generation = None
+
+    ############################################################################
+    @classmethod
+    def load(cls):
+        """Create the index from the database"""
+        rows = (
+            Host.objects.order_by("id")
+            .values_list("id", "hostname")
+            .iterator(chunk_size=10000)
+        )
+        return cls(rows)
+
+    ############################################################################
+    def __len__(self):
+        return len(self.ids)
+
+    ############################################################################
+    def _position(self, hostid):
+        pos = bisect_left(self.ids, hostid)
+        if pos < len(self.ids) and self.ids[pos] == hostid:
+            return pos
+        return None
+
+    ############################################################################
+    def __contains__(self, hostid):
+        return self._position(hostid) is not None
+
+    ############################################################################
+    def hostname(self, hostid):
+        """Return the hostname of the host or None if it isn't known"""
+        pos = self._position(hostid)
+        if pos is None:
+            return None
+        return self.names[self.offsets[pos] : self.offsets[pos + 1]].decode("utf-8")
+
+    ############################################################################
+    def nbytes(self):
+        """Approximate memory used by the index"""
+        return (
+            self.ids.itemsize * len(self.ids)
+            + self.offsets.itemsize * len(self.offsets)
+            + len(self.names)
+        )
 
 
 ################################################################################
-def get_all_hosts():
-    global _all_hosts
-    global _all_hosts_cache_time
-    if _all_hosts is None or _all_hosts_cache_time < time.time() - 60:
-        _all_hosts = Host.objects.all()
-        _all_hosts_cache_time = time.time()
-    return _all_hosts
+def getHostIndex():
+    """Return the index of all hosts, reloading it if any host has been
+    created, renamed or deleted since it was loaded. The generation is
+    read from the database as changes made by other processes may not
+    show up in our cache."""
+    global _hostindex
+    gen = Generation.current(HOST_GENERATION)
+    if _hostindex is None or gen is None or _hostindex.generation != gen:
+        _hostindex = HostIndex.load()
+        _hostindex.generation = gen
+    return _hostindex
 
 
 ################################################################################
-def getHostList(criteria):
-    allhosts = {}
-    for host in get_all_hosts():
-        allhosts[host.id] = host
+@receiver(post_save, sender=Host)
+@receiver(post_delete, sender=Host)
+def hostChanged(sender, **kwargs):  # pylint: disable=unused-argument
+    """Invalidate the host index"""
+    Generation.bump(HOST_GENERATION)
+    bumpGeneration(HOST_GENERATION)
+
+
+################################################################################
+@receiver([post_save, post_delete], sender=HostAlias)
+def aliasChanged(sender, **kwargs):  # pylint: disable=unused-argument
+    """Invalidate cached host queries"""
+    Generation.bump(ALIAS_GENERATION)
+    bumpGeneration(ALIAS_GENERATION)
+
 
+################################################################################
+def getHostList(criteria):
+    """Return the Host objects that match the criteria. Only the id and
+    hostname are loaded (from the host index), the other fields are loaded
+    from the database if they are used"""
     qualifiers = parseQualifiers(criteria)
     hostids = getMatches(qualifiers)
-    hosts = [allhosts[hid] for hid in hostids]
+    index = getHostIndex()
+    hosts = []
+    missing = []
+    for hostid in hostids:
+        hostname = index.hostname(hostid)
+        if hostname is None:  # Created since the index was loaded
+            missing.append(hostid)
+        else:
+            hosts.append(Host.from_db(None, ["id", "hostname"], [hostid, hostname]))
+    if missing:
+        hosts.extend(Host.objects.filter(id__in=missing))
     return hosts
 
 
+################################################################################
+class ValueIndex(object):
+    """Optional in memory inverted index of keyid -> value -> hostids
+
+    The hostids for each value are kept as a sorted array of unsigned ints
+    so equal, unequal, def, undef, contains and notcontains qualifiers can
+    be answered with set operations rather than a trip to the database.
+
+    Each key has its own generation counter in the Django cache. Changes
+    made by this process are applied to the index as they are committed;
+    a change made anywhere else bumps the generation and the key is
+    reloaded. Keys are only loaded into a process from the postings that
+    the warm_value_index command (or a reload) has put into the cache, so
+    a key that has never been warmed, or that doesn't fit into the memory
+    budget, is left to the database.
+    """
+
+    ############################################################################
+    def __init__(self, budget):
+        self.budget = budget
+        self.keys = {}  # keyid: [generation, {value: hostids}, nbytes]
+        self.nbytes = 0
+
+    ############################################################################
+    @staticmethod
+    def build(keyid):
+        """Read the postings for a key from the database"""
+        postings = {}
+        rows = (
+            KeyValue.objects.filter(keyid=keyid)
+            .order_by("value", "hostid")
+            .values_list("value", "hostid")
+            .iterator(chunk_size=10000)
+        )
+        for value, hostid in rows:
+            if value not in postings:
+                postings[value] = array("I")
+            postings[value].append(hostid)
+        return postings
+
+    ############################################################################
+    @staticmethod
+    def postingsSize(postings):
+        """Approximate memory used by the postings of a key"""
+        return sum(
+            sys.getsizeof(val) + hostids.itemsize * len(hostids) + 64
+            for val, hostids in postings.items()
+        )
+
+    ############################################################################
+    @classmethod
+    def publish(cls, keyid):
+        """Build the postings for a key and share them through the cache.
+        Returns the postings and the generation they are valid for."""
+        # Read the generation first so that a change that commits while we
+        # are building can only make the postings look out of date
+        gen = getGeneration(VALUE_GENERATION % keyid)
+        postings = cls.build(keyid)
+        if gen is not None:
+            cache.set(
+                VALUE_POSTINGS % (keyid, gen),
+                {val: hostids.tobytes() for val, hostids in postings.items()},
+                timeout=AK_METADATA_TIMEOUT,
+            )
+        return postings, gen
+
+    ############################################################################
+    def drop(self, keyid):
+        entry = self.keys.pop(keyid, None)
+        if entry:
+            self.nbytes -= entry[2]
+
+    ############################################################################
+    def postings(self, keyid):
+        """Return {value: hostids} for a key, or None if the key isn't in
+        the index and the database will have to be asked instead"""
+        gen = getGeneration(VALUE_GENERATION % keyid)
+        if gen is None:
+            return None
+        entry = self.keys.get(keyid)
+        if entry and entry[0] == gen:
+            return entry[1]
+        stale = entry is not None
+        self.drop(keyid)
+        shared = cache.get(VALUE_POSTINGS % (keyid, gen))
+        if shared is not None:
+            postings = {}
+            for val, data in shared.items():
+                postings[val] = array("I")
+                postings[val].frombytes(data)
+        elif stale:  # Was in use before it changed, so reload it
+            postings, gen = self.publish(keyid)
+        else:
+            return None
+        size = self.postingsSize(postings)
+        if gen is None or self.nbytes + size > self.budget:
+            return None
+        self.keys[keyid] = [gen, postings, size]
+        self.nbytes += size
+        return postings
+
+    ############################################################################
+    def hostids(self, qual, key, value):
+        """Return (mode, hostids) for a qualifier, where mode is the same
+        as for qualifierCondition(), or None if the index can't answer it"""
+        if qual not in ("equal", "unequal", "contains", "notcontains", "def", "undef"):
+            return None
+        ak = getAK(key)
+        if qual in ("equal", "unequal") and isNumericQualifier(ak, value):
+            return None
+        postings = self.postings(ak.id)
+        if postings is None:
+            return None
+        if qual in ("equal", "unequal"):
+            lists = [postings.get(value, ())]
+        elif qual in ("contains", "notcontains"):
+            lists = [hostids for val, hostids in postings.items() if value in val]
+        else:
+            lists = postings.values()
+        hostids = set()
+        for hlist in lists:
+            hostids.update(hlist)
+        if qual in ("unequal", "notcontains", "undef"):
+            return "difference", hostids
+        return "intersection", hostids
+
+    ############################################################################
+    def changed(self, keyid, hostid, added=None, removed=None):
+        """Record that a value has been added to or removed from a host.
+        Nothing happens until the transaction commits."""
+        name = VALUE_GENERATION % keyid
+
+        def apply():
+            oldgen = cache.get(name)
+            newgen = incrGeneration(name)
+            entry = self.keys.get(keyid)
+            if entry is None:
+                return
+            # If anyone else has changed the key we have to reload it
+            if oldgen is None or entry[0] != oldgen or newgen != oldgen + 1:
+                self.drop(keyid)
+                return
+            postings = entry[1]
+            if removed is not None and removed in postings:
+                hostids = postings[removed]
+                pos = bisect_left(hostids, hostid)
+                if pos < len(hostids) and hostids[pos] == hostid:
+                    del hostids[pos]
+                if not hostids:
+                    del postings[removed]
+            if added is not None:
+                hostids = postings.setdefault(added, array("I"))
+                pos = bisect_left(hostids, hostid)
+                if pos == len(hostids) or hostids[pos] != hostid:
+                    hostids.insert(pos, hostid)
+            entry[0] = newgen
+
+        transaction.on_commit(apply)
+
+    ############################################################################
+    def invalidate(self, keyids):
+        """Record that the keys have been changed in bulk. Keys that are in
+        use will be reloaded once the transaction commits."""
+
+        def bump():
+            for keyid in keyids:
+                incrGeneration(VALUE_GENERATION % keyid)
+
+        transaction.on_commit(bump)
+
+
+################################################################################
+def getValueIndex():
+    """Return the in memory value index or None if it isn't enabled by
+    setting HOSTINFO_VALUE_INDEX_MEMORY to the number of bytes it may use"""
+    global _valueindex
+    budget = getattr(settings, "HOSTINFO_VALUE_INDEX_MEMORY", 0)
+    if not budget:
+        return None
+    if _valueindex is None or _valueindex.budget != budget:
+        _valueindex = ValueIndex(budget)
+    return _valueindex
+
+
+################################################################################
+@receiver(post_save, sender=KeyValue)
+@receiver(post_delete, sender=KeyValue)
+def keyValueChanged(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """Invalidate cached queries on the key and keep the value index up
+    to date"""
+    bumpGeneration(KEY_GENERATION % instance.keyid_id)
+    index = getValueIndex()
+    if index is None:
+        return
+    if kwargs["signal"] is post_delete:
+        index.changed(instance.keyid_id, instance.hostid_id, removed=instance.value)
+        return
+    previous = getattr(instance, "_previous_value", None)
+    if previous == instance.value:
+        previous = None
+    index.changed(
+        instance.keyid_id, instance.hostid_id, added=instance.value, removed=previous
+    )
+
+
+################################################################################
+@receiver(post_save, sender=KeyValue)
+@receiver(post_delete, sender=KeyValue)
+def keyStatsChanged(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """Keep the KeyStats counts up to date"""
+    changes = defaultdict(int)
+    if kwargs["signal"] is post_delete:
+        changes[(instance.keyid_id, instance.value)] -= 1
+    elif kwargs.get("created"):
+        changes[(instance.keyid_id, instance.value)] += 1
+    else:
+        previous = getattr(instance, "_previous_value", None)
+        if previous is not None and previous != instance.value:
+            changes[(instance.keyid_id, instance.value)] += 1
+            changes[(instance.keyid_id, previous)] -= 1
+    KeyStats.adjust(changes)
+
+
+################################################################################
+def isNumericQualifier(key, value):
+    """Numeric keys can be queried for non-numeric values, so only
+    compare numerically if the value looks like a number"""
+    if not key or not key.numericFlag:
+        return False
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+################################################################################
+def qualifierCondition(qual, key, value):
+    """Convert a single qualifier into a condition on the Host table
+
+    Returns a tuple of (mode, condition) where mode is one of:
+        intersection - hosts must satisfy the condition
+        difference - hosts must not satisfy the condition
+        python - has to be evaluated outside the database (condition is None)
+        noop - handled in post processing (condition is None)
+    """
+    if qual == "host":
+        aliases = HostAlias.objects.filter(hostid=OuterRef("pk"), alias=value)
+        return "intersection", Q(hostname=value) | Q(Exists(aliases))
+    if qual == "hostre":  # hostre doesn't put a key into key
+        aliases = HostAlias.objects.filter(hostid=OuterRef("pk"), alias__contains=key)
+        return "intersection", Q(hostname__contains=key) | Q(Exists(aliases))
+    if qual in ("leneq", "lengt", "lenlt"):
+        return "noop", None
+    if qual == "approx":
+        return "python", None
+
+    ak = getAK(key)
+    checknum = isNumericQualifier(ak, value)
+    field = "numvalue" if checknum else "value"
+    filters = {
+        "equal": {field: value},
+        "unequal": {field: value},
+        "lessthan": {f"{field}__lt": value},
+        "greaterthan": {f"{field}__gt": value},
+        "contains": {"value__contains": value},
+        "notcontains": {"value__contains": value},
+        "def": {},
+        "undef": {},
+    }
+    if qual not in filters:
+        raise HostinfoInternalException(msg=f"Unknown qualifier {qual}")
+    kvs = KeyValue.objects.filter(hostid=OuterRef("pk"), keyid=ak.id, **filters[qual])
+    if qual in ("unequal", "notcontains", "undef"):
+        return "difference", Exists(kvs)
+    return "intersection", Exists(kvs)
+
+
+################################################################################
+def lengthMatches(qual, key, value, hostids, hostqs):
+    """Return the members of hostids that have the right number of values
+    for a key. The number of values per host is calculated in a single
+    grouped query over hostqs (a queryset of the Host ids still in
+    contention, or None for all hosts) rather than one query per host.
+
+    Hosts without the key set have a length of zero.
+    """
+    try:
+        lngth = int(value)
+    except ValueError:
+        raise HostinfoException("Length must be an integer, not %s" % str(value))
+    kvs = KeyValue.objects.filter(keyid=getAK(key).id)
+    if hostqs is not None:
+        kvs = kvs.filter(hostid__in=hostqs)
+    counts = dict(
+        kvs.order_by()
+        .values("hostid")
+        .annotate(num=Count("id"))
+        .values_list("hostid", "num")
+    )
+    if qual == "leneq":
+        return set(h for h in hostids if counts.get(h, 0) == lngth)
+    if qual == "lengt":
+        return set(h for h in hostids if counts.get(h, 0) >= lngth)
+    return set(h for h in hostids if counts.get(h, 0) <= lngth)
+
+
 ################################################################################
 def getMatches(qualifiers):
     """Get a list of matching hostids that satisfy the qualifiers
 
-    Create a set of all the hostids and then go through each qualifier
-    and create a set of hostids that match that qualifier and then
-    take the intersection of those sets to get the hosts that match
-    the qualifier.
+    If HOSTINFO_QUERY_CACHE_TIMEOUT is set the answer is cached against
+    the generations of everything that it depends on, so a change to a
+    key only invalidates the queries that use that key.
+    """
+    timeout = getattr(settings, "HOSTINFO_QUERY_CACHE_TIMEOUT", 0)
+    if not timeout or _querycache_bypass.get():
+        return calcMatches(qualifiers)
+    tags = queryCacheTags(qualifiers)
+    gens = [getGeneration(tag) for tag in tags]
+    if None in gens:
+        return calcMatches(qualifiers)
+    criteria = repr((sorted(set(qualifiers)), tags, gens))
+    name = QUERY_CACHE % hashlib.sha1(criteria.encode("utf-8")).hexdigest()
+    hostids = cache.get(name)
+    if hostids is not None:
+        countQueryCache("hits")
+        return list(hostids)
+    countQueryCache("misses")
+    hostids = calcMatches(qualifiers)
+    cache.set(name, hostids, timeout=timeout)
+    return hostids
+
+
+################################################################################
+def queryCacheTags(qualifiers):
+    """Return the names of the generation counters that the result of
+    a query depends on"""
+    tags = {AK_GENERATION}
+    if not qualifiers:
+        tags.add(HOST_GENERATION)
+    for q, k, v in qualifiers:
+        if q in ("host", "hostre"):
+            tags.update((HOST_GENERATION, ALIAS_GENERATION))
+            continue
+        tags.add(KEY_GENERATION % getAK(k).id)
+        # These can match hosts that don't have the key at all
+        if q in ("unequal", "notcontains", "undef", "leneq", "lengt", "lenlt"):
+            tags.add(HOST_GENERATION)
+    return sorted(tags)
+
+
+################################################################################
+def countQueryCache(stat):
+    """Count the hits and misses of the query cache"""
+    name = QUERY_CACHE_STATS % stat
+    try:
+        cache.incr(name)
+    except ValueError:
+        cache.add(name, 1, timeout=None)
+
+
+################################################################################
+def queryCacheStats():
+    """Return the hits and misses of the query cache"""
+    return {stat: cache.get(QUERY_CACHE_STATS % stat, 0) for stat in ("hits", "misses")}
+
+
+################################################################################
+def resetQueryCacheStats():
+    """Start counting the hits and misses again"""
+    cache.delete_many([QUERY_CACHE_STATS % stat for stat in ("hits", "misses")])
+
+
+################################################################################
+@contextmanager
+def bypassQueryCache():
+    """Don't use the query cache for anything done in this context"""
+    token = _querycache_bypass.set(True)
+    try:
+        yield
+    finally:
+        _querycache_bypass.reset(token)
+
 
-    Unequal queries are handled a bit differently by taking the
-    difference between all hosts and the hosts that have that value set.
+################################################################################
+def calcMatches(qualifiers):
+    """Work out the list of hostids that satisfy the qualifiers
+
+    Qualifiers that the value index can answer are done in memory. The
+    rest are each converted into an EXISTS (or NOT EXISTS) condition
+    on the Host table and they are all combined into a single SQL query.
+
+    Approximate qualifiers can't be done in the database so they are
+    evaluated afterwards against the hosts that survived the database
+    query, as are the length qualifiers which need a count per host.
     """
-    hostids = set([host.id for host in get_all_hosts()])
-    for q, k, v in qualifiers:  # qualifier, key, value
-        if q != "hostre":  # hostre doesn't put a key into key
-            key = getAK(k)
-            checknum = False
-            # Numeric keys can be queried for non-numeric values
-            if key and key.numericFlag:
-                try:
-                    float(v)
-                    checknum = True
-                except ValueError:
-                    pass
-        mode = "intersection"
-        queryset = set([])  # Else if no match it won't have a queryset defined
-        if q == "host":
-            hostqs = set([h.id for h in Host.objects.filter(hostname=v)])
-            aliasqs = set([ha.hostid.id for ha in HostAlias.objects.filter(alias=v)])
-            queryset = hostqs | aliasqs
-            vals = []
-        elif q == "equal":
-            if checknum:
-                vals = KeyValue.objects.filter(keyid=key.id, numvalue=v).values(
-                    "hostid"
-                )
-            else:
-                vals = KeyValue.objects.filter(keyid=key.id, value=v).values("hostid")
-        elif q == "lessthan":
-            if checknum:
-                vals = KeyValue.objects.filter(keyid=key.id, numvalue__lt=v).values(
-                    "hostid"
-                )
-            else:
-                vals = KeyValue.objects.filter(keyid=key.id, value__lt=v).values(
-                    "hostid"
-                )
-        elif q == "approx":
-            vals = getApproxObjects(keyid=key.id, value=v)
-        elif q == "greaterthan":
-            if checknum:
-                vals = KeyValue.objects.filter(keyid=key.id, numvalue__gt=v).values(
-                    "hostid"
-                )
-            else:
-                vals = KeyValue.objects.filter(keyid=key.id, value__gt=v).values(
-                    "hostid"
-                )
-        elif q == "contains":
-            vals = KeyValue.objects.filter(keyid=key.id, value__contains=v).values(
-                "hostid"
-            )
-        elif q == "notcontains":
-            vals = KeyValue.objects.filter(keyid=key.id, value__contains=v).values(
-                "hostid"
-            )
-            mode = "difference"
-        elif q == "def":
-            vals = KeyValue.objects.filter(keyid=key.id).values("hostid")
-        elif q == "unequal":
-            if checknum:
-                vals = KeyValue.objects.filter(keyid=key.id, numvalue=v).values(
-                    "hostid"
-                )
-            else:
-                vals = KeyValue.objects.filter(keyid=key.id, value=v).values("hostid")
-            mode = "difference"
-        elif q == "undef":
-            vals = KeyValue.objects.filter(keyid=key.id).values("hostid")
-            mode = "difference"
-        if q in ("leneq", "lengt", "lenlt"):
-            vals = []
-            mode = "noop"
-        elif q == "hostre":
-            vals = [
-                {"hostid": h["id"]}
-                for h in Host.objects.filter(hostname__contains=k).values("id")
-            ]
-            alias = [
-                {"hostid": h["hostid"]}
-                for h in HostAlias.objects.filter(alias__contains=k).values("hostid")
-            ]
-            vals.extend(alias)
-
-        if vals:
-            queryset = set([e["hostid"] for e in vals])
+    index = getValueIndex()
+    indexed = []
+    sqlquals = []
+    for q, k, v in qualifiers:
+        found = index.hostids(q, k, v) if index else None
+        if found is None:
+            sqlquals.append((q, k, v))
+        else:
+            indexed.append(found)
+
+    hosts = Host.objects.order_by()
+    hostqs = None  # Only restrict to hosts if the database has been asked
+    pyquals = []
+    for q, k, v in sqlquals:
+        mode, cond = qualifierCondition(q, k, v)
         if mode == "intersection":
-            hostids = hostids & queryset
+            hosts = hosts.filter(cond)
         elif mode == "difference":
-            hostids = hostids - queryset
-        elif mode == "noop":
-            pass
+            hosts = hosts.exclude(cond)
+        elif mode == "python":
+            pyquals.append((q, k, v))
+            continue
+        else:
+            continue
+        hostqs = hosts.values("id")
+
+    hostids = None  # None means every host
+    for mode, found in sorted(indexed, key=lambda x: len(x[1])):
+        if mode == "intersection":
+            hostids = found if hostids is None else hostids & found
+    if pyquals:
+        for q, k, v in pyquals:
+            if hostids is not None and not hostids:
+                break
+            approx = getApproxObjects(keyid=getAK(k).id, value=v, hostids=hostqs)
+            approxids = set(e["hostid"] for e in approx)
+            hostids = approxids if hostids is None else hostids & approxids
+    elif hostqs is not None and (hostids is None or hostids):
+        dbids = set(hosts.values_list("id", flat=True))
+        hostids = dbids if hostids is None else hostids & dbids
+    if hostids is None:  # Every host
+        hostids = set(getHostIndex().ids)
+    for mode, found in indexed:
+        if mode == "difference":
+            hostids -= found
 
     # Some queries require post processing
-    # Note that these are much slower to process so do them after
     for q, k, v in qualifiers:  # qualifier, key, value
         if q in ("leneq", "lengt", "lenlt"):
-            key = getAK(k)
-            try:
-                lngth = int(v)
-            except ValueError:
-                raise HostinfoException("Length must be an integer, not %s" % str(v))
-            for h in get_all_hosts():
-                if h.id not in hostids:
-                    continue
-                vals = KeyValue.objects.filter(hostid=h.id, keyid=key.id)
-                if q == "leneq":
-                    if len(vals) != lngth:
-                        hostids.remove(h.id)
-                elif q == "lengt":
-                    if len(vals) < lngth:
-                        hostids.remove(h.id)
-                elif q == "lenlt":
-                    if len(vals) > lngth:
-                        hostids.remove(h.id)
+            hostids = lengthMatches(q, k, v, hostids, hostqs)
 
     return list(hostids)
 
@@ -725,7 +1566,7 @@ def getOrigin(origin):
     if origin:
         return origin
     try:
-        origin = os.getlogin()
+        origin = getLogin()
     except OSError:  # pragma: no cover
         # Web interface can't do os.getlogin calls
         for e in ("REMOTE_USER", "REMOTE_ADDR", "USER"):
@@ -750,24 +1591,206 @@ def checkHost(host):
         return False
 
 
+################################################################################
+def getGeneration(name):
+    """Return the current value of a generation counter shared between
+    processes through the Django cache. Counters start at the current
+    time so that a counter that has been evicted from the cache can't
+    restart at a value a process has already seen.
+    Returns None if the cache can't hold the counter.
+    """
+    gen = cache.get(name)
+    if gen is None:
+        cache.add(name, int(time.time() * 1000), timeout=None)
+        gen = cache.get(name)
+    return gen
+
+
+################################################################################
+def bumpGeneration(name):
+    """Increment a generation counter to invalidate anything cached
+    against the old value. The counter is bumped again once the
+    transaction commits so that nothing can cache uncommitted data against
+    the new value."""
+
+    incrGeneration(name)
+    transaction.on_commit(lambda: incrGeneration(name))
+
+
+################################################################################
+def incrGeneration(name):
+    """Increment a generation counter straight away and return the new
+    value, or None if the cache can't hold the counter"""
+    try:
+        return cache.incr(name)
+    except ValueError:
+        cache.add(name, int(time.time() * 1000), timeout=None)
+        return cache.get(name)
+
+
+################################################################################
+def loadKeyMetadata():
+    """Load everything we need to know about the keys from the database"""
+    keys = {ak.key: ak for ak in AllowedKey.objects.all()}
+    restricted = defaultdict(set)
+    for keyid, value in RestrictedValue.objects.values_list("keyid", "value"):
+        restricted[keyid].add(value)
+    return {
+        "keys": keys,
+        "rev": {ak.id: ak.key for ak in keys.values()},
+        "restricted": dict(restricted),
+    }
+
+
+################################################################################
+def keyMetadata():
+    """Return the cached key metadata - the AllowedKeys by name, the key
+    names by id and the restricted values by keyid.
+
+    The metadata is versioned by a Generation in the database that changes
+    whenever an AllowedKey or RestrictedValue changes, so changes made by
+    any process are seen. It is kept locally and shared between processes
+    through the Django cache. The generation is only checked once for each
+    request, command server command or KeyValueBatch (see
+    expireKeyMetadata()) rather than every time a key is looked up.
+    """
+    global _akcache, _akchecked
+    if _akchecked and _akcache:
+        return _akcache
+    gen = Generation.current(AK_GENERATION)
+    _akchecked = True
+    if _akcache and _akcache.get("generation") == gen:
+        return _akcache
+    meta = cache.get(f"{AK_METADATA}:{gen}")
+    if meta is None:
+        meta = loadKeyMetadata()
+        cache.set(f"{AK_METADATA}:{gen}", meta, timeout=AK_METADATA_TIMEOUT)
+    meta["generation"] = gen
+    _akcache = meta
+    return _akcache
+
+
+################################################################################
+def expireKeyMetadata():
+    """Make the next use of the key metadata check that it is current"""
+    global _akchecked
+    _akchecked = False
+
+
+################################################################################
+def reloadKeyMetadata():
+    """Load the key metadata straight from the database, for when it is
+    known to be missing something"""
+    global _akcache, _akchecked
+    _akcache = loadKeyMetadata()
+    _akcache["generation"] = None  # Check it again next time
+    _akchecked = True
+    return _akcache
+
+
 ################################################################################
 def clearAKcache():
     """Remove the contents of the allowedkey cache - mostly for test purposes"""
     global _akcache
-    _akcache = {None: None}
+    _akcache = {}
+    expireKeyMetadata()
+    Generation.bump(AK_GENERATION)
+    bumpGeneration(AK_GENERATION)
 
 
 ################################################################################
 def getAK(key):
     """Lookup AllowedKeys. This is a oft repeated expensive activity so
     cache it"""
-    global _akcache
-    if key not in _akcache:
-        try:
-            _akcache[key] = AllowedKey.objects.get(key=key)
-        except ObjectDoesNotExist:
-            raise HostinfoException("Must use an existing key, not %s" % key)
-    return _akcache[key]
+    if key is None:
+        return None
+    if isinstance(key, AllowedKey):
+        key = key.key
+    meta = keyMetadata()
+    if key in meta["keys"]:
+        return meta["keys"][key]
+    # The key may have been created since the generation was checked
+    if AllowedKey.objects.filter(key=key).exists():
+        return reloadKeyMetadata()["keys"][key]
+    raise HostinfoException("Must use an existing key, not %s" % key)
+
+
+################################################################################
+def getRevAK():
+    """Return a dictionary of AllowedKey ids to key names"""
+    return keyMetadata()["rev"]
+
+
+################################################################################
+def getRestrictedValues(keyid):
+    """Return the set of values that a restricted key can have"""
+    return keyMetadata()["restricted"].get(keyid, set())
+
+
+################################################################################
+def permittedValue(keyid, value):
+    """Return True if value is one of the values a restricted key can have"""
+    if value in getRestrictedValues(keyid):
+        return True
+    # The value may have been added since the generation was checked
+    if RestrictedValue.objects.filter(keyid=keyid, value=value).exists():
+        reloadKeyMetadata()
+        return True
+    return False
+
+
+################################################################################
+@receiver(post_save, sender=AllowedKey)
+@receiver(post_delete, sender=AllowedKey)
+@receiver(post_save, sender=RestrictedValue)
+@receiver(post_delete, sender=RestrictedValue)
+def keyMetadataChanged(sender, **kwargs):  # pylint: disable=unused-argument
+    """Invalidate the key metadata cache"""
+    Generation.bump(AK_GENERATION)
+    bumpGeneration(AK_GENERATION)
+    expireKeyMetadata()
+
+
+################################################################################
+@receiver(request_started)
+def requestStarted(sender, **kwargs):  # pylint: disable=unused-argument
+    """Check the key metadata is current once for each request"""
+    expireKeyMetadata()
+
+
+################################################################################
+@receiver([post_save, post_delete], sender=Host)
+@receiver([post_save, post_delete], sender=HostAlias)
+@receiver([post_save, post_delete], sender=AllowedKey)
+@receiver([post_save, post_delete], sender=RestrictedValue)
+@receiver([post_save, post_delete], sender=KeyValue)
+@receiver([post_save, post_delete], sender=Links)
+def dataChanged(sender, **kwargs):  # pylint: disable=unused-argument
+    """Anything the read APIs return may now be different"""
+    bumpDataGeneration()
+
+
+################################################################################
+def bumpDataGeneration():
+    """Invalidate the ETags of the read APIs and record when it happened
+    for their Last-Modified. Anything that changes data without sending
+    the model signals (e.g. bulk_create) has to call this itself."""
+
+    def modified():
+        cache.set(DATA_MODIFIED, time.time(), timeout=None)
+
+    bumpGeneration(DATA_GENERATION)
+    modified()
+    transaction.on_commit(modified)
+
+
+################################################################################
+def getDataModified():
+    """When the data last changed, or None if we don't know"""
+    modified = cache.get(DATA_MODIFIED)
+    if modified is None:
+        return None
+    return datetime.fromtimestamp(modified, tz=timezone.utc)
 
 
 ################################################################################
@@ -818,6 +1841,336 @@ def addKeytoHost(
     return retval
 
 
+################################################################################
+class KeyValueBatch(object):
+    """Add, update, append and delete a lot of key values at once
+
+    Queue the operations with add() and delete() then apply() them. They
+    are worked through in order against an in memory copy of the values
+    of the hosts and keys involved, which is loaded with a query per chunk
+    of hosts. If every operation is valid the changes, their UndoLog
+    entries and their history are written with bulk inserts, otherwise
+    nothing is written. Should be used inside transaction.atomic().
+
+    Bulk writes don't send the model signals, so everything that the
+    signals and KeyValue.save() would have kept up to date is done here.
+    """
+
+    ############################################################################
+    def __init__(self, user=None, origin=None, readonlychange=False):
+        self.user = user or getUser()
+        self.origin = getOrigin(origin)
+        self.readonlychange = readonlychange
+        self.ops = []
+
+    ############################################################################
+    def add(self, host, key, value, update=False, append=False, origin=None):
+        """Queue adding a value, with the same rules as addKeytoHost()"""
+        self.ops.append(("add", host, key, value, update, append, origin))
+
+    ############################################################################
+    def delete(self, host, key, value=None):
+        """Queue deleting a value, or every value of the key if value is None"""
+        self.ops.append(("delete", host, key, value, False, False, None))
+
+    ############################################################################
+    def apply(self, write=True):
+        """Return the status of each operation, which is a HostinfoException
+        if the operation can't be done. Nothing is written unless every
+        operation can be done (and write is True)."""
+        expireKeyMetadata()
+        self.hosts = self.resolveHosts(set(op[1] for op in self.ops))
+        self.keys = {}
+        for key in set(op[2] for op in self.ops):
+            try:
+                self.keys[key] = getAK(key)
+            except HostinfoException as exc:
+                self.keys[key] = exc
+        self.values = self.loadValues()
+        self.created = []
+        self.updated = {}
+        self.deleted = {}
+        self.undo = []
+
+        results = []
+        for op in self.ops:
+            try:
+                if op[0] == "delete":
+                    results.append(self.doDelete(*op[1:4]))
+                else:
+                    results.append(self.doAdd(*op[1:]))
+            except HostinfoException as exc:
+                results.append(exc)
+            except TypeError as exc:  # Bad dates
+                results.append(HostinfoException(str(exc)))
+        if write and not any(isinstance(r, HostinfoException) for r in results):
+            self.write()
+        return results
+
+    ############################################################################
+    @staticmethod
+    def resolveHosts(names):
+        """Return {name: (hostid, hostname)} for the hosts and aliases"""
+        hosts = {}
+        names = list(names)
+        for start in range(0, len(names), BATCH_CHUNK):
+            chunk = names[start : start + BATCH_CHUNK]
+            for hostid, hostname in Host.objects.filter(hostname__in=chunk).values_list(
+                "id", "hostname"
+            ):
+                hosts[hostname] = (hostid, hostname)
+            aliases = HostAlias.objects.filter(alias__in=chunk).values_list(
+                "alias", "hostid", "hostid__hostname"
+            )
+            for alias, hostid, hostname in aliases:
+                hosts.setdefault(alias, (hostid, hostname))
+        return hosts
+
+    ############################################################################
+    def loadValues(self):
+        """Return {(hostid, keyid): [KeyValue]} for everything we might touch"""
+        values = defaultdict(list)
+        keyids = [ak.id for ak in self.keys.values() if isinstance(ak, AllowedKey)]
+        hostids = sorted(set(hostid for hostid, _ in self.hosts.values()))
+        if not keyids:
+            return values
+        for start in range(0, len(hostids), BATCH_CHUNK):
+            kvs = KeyValue.objects.filter(
+                hostid__in=hostids[start : start + BATCH_CHUNK], keyid__in=keyids
+            ).order_by("id")
+            for kv in kvs:
+                values[(kv.hostid_id, kv.keyid_id)].append(kv)
+        return values
+
+    ############################################################################
+    def lookup(self, host, key):
+        """Return the hostname, key and current values of host"""
+        if host not in self.hosts:
+            raise HostinfoException("Unknown host: %s" % host)
+        if isinstance(self.keys[key], HostinfoException):
+            raise self.keys[key]
+        hostid, hostname = self.hosts[host]
+        ak = self.keys[key]
+        return hostname, ak, self.values[(hostid, ak.id)]
+
+    ############################################################################
+    def doAdd(self, host, key, value, update, append, origin):
+        hostname, ak, kvs = self.lookup(host, key)
+        value = value.lower().strip()
+        if value and ak.get_validtype_display() == "date":
+            value = validateDate(value)
+        if ak.get_validtype_display() != "list" and append:
+            raise HostinfoException("Can only append to list type keys")
+        if kvs and not update and not append:
+            if kvs[0].value != value:
+                raise HostinfoException(
+                    "%s:%s already has a value %s" % (host, key, kvs[0].value)
+                )
+            return "duplicate"
+        if (append and value in [kv.value for kv in kvs]) or (
+            update and kvs and kvs[0].value == value
+        ):
+            return "duplicate"
+
+        if not value:
+            raise HostinfoException("Empty value not permitted")
+        if ak.restrictedFlag and not permittedValue(ak.id, value):
+            raise RestrictedValueException(key=ak, msg="%s is a restricted key" % ak)
+        if ak.readonlyFlag and not self.readonlychange:
+            raise ReadonlyValueException(key=ak, msg="%s is a readonly key" % ak)
+        numvalue = numericValue(value)
+        origin = self.origin if origin is None else origin
+
+        if kvs and update:
+            kv = kvs[0]
+            self.undo.append(
+                "hostinfo_replacevalue %s=%s %s %s" % (ak, value, kv.value, hostname)
+            )
+            if kv.id and kv.id not in self.updated:
+                kv.oldvalue = kv.value
+                self.updated[kv.id] = kv
+            kv.value, kv.numvalue, kv.origin = value, numvalue, origin
+            return "updated"
+
+        kv = KeyValue(
+            hostid_id=self.hosts[host][0],
+            keyid_id=ak.id,
+            value=value,
+            numvalue=numvalue,
+            origin=origin,
+        )
+        kvs.append(kv)
+        self.created.append(kv)
+        self.undo.append("hostinfo_deletevalue %s=%s %s" % (ak, value, hostname))
+        return "appended" if len(kvs) > 1 else "created"
+
+    ############################################################################
+    def doDelete(self, host, key, value):
+        hostname, ak, kvs = self.lookup(host, key)
+        value = (value or "").lower().strip()
+        victims = [kv for kv in kvs if not value or kv.value == value]
+        if not victims:
+            raise HostinfoException("Host %s doesn't have key %s" % (host, key))
+        if ak.readonlyFlag and not self.readonlychange:
+            raise ReadonlyValueException(key=ak, msg="%s is a read only key" % ak)
+        undoflag = "--append" if ak.get_validtype_display() == "list" else ""
+        for kv in victims:
+            self.undo.append(
+                "hostinfo_addvalue %s %s=%s %s" % (undoflag, ak, kv.value, hostname)
+            )
+            kvs.remove(kv)
+            if kv.id is None:  # Created earlier in this batch
+                self.created = [c for c in self.created if c is not kv]
+                continue
+            if kv.id in self.updated:
+                del self.updated[kv.id]
+                kv.value = kv.oldvalue
+            self.deleted[kv.id] = kv
+        return "deleted"
+
+    ############################################################################
+    def history(self, kvs, history_type):
+        """Bulk insert the history that simple_history would have written"""
+        keys = {ak.id: ak for ak in self.keys.values() if isinstance(ak, AllowedKey)}
+        kvs = [kv for kv in kvs if keys[kv.keyid_id].auditFlag]
+        if not kvs:
+            return
+        if history_type != "-":
+            KeyValue.history.bulk_history_create(
+                kvs, update=history_type == "~", batch_size=BATCH_CHUNK
+            )
+            return
+        model = KeyValue.history.model
+        now = django_timezone.now()
+        rows = [
+            model(
+                history_date=now,
+                history_user=model.get_default_history_user(kv),
+                history_change_reason="",
+                history_type=history_type,
+                **{
+                    field.attname: getattr(kv, field.attname)
+                    for field in model.tracked_fields
+                },
+            )
+            for kv in kvs
+        ]
+        model.objects.bulk_create(rows, batch_size=BATCH_CHUNK)
+
+    ############################################################################
+    def deleteRows(self, ids):
+        """Delete the KeyValues straight from the table. QuerySet.delete()
+        would send the signals, and everything they do is done here."""
+        table = connection.ops.quote_name(KeyValue._meta.db_table)
+        column = connection.ops.quote_name(KeyValue._meta.pk.column)
+        with connection.cursor() as cursor:
+            for start in range(0, len(ids), BATCH_CHUNK):
+                chunk = ids[start : start + BATCH_CHUNK]
+                params = ", ".join(["%s"] * len(chunk))
+                cursor.execute(
+                    f"DELETE FROM {table} WHERE {column} IN ({params})", chunk
+                )
+
+    ############################################################################
+    def write(self):
+        """Write all the changes to the database"""
+        added = defaultdict(set)
+        removed = defaultdict(set)
+        uses = defaultdict(int)
+        deleted = list(self.deleted.values())
+        if deleted:
+            self.history(deleted, "-")
+            self.deleteRows([kv.id for kv in deleted])
+            for kv in deleted:
+                removed[kv.keyid_id].add(kv.value)
+                uses[(kv.keyid_id, kv.value)] -= 1
+
+        updated = list(self.updated.values())
+        if updated:
+            # Fleets tend to get the same few values so update them by value
+            today = date.today()
+            byvalue = defaultdict(list)
+            for kv in updated:
+                kv.modifieddate = today
+                removed[kv.keyid_id].add(kv.oldvalue)
+                added[kv.keyid_id].add(kv.value)
+                uses[(kv.keyid_id, kv.oldvalue)] -= 1
+                uses[(kv.keyid_id, kv.value)] += 1
+                byvalue[(kv.value, kv.numvalue, kv.origin)].append(kv.id)
+            for (value, numvalue, origin), ids in byvalue.items():
+                for start in range(0, len(ids), BATCH_CHUNK):
+                    KeyValue.objects.filter(
+                        id__in=ids[start : start + BATCH_CHUNK]
+                    ).update(
+                        value=value,
+                        numvalue=numvalue,
+                        origin=origin,
+                        modifieddate=today,
+                    )
+            self.history(updated, "~")
+
+        if self.created:
+            KeyValue.objects.bulk_create(self.created, batch_size=BATCH_CHUNK)
+            if self.created[0].id is None:  # Database can't return the ids
+                self.findIds(self.created)
+            for kv in self.created:
+                added[kv.keyid_id].add(kv.value)
+                uses[(kv.keyid_id, kv.value)] += 1
+            self.history(self.created, "+")
+
+        UndoLog.objects.bulk_create(
+            [UndoLog(user=self.user[:200], action=act[:200]) for act in self.undo],
+            batch_size=BATCH_CHUNK,
+        )
+        for keyid, values in added.items():
+            ApproxIndex.addValues(keyid, values)
+        for keyid, values in removed.items():
+            ApproxIndex.removeValues(keyid, values - added[keyid])
+        KeyStats.adjust(uses)
+        keyValuesChanged(set(added) | set(removed))
+
+    ############################################################################
+    @staticmethod
+    def findIds(kvs):
+        """Fill in the ids of newly created KeyValues"""
+        hostids = sorted(set(kv.hostid_id for kv in kvs))
+        keyids = set(kv.keyid_id for kv in kvs)
+        ids = {}
+        for start in range(0, len(hostids), BATCH_CHUNK):
+            rows = KeyValue.objects.filter(
+                hostid__in=hostids[start : start + BATCH_CHUNK], keyid__in=keyids
+            ).values_list("id", "hostid", "keyid", "value")
+            for kvid, hostid, keyid, value in rows:
+                ids[(hostid, keyid, value)] = kvid
+        for kv in kvs:
+            kv.id = ids[(kv.hostid_id, kv.keyid_id, kv.value)]
+
+
+################################################################################
+def keyValuesChanged(keyids):
+    """Do what the KeyValue signals would have done for KeyValues of
+    these keys that have been changed in bulk"""
+    if not keyids:
+        return
+    for keyid in keyids:
+        bumpGeneration(KEY_GENERATION % keyid)
+    index = getValueIndex()
+    if index is not None:
+        index.invalidate(keyids)
+    bumpDataGeneration()
+
+
+################################################################################
+def hostsChanged():
+    """Do what the Host and HostAlias signals would have done for hosts
+    and aliases that have been created in bulk"""
+    Generation.bump(HOST_GENERATION)
+    Generation.bump(ALIAS_GENERATION)
+    bumpGeneration(HOST_GENERATION)
+    bumpGeneration(ALIAS_GENERATION)
+    bumpDataGeneration()
+
+
 ###############################################################################
 class HostinfoCommand(object):
     description = None
@@ -834,6 +2187,36 @@ class HostinfoCommand(object):
         return self.handle(self.namespace)
 
 
+###############################################################################
+def writeOutput(output, out=None):
+    """Print the output of a command with the surrounding whitespace
+    stripped. The output can be a string or, so that big outputs are
+    written as they are generated, an iterable of strings."""
+    out = out or sys.stdout
+    if not output:
+        return
+    if isinstance(output, str):
+        out.write("%s\n" % output.strip())
+        return
+    anything = written = False
+    pending = ""  # Whitespace that is only written if more output follows
+    for chunk in output:
+        if not chunk:
+            continue
+        anything = True
+        if not written:
+            chunk = chunk.lstrip()
+        body = chunk.rstrip()
+        if body:
+            out.write(pending + body)
+            pending = chunk[len(body) :]
+            written = True
+        else:
+            pending += chunk
+    if anything:
+        out.write("\n")
+
+
 ###############################################################################
 def run_from_cmdline():
     import importlib
@@ -849,8 +2232,7 @@ def run_from_cmdline():
     c.over_parseArgs()
     try:
         output, retval = c.over_handle()
-        if output:
-            print(output.strip())
+        writeOutput(output)
     except HostinfoException as exc:
         sys.stderr.write("%s\n" % exc.msg)
         return exc.retval
@@ -0,0 +1,67 @@
+"""Show where the start up time of a hostinfo command goes
+
+Used by bin/hostinfo --profile-startup. Like cliclient.py this is imported
+before django is set up so it mustn't import anything from django.
+"""
+#
+# Written by Dougal Scott <dougal.scott@gmail.com>
+#
+#    Copyright (C) 2025 Dougal Scott
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import subprocess
+import sys
+import time
+
+IMPORT_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+################################################################################
+def profileStartup(argv, top=25):
+    """Run the command again with python timing its imports, then report
+    the slowest imports and the total start up time on stderr"""
+    env = dict(os.environ, HOSTINFO_SOCKET="")  # Time a real cold start
+    start = time.time()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime"] + list(argv),
+        env=env,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    elapsed = time.time() - start
+
+    imports = []
+    for line in proc.stderr.splitlines():
+        m = IMPORT_LINE.match(line)
+        if m:
+            selftime, cumulative, indent, module = m.groups()
+            imports.append((int(cumulative), int(selftime), len(indent), module))
+        elif not line.startswith("import time:"):
+            sys.stderr.write("%s\n" % line)
+    total = sum(imp[0] for imp in imports if imp[2] == 1)
+
+    sys.stderr.write("%10s %10s  %s\n" % ("cumul ms", "self ms", "module"))
+    for cumulative, selftime, _, module in sorted(imports, reverse=True)[:top]:
+        sys.stderr.write(
+            "%10.1f %10.1f  %s\n" % (cumulative / 1000, selftime / 1000, module)
+        )
+    sys.stderr.write("%d modules imported in %.1f ms\n" % (len(imports), total / 1000))
+    sys.stderr.write("Total time %.1f ms\n" % (elapsed * 1000))
+    return proc.returncode
+
+
+# EOF
@@ -1,15 +1,62 @@
 """ Views for the REST interface """
 # Handle django model.objects
 # pylint: disable=no-member
+import itertools
 import json
-from django.http import JsonResponse, Http404
+from collections import defaultdict
+from urllib.parse import quote
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.http import JsonResponse, Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, get_list_or_404
 from django.urls import reverse
-from django.views.decorators.http import require_http_methods
+from django.utils.http import RFC3986_SUBDELIMS
+from django.views.decorators.http import condition, require_http_methods
+from django.views.decorators.vary import vary_on_headers
 from django.views.decorators.csrf import csrf_exempt
 from .models import Host, AllowedKey, KeyValue, HostAlias, Links, RestrictedValue
 from .models import parseQualifiers, getMatches, getHost, HostinfoException
-from .models import addKeytoHost, calcKeylistVals
+from .models import addKeytoHost, calcKeylistVals, getRevAK, KeyValueBatch
+from .models import getGeneration, getDataModified, DATA_GENERATION, KeyStats
+from .models import getUser
+
+HOST_CHUNK = 500
+API_MAX_LIMIT = 5000
+KEYSTATS_TOP = 10
+URL_PLACEHOLDER = 987654321012
+
+
+###############################################################################
+def conditionalRequests():
+    """The ETags and Last-Modified come from the Django cache, so they are
+    only sent if HOSTINFO_CONDITIONAL_REQUESTS says it is shared by all of
+    the processes. Otherwise a process wouldn't see changes made by the
+    others and would answer 304 Not Modified for data that has changed."""
+    return getattr(settings, "HOSTINFO_CONDITIONAL_REQUESTS", False)
+
+
+###############################################################################
+def dataETag(request, *args, **kwargs):  # pylint: disable=unused-argument
+    """ETag for the read APIs. Nothing they return can change without the
+    data generation changing, so if the client has the current generation
+    there is no need to run the query."""
+    if not conditionalRequests():
+        return None
+    gen = getGeneration(DATA_GENERATION)
+    if gen is None:
+        return None
+    if wantStream(request):
+        return f'"{gen}-ndjson"'
+    return f'"{gen}"'
+
+
+###############################################################################
+def dataModified(request, *args, **kwargs):  # pylint: disable=unused-argument
+    """Last-Modified for the read APIs"""
+    if not conditionalRequests():
+        return None
+    return getDataModified()
 
 
 ###############################################################################
@@ -52,6 +99,8 @@ def getSerializerArgs(request):
 
 ###############################################################################
 @require_http_methods(["GET"])
+@vary_on_headers("Accept")
+@condition(etag_func=dataETag, last_modified_func=dataModified)
 def HostQuery(request, query):
     """Query hosts"""
     sargs = getSerializerArgs(request)
@@ -60,15 +109,94 @@ def HostQuery(request, query):
         qualifiers = parseQualifiers(criteria)
     except HostinfoException as exc:  # pragma: no cover
         return JsonResponse({"error": str(exc)}, status=406)
+    try:
+        limit, after = getPage(request)
+    except HostinfoException as exc:
+        return JsonResponse({"error": str(exc)}, status=406)
     matches = getMatches(qualifiers)
-    hosts = Host.objects.filter(pk__in=matches)
+    nextpage = None
+    if limit is None:
+        hosts = Host.objects.filter(pk__in=matches)
+    else:
+        matches = sorted(m for m in matches if m > after)[: limit + 1]
+        hosts = list(Host.objects.filter(pk__in=matches).order_by("id"))
+        hosts, nextpage = paginate(request, hosts, limit)
+    if wantStream(request):
+        if limit is None:
+            hosts = hosts.iterator(chunk_size=HOST_CHUNK)
+        return streamHosts(hosts, request, nextpage, **sargs)
     ans = {
         "result": f"{len(hosts)} matching hosts",
-        "hosts": [HostSerialize(host, request, **sargs) for host in hosts],
+        "hosts": HostBulkSerialize(hosts, request, **sargs),
     }
+    if limit is not None:
+        ans["next"] = nextpage
     return JsonResponse(ans)
 
 
+###############################################################################
+def wantStream(request):
+    """Does the client want the hosts as newline delimited JSON"""
+    if "application/x-ndjson" in request.headers.get("Accept", ""):
+        return True
+    stream = get_payload(request).get("stream", "0")
+    if isinstance(stream, list):
+        stream = stream[0]
+    return str(stream).lower() not in ("", "0", "false", "no")
+
+
+###############################################################################
+def streamHosts(hosts, request, nextpage=None, **kwargs):
+    """Stream the hosts one JSON object per line as they are serialized.
+    If this is a page the next page is given in a Link header."""
+
+    def lines():
+        for ans in iterHostSerialize(hosts, request, **kwargs):
+            yield json.dumps(ans, cls=DjangoJSONEncoder) + "\n"
+
+    response = StreamingHttpResponse(lines(), content_type="application/x-ndjson")
+    if nextpage:
+        response["Link"] = f'<{nextpage}>; rel="next"'
+    return response
+
+
+###############################################################################
+def getPage(request):
+    """Return the limit and after parameters for keyset pagination on the
+    host id. limit is None if the client wants everything in one go."""
+    payload = get_payload(request)
+    page = []
+    for param, default in (("limit", None), ("after", 0)):
+        val = payload.get(param, default)
+        if isinstance(val, list):
+            val = val[0]
+        if val is None:
+            page.append(None)
+            continue
+        try:
+            page.append(int(val))
+        except ValueError:
+            raise HostinfoException(f"{param} must be an integer, not {val}")
+    limit, after = page
+    if limit is not None:
+        limit = min(max(limit, 1), API_MAX_LIMIT)
+    return limit, after
+
+
+###############################################################################
+def paginate(request, hosts, limit):
+    """hosts is the next (up to) limit + 1 hosts in id order. Return the
+    hosts for this page and the url of the next page, or None if this is
+    the last page"""
+    if len(hosts) <= limit:
+        return hosts, None
+    hosts = hosts[:limit]
+    params = request.GET.copy()
+    params["limit"] = str(limit)
+    params["after"] = str(hosts[-1].id)
+    return hosts, request.build_absolute_uri("?" + params.urlencode())
+
+
 ###############################################################################
 def get_payload(request):
     """Get payload"""
@@ -99,6 +227,8 @@ def get_origin(request):
 ###############################################################################
 @csrf_exempt
 @require_http_methods(["GET", "POST"])
+@vary_on_headers("Accept")
+@condition(etag_func=dataETag, last_modified_func=dataModified)
 def HostDetail(request, hostpk=None, hostname=None):
     """Details about a host"""
     if request.method == "GET":
@@ -131,6 +261,8 @@ def getReferredHost(hostpk=None, hostname=None):
 ###############################################################################
 # /keylist/(keypk, key)/[query]
 @require_http_methods(["GET"])
+@vary_on_headers("Accept")
+@condition(etag_func=dataETag, last_modified_func=dataModified)
 def KeyListRest(request, akeypk=None, akey=None, query=None):
     """ List Keys through REST interface """
     matches = []
@@ -152,6 +284,46 @@ def KeyListRest(request, akeypk=None, akey=None, query=None):
     return JsonResponse(data)
 
 
+###############################################################################
+# /keystats/[(keypk, key)/][?top=N]
+@require_http_methods(["GET"])
+@vary_on_headers("Accept")
+@condition(etag_func=dataETag, last_modified_func=dataModified)
+def KeyStatsRest(request, akeypk=None, akey=None):
+    """The most common values of each key, from the KeyStats counts"""
+    try:
+        top = min(int(request.GET.get("top", KEYSTATS_TOP)), API_MAX_LIMIT)
+    except ValueError:
+        return JsonResponse({"error": "top must be a number"}, status=406)
+    if akeypk:
+        keys = [get_object_or_404(AllowedKey, id=akeypk)]
+    elif akey:
+        keys = [get_object_or_404(AllowedKey, key=akey)]
+    else:
+        keys = list(AllowedKey.objects.all())
+    total = Host.objects.count()
+    numhosts = KeyStats.hostCounts(keys)
+    values = KeyStats.topValues([ak.id for ak in keys], top)
+    keyurl = urlTemplate(request, "restakey")
+    ans = {
+        "result": "ok",
+        "total": total,
+        "keys": [
+            {
+                "key": ak.key,
+                "url": keyurl(ak.id),
+                "numdef": numhosts[ak.id],
+                "numundef": total - numhosts[ak.id],
+                "values": [
+                    {"value": value, "count": uses} for value, uses in values[ak.id]
+                ],
+            }
+            for ak in keys
+        ],
+    }
+    return JsonResponse(ans)
+
+
 ###############################################################################
 @require_http_methods(["GET", "POST", "DELETE"])
 @csrf_exempt
@@ -321,15 +493,170 @@ def HostAliasRest(request, hostpk=None, hostname=None, aliaspk=None, alias=None)
     return JsonResponse(ans)
 
 
+###############################################################################
+@csrf_exempt
+@require_http_methods(["POST"])
+def BatchRest(request):
+    """Apply a list of operations in one transaction "/api/batch/"
+
+    Each operation is a dict with an "op" of add, update, append or delete
+    and a "host", plus either a "key" and "value", an "alias", or a "link"
+    (the tag) and "url". The operations are done in the order they are
+    given, and nothing is changed unless every operation works.
+    """
+    try:
+        payload = json.loads(request.body.decode("utf-8"))
+    except ValueError:
+        payload = None
+    ops = payload.get("operations") if isinstance(payload, dict) else payload
+    if not isinstance(ops, list) or not all(isinstance(op, dict) for op in ops):
+        return JsonResponse({"error": "Expected a list of operations"}, status=406)
+    origin = request.META.get("REMOTE_HOST", "unknown rest")
+    if isinstance(payload, dict) and payload.get("origin"):
+        origin = payload["origin"]
+
+    statuses = [None] * len(ops)
+    user = getUser()
+    with transaction.atomic():
+        # Each run of key value operations is applied as one batch before
+        # the alias or link operation that follows it
+        batch, kvops = KeyValueBatch(user=user, origin=origin), []
+        for num, op in enumerate(ops):
+            try:
+                if op.get("op") not in ("add", "update", "append", "delete"):
+                    raise HostinfoException(f"Unknown operation {op.get('op')}")
+                if "key" in op:
+                    batchKeyValue(batch, op, origin)
+                    kvops.append(num)
+                    continue
+                if kvops:
+                    applyBatch(batch, kvops, statuses)
+                    batch, kvops = KeyValueBatch(user=user, origin=origin), []
+                if "alias" in op:
+                    statuses[num] = batchAlias(op, origin)
+                elif "link" in op:
+                    statuses[num] = batchLink(op)
+                else:
+                    raise HostinfoException("Need a key, alias or link")
+            except HostinfoException as exc:
+                statuses[num] = exc
+            except KeyError as exc:
+                statuses[num] = HostinfoException(f"Missing {exc}")
+        applyBatch(batch, kvops, statuses)
+        failed = any(isinstance(status, HostinfoException) for status in statuses)
+        if failed:
+            transaction.set_rollback(True)
+
+    for num, status in enumerate(statuses):
+        if isinstance(status, HostinfoException):
+            statuses[num] = f"failed: {status.msg}"
+        elif failed:
+            statuses[num] = "aborted"
+    ans = {"result": "failed" if failed else "ok", "statuses": statuses}
+    return JsonResponse(ans, status=406 if failed else 200)
+
+
+###############################################################################
+def applyBatch(batch, kvops, statuses):
+    """Apply the key value operations queued by /api/batch/ and record how
+    they went. They are only checked, not written, if anything before them
+    has already failed."""
+    if not kvops:
+        return
+    failed = any(isinstance(status, HostinfoException) for status in statuses)
+    for num, status in zip(kvops, batch.apply(write=not failed)):
+        statuses[num] = status
+
+
+###############################################################################
+def batchKeyValue(batch, op, origin):
+    """Queue a key value operation from /api/batch/"""
+    host, key = op["host"].lower(), op["key"].lower()
+    if op["op"] == "delete":
+        batch.delete(host, key, op.get("value"))
+    else:
+        batch.add(
+            host,
+            key,
+            str(op["value"]),
+            update=op["op"] == "update",
+            append=op["op"] == "append",
+            origin=op.get("origin", origin),
+        )
+
+
+###############################################################################
+def batchAlias(op, origin):
+    """Do an alias operation from /api/batch/"""
+    hostid = getHost(op["host"].lower())
+    if not hostid:
+        raise HostinfoException(f"Unknown host: {op['host']}")
+    alias = op["alias"].lower()
+    existing = HostAlias.objects.filter(alias=alias).first()
+    if op["op"] == "delete":
+        if not existing or existing.hostid_id != hostid.id:
+            raise HostinfoException(f"Host {op['host']} doesn't have alias {alias}")
+        existing.delete()
+        return "deleted"
+    if existing:
+        if existing.hostid_id == hostid.id:
+            return "duplicate"
+        raise HostinfoException(f"{alias} is already an alias of another host")
+    if Host.objects.filter(hostname=alias).exists():
+        raise HostinfoException(f"{alias} is already a host")
+    HostAlias(hostid=hostid, alias=alias, origin=op.get("origin", origin)).save()
+    return "created"
+
+
+###############################################################################
+def batchLink(op):
+    """Do a link operation from /api/batch/"""
+    hostid = getHost(op["host"].lower())
+    if not hostid:
+        raise HostinfoException(f"Unknown host: {op['host']}")
+    existing = Links.objects.filter(hostid=hostid, tag=op["link"]).first()
+    if op["op"] == "delete":
+        if not existing:
+            raise HostinfoException(f"Host {op['host']} doesn't have link {op['link']}")
+        existing.delete()
+        return "deleted"
+    if existing and existing.url == op["url"]:
+        return "duplicate"
+    if existing:
+        existing.url = op["url"]
+        existing.save()
+        return "updated"
+    Links(hostid=hostid, tag=op["link"], url=op["url"]).save()
+    return "created"
+
+
 ###############################################################################
 @require_http_methods(["GET"])
+@vary_on_headers("Accept")
+@condition(etag_func=dataETag, last_modified_func=dataModified)
 def HostList(request, *args):  # pylint: disable=unused-argument
     """List the hosts "/api/hosts/" """
-    hosts = get_list_or_404(Host)
+    try:
+        limit, after = getPage(request)
+    except HostinfoException as exc:
+        return JsonResponse({"error": str(exc)}, status=406)
+    sargs = {"keys": False, "aliases": False, "links": False, "dates": False}
+    nextpage = None
+    if limit is not None:
+        hosts = list(Host.objects.filter(id__gt=after).order_by("id")[: limit + 1])
+        hosts, nextpage = paginate(request, hosts, limit)
+    if wantStream(request):
+        if limit is None:
+            hosts = Host.objects.all().iterator(chunk_size=HOST_CHUNK)
+        return streamHosts(hosts, request, nextpage, **sargs)
+    if limit is None:
+        hosts = get_list_or_404(Host)
     ans = {
         "result": f"{len(hosts)} hosts",
-        "hosts": [HostShortSerialize(host, request) for host in hosts],
+        "hosts": HostBulkSerialize(hosts, request, **sargs),
     }
+    if limit is not None:
+        ans["next"] = nextpage
     return JsonResponse(ans)
 
 
@@ -353,8 +680,29 @@ def KValDetail(request, pk=None):
 
 
 ###############################################################################
-def HostSerialize(obj, request, **kwargs):
-    """Serialize the host"""
+def urlTemplate(request, viewname, nargs=1):
+    """Return a function that gives the same answer as
+    request.build_absolute_uri(reverse(viewname, args=args)) but only
+    calls reverse() once, for when we need the url of a lot of objects"""
+    placeholders = [str(URL_PLACEHOLDER + num) for num in range(nargs)]
+    url = request.build_absolute_uri(reverse(viewname, args=placeholders))
+    pieces = [url]
+    for placeholder in placeholders:
+        pieces[-1:] = pieces[-1].split(placeholder, 1)
+
+    def build(*args):
+        ans = [pieces[0]]
+        for arg, piece in zip(args, pieces[1:]):
+            ans.append(quote(str(arg), safe=RFC3986_SUBDELIMS + "/~:@"))
+            ans.append(piece)
+        return "".join(ans)
+
+    return build
+
+
+###############################################################################
+def serializerFields(kwargs):
+    """Work out which fields HostSerialize should include"""
     fields = {
         "keys": False,
         "aliases": False,
@@ -380,6 +728,13 @@ def HostSerialize(obj, request, **kwargs):
             "dates": True,
             "origin": True,
         }
+    return fields
+
+
+###############################################################################
+def HostSerialize(obj, request, **kwargs):
+    """Serialize the host"""
+    fields = serializerFields(kwargs)
 
     ans = {
         "id": obj.id,
@@ -427,6 +782,107 @@ def HostSerialize(obj, request, **kwargs):
     return ans
 
 
+###############################################################################
+def HostBulkSerialize(hosts, request, **kwargs):
+    """Serialize a lot of hosts with the same result as calling
+    HostSerialize() on each of them, but with the key values, aliases and
+    links loaded a chunk of hosts at a time rather than host by host"""
+    return list(iterHostSerialize(hosts, request, **kwargs))
+
+
+###############################################################################
+def iterHostSerialize(hosts, request, **kwargs):
+    """Generator behind HostBulkSerialize(). hosts can be any iterable,
+    only one chunk of hosts and their details is held at a time."""
+    fields = serializerFields(kwargs)
+    hosturl = urlTemplate(request, "resthost")
+    kvalurl = urlTemplate(request, "restkval")
+    aliasurl = urlTemplate(request, "hostaliasrest", 2)
+    keys = {}
+    if fields["keys"]:
+        for keyid, key in getRevAK().items():
+            if "*" in fields["keys"] or key in fields["keys"]:
+                keys[keyid] = key
+
+    hosts = iter(hosts)
+    while True:
+        chunk = list(itertools.islice(hosts, HOST_CHUNK))
+        if not chunk:
+            break
+        hostids = [host.id for host in chunk]
+        keyvals = defaultdict(list)
+        aliases = defaultdict(list)
+        links = defaultdict(list)
+        if keys:
+            kvs = (
+                KeyValue.objects.filter(hostid__in=hostids, keyid__in=keys)
+                .order_by("id")
+                .values_list("id", "hostid", "keyid", "value")
+            )
+            for kvid, hostid, keyid, value in kvs:
+                keyvals[hostid].append((kvid, keys[keyid], value))
+        if fields["aliases"]:
+            rows = (
+                HostAlias.objects.filter(hostid__in=hostids)
+                .order_by("id")
+                .values_list(
+                    "id", "hostid", "alias", "origin", "createdate", "modifieddate"
+                )
+            )
+            for row in rows:
+                aliases[row[1]].append(row)
+        if fields["links"]:
+            rows = Links.objects.filter(hostid__in=hostids).values_list(
+                "id", "hostid", "url", "tag", "modifieddate"
+            )
+            for row in rows:
+                links[row[1]].append(row)
+
+        for host in chunk:
+            short = {
+                "id": host.id,
+                "hostname": host.hostname,
+                "url": hosturl(host.id),
+            }
+            ans = dict(short)
+            if fields["origin"]:
+                ans["origin"] = host.origin
+            if fields["dates"]:
+                ans["createdate"] = host.createdate
+                ans["modifieddate"] = host.modifieddate
+            if fields["keys"]:
+                ans["keyvalues"] = {}
+                for kvid, key, value in keyvals[host.id]:
+                    ans["keyvalues"].setdefault(key, []).append(
+                        {"id": kvid, "url": kvalurl(kvid), "key": key, "value": value}
+                    )
+            if fields["aliases"]:
+                ans["aliases"] = [
+                    {
+                        "id": row[0],
+                        "url": aliasurl(host.hostname, row[0]),
+                        "host": short,
+                        "alias": row[2],
+                        "origin": row[3],
+                        "createdate": row[4],
+                        "modifieddate": row[5],
+                    }
+                    for row in aliases[host.id]
+                ]
+            if fields["links"]:
+                ans["links"] = [
+                    {
+                        "id": row[0],
+                        "host": short,
+                        "url": row[2],
+                        "tag": row[3],
+                        "modifieddate": row[4],
+                    }
+                    for row in links[host.id]
+                ]
+            yield ans
+
+
 ###############################################################################
 def AllowedKeySerialize(obj, request):
     """Serialize the allowed keys"""
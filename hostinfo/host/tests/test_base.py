@@ -20,18 +20,35 @@
 import json
 import sys
 import time
-
-from django.test import TestCase
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import QuerySet
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.test.client import Client
 
-from host.models import HostinfoException
+from host import models
+from host.models import HostinfoException, RestrictedValue
+from host.models import getRestrictedValues, getRevAK, permittedValue
+from host.models import HostIndex, getHostIndex, getHostList, ValueIndex
+from host.models import Generation, HOST_GENERATION, AK_GENERATION, ALIAS_GENERATION
+from host.models import expireKeyMetadata
 from host.models import Host, HostAlias, AllowedKey, Links
 from host.models import validateDate, clearAKcache, calcKeylistVals
+from host.models import valueFrequencies
 from host.models import parseQualifiers, getMatches
+from host.models import bypassQueryCache, queryCacheStats
 from host.models import getHost, checkHost, getAK
 from host.models import addKeytoHost, KeyValue
+from host.models import ApproxIndex, deletionVariants, editDistance, getApproxObjects
+from host.models import KeyStats, KeyValueBatch
 
-from host.views import hostviewrepr, hostData
+from host.views import hostviewrepr, hostData, getLinks
 from host.views import orderHostList
 from host.edits import getHostMergeKeyData
 
@@ -194,6 +211,87 @@ class test_parseQualifiers(TestCase):
         with self.assertRaises(HostinfoException):
             parseQualifiers(["badkey=value"])
 
+    ###########################################################################
+    def test_queries(self):
+        """The number of queries doesn't depend on the number of terms"""
+        getAK("kpq")
+        criteria = [f"kpq=value{num}" for num in range(50)]
+        with self.assertNumQueries(2):  # The generations and the hostnames
+            quals = parseQualifiers(criteria)
+        self.assertEqual(len(quals), 50)
+        self.assertEqual(quals[49], ("equal", "kpq", "value49"))
+        with self.assertNumQueries(1):  # The generations
+            self.assertEqual(parseQualifiers(criteria), quals)
+
+    ###########################################################################
+    def test_cache_invalidation(self):
+        """A new host with an embedded operator changes the parse"""
+        self.assertEqual(
+            parseQualifiers(["kpq.lt.value"]), [("lessthan", "kpq", "value")]
+        )
+        host = Host(hostname="kpq.lt.value")
+        host.save()
+        self.assertEqual(
+            parseQualifiers(["kpq.lt.value"]), [("host", None, "kpq.lt.value")]
+        )
+        host.delete()
+
+    ###########################################################################
+    def test_alias(self):
+        host = Host(hostname="hostpq")
+        host.save()
+        HostAlias(hostid=host, alias="hostpq.lt.example.com").save()
+        self.assertEqual(
+            parseQualifiers(["hostpq.lt.example.com"]),
+            [("host", None, "hostpq.lt.example.com")],
+        )
+        host.delete()
+
+    ###########################################################################
+    def test_alias_invalidation(self):
+        """A new alias with an embedded operator changes the parse"""
+        host = Host(hostname="hostpqa")
+        host.save()
+        self.assertEqual(
+            parseQualifiers(["kpq.gt.value"]), [("greaterthan", "kpq", "value")]
+        )
+        HostAlias(hostid=host, alias="kpq.gt.value").save()
+        self.assertEqual(
+            parseQualifiers(["kpq.gt.value"]), [("host", None, "kpq.gt.value")]
+        )
+        host.delete()
+
+    ###########################################################################
+    def test_other_process(self):
+        """Aliases added by another process change the parse"""
+        host = Host(hostname="hostpqc")
+        host.save()
+        self.assertEqual(
+            parseQualifiers(["kpq.ne.value"]), [("unequal", "kpq", "value")]
+        )
+        # Without the signals here, as in another process
+        HostAlias.objects.bulk_create([HostAlias(hostid=host, alias="kpq.ne.value")])
+        Generation.bump(ALIAS_GENERATION)
+        self.assertEqual(
+            parseQualifiers(["kpq.ne.value"]), [("host", None, "kpq.ne.value")]
+        )
+        host.delete()
+
+    ###########################################################################
+    def test_today(self):
+        """Relative dates aren't remembered past the day they were parsed"""
+        datekey = AllowedKey(key="kpqdate", validtype=3)
+        datekey.save()
+        day1 = time.struct_time((2020, 1, 1, 12, 0, 0, 2, 1, 0))
+        day2 = time.struct_time((2020, 1, 2, 12, 0, 0, 3, 2, 0))
+        with patch("time.localtime", return_value=day1):
+            quals = parseQualifiers(["kpqdate<today"])
+        self.assertEqual(quals, [("lessthan", "kpqdate", "2020-01-01")])
+        with patch("time.localtime", return_value=day2):
+            quals = parseQualifiers(["kpqdate<today"])
+        self.assertEqual(quals, [("lessthan", "kpqdate", "2020-01-02")])
+        datekey.delete()
+
 
 ###############################################################################
 class test_getMatches(TestCase):
@@ -254,6 +352,27 @@ class test_getMatches(TestCase):
             tester = self.assertCountEqual
         tester(getMatches([("lenlt", "list", "2")]), [self.host.id, self.host2.id])
 
+    ###########################################################################
+    def test_len_queries(self):
+        """Number of queries for the length qualifiers shouldn't depend
+        on the number of hosts"""
+        numqueries = []
+        hosts = []
+        for numhosts in (5, 50):
+            for num in range(len(hosts), numhosts):
+                host = Host(hostname=f"hostlen{num}")
+                host.save()
+                hosts.append(host)
+                addKeytoHost(host=host.hostname, key="list", value="alpha")
+            getAK("list")
+            with CaptureQueriesContext(connection) as ctx:
+                matches = getMatches([("lengt", "list", "1"), ("leneq", "list", "1")])
+            self.assertEqual(len(matches), numhosts + 1)
+            numqueries.append(len(ctx.captured_queries))
+        self.assertEqual(numqueries[0], numqueries[1])
+        for host in hosts:
+            host.delete()
+
     ###########################################################################
     def test_badlenlt(self):
         with self.assertRaises(HostinfoException) as cm:
@@ -434,6 +553,483 @@ class test_getMatches(TestCase):
         self.assertEqual(getMatches([("host", None, "host")]), [])
         self.assertEqual(getMatches([("host", None, "foo")]), [])
 
+    ###########################################################################
+    def test_combined(self):
+        # hostA: single=100, list==[alpha, beta], date=2012/12/25, number=100
+        # hostB: list=[alpha], number=2
+        self.assertEqual(
+            getMatches([("equal", "list", "alpha"), ("undef", "single", "")]),
+            [self.host2.id],
+        )
+        self.assertEqual(
+            getMatches(
+                [
+                    ("def", "list", ""),
+                    ("approx", "list", "btea"),
+                    ("greaterthan", "number", "10"),
+                ]
+            ),
+            [self.host.id],
+        )
+        self.assertEqual(
+            getMatches([("hostre", "hostgm", ""), ("host", None, "hostgmb")]),
+            [self.host2.id],
+        )
+        self.assertEqual(
+            getMatches([("equal", "list", "alpha"), ("notcontains", "list", "bet")]),
+            [self.host2.id],
+        )
+        self.assertEqual(
+            set(getMatches([])),
+            set([h.id for h in Host.objects.all()]),
+        )
+
+    ###########################################################################
+    def test_single_query(self):
+        """All of the database qualifiers are done in the one query"""
+        quals = [("equal", "list", "alpha"), ("undef", "single", "")]
+        getMatches(quals)  # Load the keys
+        with self.assertNumQueries(1):
+            self.assertEqual(getMatches(quals), [self.host2.id])
+
+
+###############################################################################
+class test_ApproxIndex(TestCase):
+    def setUp(self):
+        clearAKcache()
+        self.host = Host(hostname="hostai")
+        self.host.save()
+        self.key = AllowedKey(key="serial", validtype=2)
+        self.key.save()
+        self.kv = KeyValue(hostid=self.host, keyid=self.key, value="abc123")
+        self.kv.save()
+
+    ###########################################################################
+    def tearDown(self):
+        self.key.delete()
+        self.host.delete()
+
+    ###########################################################################
+    def test_editdistance(self):
+        self.assertEqual(editDistance("abc", "abc"), 0)
+        self.assertEqual(editDistance("abc", "acb"), 1)
+        self.assertEqual(editDistance("abc", "abcd"), 1)
+        self.assertEqual(editDistance("abc", "xbc"), 1)
+        self.assertEqual(editDistance("abc", "cba"), 2)
+        self.assertEqual(editDistance("abcdef", "badcfe", 3), 3)
+
+    ###########################################################################
+    def test_variants(self):
+        self.assertEqual(deletionVariants("ab"), {"ab", "a", "b"})
+        self.assertEqual(
+            deletionVariants("abc", 2), {"abc", "ab", "ac", "bc", "a", "b", "c"}
+        )
+
+    ###########################################################################
+    def test_maintained(self):
+        self.assertEqual(
+            getApproxObjects(self.key.id, "abc124"), [{"hostid": self.host.id}]
+        )
+        self.kv.value = "xyz789"
+        self.kv.save()
+        self.assertEqual(getApproxObjects(self.key.id, "abc124"), [])
+        self.assertEqual(
+            getApproxObjects(self.key.id, "xzy789"), [{"hostid": self.host.id}]
+        )
+        self.assertFalse(ApproxIndex.objects.filter(value="abc123").exists())
+        self.kv.delete()
+        self.assertFalse(ApproxIndex.objects.filter(keyid=self.key).exists())
+
+    ###########################################################################
+    def test_shared_value(self):
+        """Only remove values from the index once nothing uses them"""
+        host2 = Host(hostname="hostai2")
+        host2.save()
+        kv2 = KeyValue(hostid=host2, keyid=self.key, value="abc123")
+        kv2.save()
+        self.kv.delete()
+        self.assertEqual(
+            getApproxObjects(self.key.id, "abd123"), [{"hostid": host2.id}]
+        )
+        host2.delete()
+
+    ###########################################################################
+    def test_unchanged(self):
+        """The index is only written to for values that are new to the key"""
+        host2 = Host(hostname="hostai2")
+        host2.save()
+        with patch.object(ApproxIndex, "addValues") as addValues:
+            self.kv.origin = "elsewhere"
+            self.kv.save()
+            KeyValue(hostid=host2, keyid=self.key, value="abc123").save()
+            addValues.assert_not_called()
+            KeyValue(hostid=host2, keyid=self.key, value="def456").save()
+            addValues.assert_called_once_with(self.key.id, ["def456"])
+        host2.delete()
+
+    ###########################################################################
+    def test_rebuild(self):
+        ApproxIndex.objects.all().delete()
+        self.assertEqual(getApproxObjects(self.key.id, "abc12"), [])
+        ApproxIndex.rebuild(keyid=self.key.id)
+        self.assertEqual(
+            getApproxObjects(self.key.id, "abc12"), [{"hostid": self.host.id}]
+        )
+
+
+###############################################################################
+class test_KeyStats(TestCase):
+    def setUp(self):
+        clearAKcache()
+        self.hosts = [Host(hostname="hostks%d" % i) for i in range(3)]
+        for host in self.hosts:
+            host.save()
+        self.key = AllowedKey(key="ksrack", validtype=1, numericFlag=True)
+        self.key.save()
+        self.listkey = AllowedKey(key="kslist", validtype=2)
+        self.listkey.save()
+
+    ###########################################################################
+    def tearDown(self):
+        for host in self.hosts:
+            host.delete()
+        self.key.delete()
+        self.listkey.delete()
+
+    ###########################################################################
+    def stats(self, key):
+        return dict(
+            KeyStats.objects.filter(keyid=key).values_list("value", "uses")
+        )
+
+    ###########################################################################
+    def test_maintained(self):
+        kvs = [
+            KeyValue(hostid=host, keyid=self.key, value="10") for host in self.hosts
+        ]
+        for kv in kvs:
+            kv.save()
+        self.assertEqual(self.stats(self.key), {"10": 3})
+        kvs[0].value = "9"
+        kvs[0].save()
+        self.assertEqual(self.stats(self.key), {"10": 2, "9": 1})
+        kvs[0].delete()
+        self.assertEqual(self.stats(self.key), {"10": 2})
+        self.hosts[1].delete()
+        self.assertEqual(self.stats(self.key), {"10": 1})
+        self.hosts = self.hosts[2:]
+
+    ###########################################################################
+    def test_batch(self):
+        batch = KeyValueBatch()
+        for host in self.hosts:
+            batch.add(host.hostname, "ksrack", "10")
+        batch.apply()
+        self.assertEqual(self.stats(self.key), {"10": 3})
+        batch = KeyValueBatch()
+        batch.add("hostks0", "ksrack", "11", update=True)
+        batch.delete("hostks1", "ksrack")
+        batch.apply()
+        self.assertEqual(self.stats(self.key), {"10": 1, "11": 1})
+
+    ###########################################################################
+    def test_concurrent(self):
+        """Two changes adding the same new value both count"""
+        update = QuerySet.update
+        competing = []
+
+        def racingUpdate(qs, **kwargs):
+            updated = update(qs, **kwargs)
+            if qs.model is KeyStats and not competing:
+                competing.append(True)  # Another transaction gets in
+                KeyStats.adjust({(self.key.id, "12"): 1})
+            return updated
+
+        with patch.object(QuerySet, "update", racingUpdate):
+            KeyStats.adjust({(self.key.id, "12"): 1})
+        self.assertEqual(self.stats(self.key), {"12": 2})
+
+    ###########################################################################
+    def test_frequencies(self):
+        for host, value in zip(self.hosts, ("2", "10", "10")):
+            KeyValue(hostid=host, keyid=self.key, value=value).save()
+        for value in ("a", "b"):
+            KeyValue(hostid=self.hosts[0], keyid=self.listkey, value=value).save()
+        KeyValue(hostid=self.hosts[1], keyid=self.listkey, value="a").save()
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                KeyStats.frequencies(self.key),
+                ({("2", 2.0): 1, ("10", 10.0): 2}, 3),
+            )
+        self.assertEqual(
+            KeyStats.frequencies(self.listkey),
+            ({("a", None): 2, ("b", None): 1}, 2),
+        )
+        self.assertEqual(valueFrequencies(self.key), KeyStats.frequencies(self.key))
+        self.assertEqual(
+            KeyStats.hostCounts([self.key, self.listkey]),
+            {self.key.id: 3, self.listkey.id: 2},
+        )
+        self.assertEqual(
+            KeyStats.topValues([self.key.id, self.listkey.id], top=1),
+            {self.key.id: [("10", 2)], self.listkey.id: [("a", 2)]},
+        )
+
+    ###########################################################################
+    def test_rebuild(self):
+        KeyValue(hostid=self.hosts[0], keyid=self.key, value="10").save()
+        KeyStats.objects.all().delete()
+        KeyStats(keyid=self.listkey, value="stale", uses=3).save()
+        call_command("rebuild_keystats", "ksrack")
+        self.assertEqual(self.stats(self.key), {"10": 1})
+        self.assertEqual(self.stats(self.listkey), {"stale": 3})
+        call_command("rebuild_keystats")
+        self.assertEqual(self.stats(self.listkey), {})
+        with self.assertRaises(CommandError):
+            call_command("rebuild_keystats", "ksnokey")
+
+
+###############################################################################
+class test_HostIndex(TestCase):
+    def setUp(self):
+        self.host1 = Host(hostname="hostidx1", origin="here")
+        self.host1.save()
+        self.host2 = Host(hostname="hostidx2")
+        self.host2.save()
+
+    ###########################################################################
+    def tearDown(self):
+        self.host1.delete()
+        self.host2.delete()
+
+    ###########################################################################
+    def test_index(self):
+        index = HostIndex([(1, "alpha"), (5, "béta"), (7, "gamma")])
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.hostname(5), "béta")
+        self.assertEqual(index.hostname(7), "gamma")
+        self.assertIsNone(index.hostname(6))
+        self.assertTrue(1 in index)
+        self.assertFalse(8 in index)
+        self.assertEqual(list(index.ids), [1, 5, 7])
+
+    ###########################################################################
+    def test_invalidation(self):
+        index = getHostIndex()
+        self.assertEqual(index.hostname(self.host1.id), "hostidx1")
+        with self.assertNumQueries(1):
+            self.assertIs(getHostIndex(), index)
+        self.host1.hostname = "hostidx3"
+        self.host1.save()
+        self.assertEqual(getHostIndex().hostname(self.host1.id), "hostidx3")
+        hostid = self.host2.id
+        self.host2.delete()
+        self.assertFalse(hostid in getHostIndex())
+        self.host2 = Host(hostname="hostidx2")
+        self.host2.save()
+
+    ###########################################################################
+    def test_other_process(self):
+        """Changes made by another process are seen even if they don't
+        show up in our cache"""
+        index = getHostIndex()
+        Host.objects.filter(id=self.host1.id).update(hostname="hostidx4")
+        Generation.bump(HOST_GENERATION)
+        self.assertIsNot(getHostIndex(), index)
+        self.assertEqual(getHostIndex().hostname(self.host1.id), "hostidx4")
+
+    ###########################################################################
+    def test_hostlist(self):
+        getHostIndex()
+        hosts = getHostList(["hostidx1"])
+        self.assertEqual(hosts, [self.host1])
+        self.assertEqual(hosts[0].hostname, "hostidx1")
+        self.assertEqual(hosts[0].origin, "here")
+        with self.assertNumQueries(1):  # The host generation
+            self.assertEqual(len(getMatches([])), 2)
+
+
+###############################################################################
+@override_settings(HOSTINFO_VALUE_INDEX_MEMORY=1000000)
+class test_ValueIndex(TestCase):
+    def setUp(self):
+        cache.clear()
+        models._valueindex = None
+        self.key = AllowedKey(key="vios", validtype=2)
+        self.key.save()
+        self.hosts = []
+        for num, vals in enumerate((["linux"], ["linux", "bsd"], ["solaris"], [])):
+            host = Host(hostname=f"vihost{num}")
+            host.save()
+            for val in vals:
+                KeyValue(hostid=host, keyid=self.key, value=val).save()
+            self.hosts.append(host)
+        getHostIndex()
+
+    ###########################################################################
+    def ids(self, *nums):
+        return sorted(self.hosts[num].id for num in nums)
+
+    ###########################################################################
+    def matches(self, criteria):
+        return sorted(getMatches(parseQualifiers(criteria)))
+
+    ###########################################################################
+    def test_cold(self):
+        """Keys that haven't been warmed go to the database"""
+        quals = parseQualifiers(["vios=linux"])
+        with self.assertNumQueries(1):
+            self.assertEqual(sorted(getMatches(quals)), self.ids(0, 1))
+        self.assertEqual(models.getValueIndex().keys, {})
+
+    ###########################################################################
+    def test_queries(self):
+        criteria = [
+            ["vios=linux"],
+            ["vios!=linux"],
+            ["vios~ux"],
+            ["vios%ux"],
+            ["vios.defined"],
+            ["vios.undef"],
+            ["vios=linux", "vios=bsd"],
+            ["vios=linux", "vios!=bsd"],
+            ["vios=nothing"],
+            ["vios=nothing", "vios.undef"],
+            ["vios=linux", "vihost1"],
+            ["vios=linux", "vios@bsx"],
+        ]
+        expected = {}
+        with override_settings(HOSTINFO_VALUE_INDEX_MEMORY=0):
+            for crit in criteria:
+                expected[tuple(crit)] = self.matches(crit)
+        ValueIndex.publish(self.key.id)
+        for crit in criteria:
+            self.assertEqual(self.matches(crit), expected[tuple(crit)], crit)
+        quals = parseQualifiers(["vios=linux", "vios!=bsd"])
+        with self.assertNumQueries(0):
+            self.assertEqual(sorted(getMatches(quals)), self.ids(0))
+
+    ###########################################################################
+    def test_changes(self):
+        """Changes are applied to the index as they are committed"""
+        ValueIndex.publish(self.key.id)
+        self.assertEqual(self.matches(["vios=linux"]), self.ids(0, 1))
+        index = models.getValueIndex()
+        with self.captureOnCommitCallbacks(execute=True):
+            kv = KeyValue(hostid=self.hosts[3], keyid=self.key, value="linux")
+            kv.save()
+        self.assertIn(self.key.id, index.keys)
+        quals = parseQualifiers(["vios=linux"])
+        with self.assertNumQueries(0):
+            self.assertEqual(sorted(getMatches(quals)), self.ids(0, 1, 3))
+        with self.captureOnCommitCallbacks(execute=True):
+            kv.value = "hpux"
+            kv.save()
+        self.assertEqual(self.matches(["vios=linux"]), self.ids(0, 1))
+        self.assertEqual(self.matches(["vios=hpux"]), self.ids(3))
+        with self.captureOnCommitCallbacks(execute=True):
+            kv.delete()
+        self.assertEqual(self.matches(["vios=hpux"]), [])
+        self.assertEqual(self.matches(["vios.undef"]), self.ids(3))
+        self.assertIn(self.key.id, index.keys)
+
+    ###########################################################################
+    def test_other_process(self):
+        """A change made by another process causes a reload"""
+        ValueIndex.publish(self.key.id)
+        self.assertEqual(self.matches(["vios=solaris"]), self.ids(2))
+        KeyValue(hostid=self.hosts[3], keyid=self.key, value="solaris").save()
+        models.incrGeneration(models.VALUE_GENERATION % self.key.id)
+        self.assertEqual(self.matches(["vios=solaris"]), self.ids(2, 3))
+        self.assertIn(self.key.id, models.getValueIndex().keys)
+
+    ###########################################################################
+    @override_settings(HOSTINFO_VALUE_INDEX_MEMORY=10)
+    def test_budget(self):
+        """Keys that don't fit are left to the database"""
+        ValueIndex.publish(self.key.id)
+        self.assertEqual(self.matches(["vios=linux"]), self.ids(0, 1))
+        self.assertEqual(models.getValueIndex().keys, {})
+        self.assertEqual(models.getValueIndex().nbytes, 0)
+
+    ###########################################################################
+    def test_command(self):
+        call_command("warm_value_index", "vios")
+        quals = parseQualifiers(["vios.defined"])
+        with self.assertNumQueries(0):
+            self.assertEqual(sorted(getMatches(quals)), self.ids(0, 1, 2))
+        with self.assertRaises(CommandError):
+            call_command("warm_value_index", "nokey")
+
+
+###############################################################################
+@override_settings(HOSTINFO_QUERY_CACHE_TIMEOUT=60)
+class test_QueryCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        clearAKcache()
+        self.key1 = AllowedKey(key="qckey1")
+        self.key1.save()
+        self.key2 = AllowedKey(key="qckey2")
+        self.key2.save()
+        self.host = Host(hostname="qchost")
+        self.host.save()
+        self.kv = KeyValue(hostid=self.host, keyid=self.key1, value="a")
+        self.kv.save()
+        KeyValue(hostid=self.host, keyid=self.key2, value="b").save()
+
+    ###########################################################################
+    def matches(self, criteria, queries=None):
+        quals = parseQualifiers(criteria)
+        if queries is None:
+            return getMatches(quals)
+        with self.assertNumQueries(queries):
+            return getMatches(quals)
+
+    ###########################################################################
+    def test_hit(self):
+        self.assertEqual(self.matches(["qckey1=a"]), [self.host.id])
+        self.assertEqual(self.matches(["qckey1=a"], queries=0), [self.host.id])
+        self.assertEqual(queryCacheStats(), {"hits": 1, "misses": 1})
+        call_command("query_cache_stats", "--reset", stdout=StringIO())
+        self.assertEqual(queryCacheStats(), {"hits": 0, "misses": 0})
+
+    ###########################################################################
+    def test_key_invalidation(self):
+        """Changing a key only invalidates the queries that use that key"""
+        self.matches(["qckey1=a"])
+        self.matches(["qckey2=b"])
+        self.kv.value = "c"
+        self.kv.save()
+        self.assertEqual(self.matches(["qckey1=a"]), [])
+        self.assertEqual(self.matches(["qckey2=b"], queries=0), [self.host.id])
+
+    ###########################################################################
+    def test_host_invalidation(self):
+        self.assertEqual(self.matches(["qckey1.undef"]), [])
+        self.assertEqual(self.matches(["qchost"]), [self.host.id])
+        self.matches(["qckey2=b"])
+        host = Host(hostname="qchost2")
+        host.save()
+        self.assertEqual(self.matches(["qckey1.undef"]), [host.id])
+        self.assertEqual(self.matches(["qckey2=b"], queries=0), [self.host.id])
+        HostAlias(hostid=host, alias="qcalias").save()
+        self.assertEqual(self.matches(["qcalias"]), [host.id])
+        matches = sorted(self.matches(["qchost.hostre"]))
+        self.assertEqual(matches, [self.host.id, host.id])
+
+    ###########################################################################
+    def test_bypass(self):
+        self.matches(["qckey1=a"])
+        with bypassQueryCache():
+            self.assertEqual(self.matches(["qckey1=a"], queries=1), [self.host.id])
+        self.assertEqual(queryCacheStats(), {"hits": 0, "misses": 1})
+        self.client.get("/api/query/qckey1=a/?nocache=1")
+        self.client.get("/api/query/qckey1=a/", HTTP_CACHE_CONTROL="no-cache")
+        self.assertEqual(queryCacheStats(), {"hits": 0, "misses": 1})
+        self.client.get("/api/query/qckey1=a/")
+        self.assertEqual(queryCacheStats(), {"hits": 1, "misses": 1})
+
 
 ###############################################################################
 class test_getHost(TestCase):
@@ -492,6 +1088,63 @@ class test_getAK(TestCase):
             getAK("ak_badkey")
         self.assertEqual(cm.exception.msg, "Must use an existing key, not ak_badkey")
 
+    ###########################################################################
+    def test_invalidation(self):
+        """Changes to keys are seen without clearing the cache"""
+        self.assertFalse(getAK("ak_checkkey").restrictedFlag)
+        self.ak.restrictedFlag = True
+        self.ak.save()
+        self.assertTrue(getAK("ak_checkkey").restrictedFlag)
+        self.assertEqual(getRestrictedValues(self.ak.id), set())
+        rv = RestrictedValue(keyid=self.ak, value="allowed")
+        rv.save()
+        self.assertEqual(getRestrictedValues(self.ak.id), {"allowed"})
+        self.assertEqual(getRevAK()[self.ak.id], "ak_checkkey")
+        rv.delete()
+        self.assertEqual(getRestrictedValues(self.ak.id), set())
+
+    ###########################################################################
+    def test_cached(self):
+        getAK("ak_checkkey")
+        with self.assertNumQueries(0):
+            getAK("ak_checkkey")
+            getRevAK()
+            getRestrictedValues(self.ak.id)
+
+    ###########################################################################
+    def test_restricted_elsewhere(self):
+        """Restricted values added where the cache can't see are found"""
+        self.ak.restrictedFlag = True
+        self.ak.save()
+        self.assertFalse(permittedValue(self.ak.id, "newvalue"))
+        RestrictedValue.objects.bulk_create(  # No signals
+            [RestrictedValue(keyid=self.ak, value="newvalue")]
+        )
+        self.assertTrue(permittedValue(self.ak.id, "newvalue"))
+        self.assertEqual(getRestrictedValues(self.ak.id), {"newvalue"})
+        self.assertFalse(permittedValue(self.ak.id, "othervalue"))
+
+    ###########################################################################
+    def test_shared(self):
+        """Another process can load the metadata from the shared cache"""
+        getAK("ak_checkkey")
+        models._akcache = {}
+        with self.assertNumQueries(1):  # Just the generation
+            self.assertEqual(getAK("ak_checkkey"), self.ak)
+
+    ###########################################################################
+    def test_other_process(self):
+        """Changes made by another process are seen by the next request"""
+        getAK("ak_checkkey")
+        with self.assertNumQueries(0):
+            self.assertFalse(getAK("ak_checkkey").readonlyFlag)
+        # A change that doesn't send the signals here, as in another process
+        AllowedKey.objects.filter(id=self.ak.id).update(readonlyFlag=True)
+        Generation.bump(AK_GENERATION)
+        self.assertFalse(getAK("ak_checkkey").readonlyFlag)
+        expireKeyMetadata()
+        self.assertTrue(getAK("ak_checkkey").readonlyFlag)
+
 
 ###############################################################################
 class test_checkHost(TestCase):
@@ -680,6 +1333,21 @@ class test_orderhostlist(TestCase):
         out = orderHostList(self.hosts, "ohlkey2")
         self.assertEqual(out, self.hosts)
 
+    ###########################################################################
+    def test_numeric_list(self):
+        """Multiple values for a numeric key used to raise a TypeError"""
+        kv = KeyValue(hostid=self.hosts[4], keyid=self.key3, value="0.5")
+        kv.save()
+        out = orderHostList(self.hosts, "ohlkey3")
+        self.assertEqual([h.hostname for h in out], ["e", "a", "b", "c", "d"])
+        kv.delete()
+
+    ###########################################################################
+    def test_queries(self):
+        getAK("ohlkey1")
+        with self.assertNumQueries(1):
+            orderHostList(self.hosts, "-ohlkey1")
+
 
 ###############################################################################
 class test_calcKeylistVals(TestCase):
@@ -748,6 +1416,32 @@ class test_calcKeylistVals(TestCase):
         with self.assertRaises(HostinfoException):
             calcKeylistVals("badkey")
 
+    def test_valueFrequencies(self):
+        """Counted for some hosts, most of the hosts, and all of them"""
+        host3 = Host(hostname="ckvhost3")
+        host3.save()
+        KeyValue(hostid=host3, keyid=self.key2, value="baz").save()
+        for hostids, expected in (
+            ([self.host2.id], ({("baz", None): 1}, 1)),
+            ([self.host1.id, host3.id], ({("bar", None): 1, ("baz", None): 1}, 2)),
+            (None, ({("bar", None): 1, ("baz", None): 2}, 3)),
+        ):
+            self.assertEqual(valueFrequencies("ckvkey2", hostids), expected)
+        d = calcKeylistVals("ckvkey2", [self.host2.id, host3.id])
+        self.assertEqual(d["vallist"], [("baz", 2, 100.0)])
+        self.assertEqual(d["total"], 2)
+
+    def test_numeric(self):
+        key = AllowedKey(key="ckvnum", validtype=1, numericFlag=True)
+        key.save()
+        KeyValue(hostid=self.host1, keyid=key, value="10").save()
+        KeyValue(hostid=self.host2, keyid=key, value="9").save()
+        self.assertEqual(
+            valueFrequencies("ckvnum"), ({("10", 10.0): 1, ("9", 9.0): 1}, 2)
+        )
+        d = calcKeylistVals("ckvnum")
+        self.assertEqual(d["vallist"], [("9", 1, 50.0), ("10", 1, 50.0)])
+
 
 ###############################################################################
 class test_hostData(TestCase):
@@ -864,6 +1558,31 @@ class test_hostData(TestCase):
         host1.delete()
         host2.delete()
 
+    ###########################################################################
+    def test_bulk_queries(self):
+        """Number of queries shouldn't depend on the number of hosts"""
+        numqueries = []
+        for num in (0, 20):
+            for h in range(num):
+                host = Host(hostname=f"hdfbulk{h}")
+                host.save()
+                KeyValue(hostid=host, keyid=self.key1, value="bulk").save()
+                HostAlias(hostid=host, alias=f"hdfbulkalias{h}").save()
+                Links(hostid=host, url="http://localhost", tag="here").save()
+            getAK("hdfkey1")
+            with CaptureQueriesContext(connection) as ctx:
+                result = hostData(
+                    "fred", criteria=["hdfkey1.defined"], linker=getLinks
+                )
+            self.assertEqual(result["count"], num + 1)
+            numqueries.append(len(ctx.captured_queries))
+        self.assertEqual(numqueries[0], numqueries[1])
+        bulk = [h for h in result["hostlist"] if h["hostname"] == "hdfbulk3"][0]
+        self.assertEqual(bulk["aliases"], ["hdfbulkalias3"])
+        self.assertEqual(bulk["links"], [("http://localhost", "here")])
+        self.assertEqual(bulk["hostview"][0][0], "hdfkey1")
+        self.assertEqual(bulk["hostview"][0][1][0].value, "bulk")
+
 
 ###############################################################################
 class test_version(TestCase):
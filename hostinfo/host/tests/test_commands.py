@@ -17,12 +17,20 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.test import TestCase
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
 import json
 import os
+import pwd
+import socket
+import subprocess
 import sys
 import tempfile
+import threading
 import time
+import types
+from unittest.mock import patch
 
 try:
     from StringIO import StringIO
@@ -32,8 +40,13 @@ except ImportError:  # pragma: no cover
 from host.models import Host, HostAlias, AllowedKey, RestrictedValue, Links
 from host.models import HostinfoException, ReadonlyValueException
 from host.models import RestrictedValueException
-from host.models import addKeytoHost, run_from_cmdline
-from host.models import clearAKcache, KeyValue
+from host.models import addKeytoHost, run_from_cmdline, writeOutput
+from host.models import clearAKcache, getAK, KeyValue, KeyValueBatch, UndoLog
+from host.models import AK_GENERATION, Generation
+from host.cliclient import readFrame, runRemote, sendFrame, serverRunning
+from host.cliserver import CommandHandler, CommandInput, CommandServer
+from host.cliserver import peerUser, runCommand, unsharedCacheSettings
+from host.profilestartup import profileStartup
 
 
 ###############################################################################
@@ -267,6 +280,63 @@ class test_cmd_hostinfo(TestCase):
         self.assertIn("ak2: kv3", output[0])
         self.assertIn("ak1: kv2", output[0])
 
+    ###########################################################################
+    def test_hostinfo_stream(self):
+        """Output is generated a host at a time for the command line"""
+        import json
+
+        for args in (["--json", "-p", "ak1"], ["--xml"], ["--csv"], ["-p", "ak1"]):
+            namespace = self.parser.parse_args(args)
+            self.cmd.namespace = namespace
+            output, retval = self.cmd.over_handle()
+            self.assertIsInstance(output, types.GeneratorType)
+            self.assertGreaterEqual(len(list(output)), 2)
+        namespace = self.parser.parse_args(["--json", "-p", "ak1", "-p", "ak2"])
+        self.assertEqual(
+            json.loads(self.cmd.handle(namespace)[0]),
+            {"h1": {"ak1": ["kv1"], "ak2": ["kv3"]}, "h2": {"ak1": ["kv2"]}},
+        )
+
+    ###########################################################################
+    def test_printout_cache(self):
+        """The printed values of the matching hosts are read in one query"""
+        import host.commands.cmd_hostinfo as cmd_hostinfo
+
+        self.cmd.namespace = self.parser.parse_args(["--origin"])
+        fields = self.cmd.printoutFields()
+        self.assertEqual(fields, ["value", "origin"])
+        getAK("ak1")
+        for limit in (5000, 0):  # Hosts restricted in the query and not
+            with patch.object(cmd_hostinfo, "PRINTOUT_IN_LIMIT", limit):
+                with self.assertNumQueries(1):
+                    cache = self.cmd.loadPrintoutCache(
+                        ["ak1", "ak2"], [self.h2.id], fields
+                    )
+            self.assertEqual(list(cache["ak1"]), [self.h2.id])
+            self.assertEqual(cache["ak1"][self.h2.id][0].value, "kv2")
+            self.assertEqual(cache["ak1"][self.h2.id][0].origin, "bar")
+            self.assertEqual(cache["ak2"], {})
+
+    ###########################################################################
+    def test_showall_batches(self):
+        """Showall reads the values and aliases a batch of hosts at a time"""
+        Host.objects.bulk_create([Host(hostname="hb%03d" % i) for i in range(148)])
+        KeyValue.objects.bulk_create(
+            [
+                KeyValue(hostid=h, keyid=self.ak1, value="many")
+                for h in Host.objects.filter(hostname__startswith="hb")
+            ]
+        )
+        namespace = self.parser.parse_args(["--showall", "--aliases"])
+        self.cmd.handle(namespace)  # Warm the caches
+        # The host generation, the hosts, then two batches (50 and 100 hosts)
+        # of two queries each
+        with self.assertNumQueries(6):
+            output = self.cmd.handle(namespace)[0]
+        self.assertEqual(output.count("ak1: "), 150)
+        self.assertIn("    [Aliases: halias]\nh1\n    ak1: kv1", output)
+        self.assertIn("    [Aliases: ]\nhb147\n    ak1: many", output)
+
     ###########################################################################
     def test_hostinfo_count(self):
         namespace = self.parser.parse_args(["--count"])
@@ -331,6 +401,15 @@ class test_cmd_hostinfo(TestCase):
         self.assertEquals(output[0], "")
         self.assertEquals(output[1], 1)
 
+    ###########################################################################
+    def test_hostinfo_valuereport_criteria(self):
+        """Only the hosts that match the criteria are counted"""
+        namespace = self.parser.parse_args(["--valuereport", "ak1", "ak2=kv3"])
+        output = self.cmd.handle(namespace)
+        self.assertEquals(
+            output[0], "ak1 set: 1 100.00%\nak1 unset: 0 0.00%\n\nkv1 1 100.00%\n"
+        )
+
     ###########################################################################
     def test_hostinfo_valuereport_badkey(self):
         """Make sure the key exists for a valuereport - Iss06"""
@@ -812,6 +891,43 @@ class test_cmd_addvalue(TestCase):
         key.delete()
         host2.delete()
 
+    ###########################################################################
+    def test_manyhosts(self):
+        """Test that adding to lots of hosts is done in bulk"""
+        key = AllowedKey(key="key_addvalue_t3", validtype=1)
+        key.save()
+        hosts = [Host(hostname="many%03d" % i) for i in range(100)]
+        Host.objects.bulk_create(hosts)
+        HostAlias(hostid=Host.objects.get(hostname="many000"), alias="manyalias").save()
+        args = ["key_addvalue_t3=val"] + ["many%03d" % i for i in range(1, 100)]
+        namespace = self.parser.parse_args(args + ["manyalias"])
+        with self.assertNumQueries(16):
+            retval = self.cmd.handle(namespace)
+        self.assertEquals(retval, (None, 0))
+        self.assertEquals(KeyValue.objects.filter(keyid=key, value="val").count(), 100)
+        self.assertEquals(
+            UndoLog.objects.filter(action__startswith="hostinfo_deletevalue").count(),
+            100,
+        )
+
+    ###########################################################################
+    def test_manyhosts_atomic(self):
+        """Test that nothing is added if any of the hosts fail"""
+        key = AllowedKey(key="key_addvalue_t4", validtype=1)
+        key.save()
+        host2 = Host(hostname="testhost2")
+        host2.save()
+        KeyValue(hostid=host2, keyid=key, value="other").save()
+        namespace = self.parser.parse_args(
+            ["key_addvalue_t4=value", "testhost", "testhost2"]
+        )
+        with self.assertRaises(HostinfoException) as cm:
+            self.cmd.handle(namespace)
+        self.assertEquals(
+            cm.exception.msg, "testhost2:key_addvalue_t4 already has a value other"
+        )
+        self.assertEquals(KeyValue.objects.filter(hostid=self.host).count(), 0)
+
     ###########################################################################
     def test_restrictedkey(self):
         """Test that we can't add a non-allowed value to a restricted key
@@ -1112,6 +1228,35 @@ class test_cmd_deletevalue(TestCase):
         kvlist = KeyValue.objects.filter(hostid=self.h1)
         self.assertEquals(len(kvlist), 0)
 
+    ###########################################################################
+    def test_manyhosts(self):
+        """Test deleting from lots of hosts at once"""
+        hosts = [Host(hostname="dvmany%03d" % i) for i in range(50)]
+        Host.objects.bulk_create(hosts)
+        hosts = Host.objects.filter(hostname__startswith="dvmany")
+        KeyValue.objects.bulk_create(
+            [KeyValue(hostid=h, keyid=self.ak, value="gone") for h in hosts]
+        )
+        namespace = self.parser.parse_args(
+            ["key_dv"] + [h.hostname for h in hosts] + ["host_delval"]
+        )
+        with self.assertNumQueries(19):
+            output = self.cmd.handle(namespace)
+        self.assertEquals(output, (None, 0))
+        self.assertEquals(KeyValue.objects.filter(keyid=self.ak).count(), 0)
+        self.assertEquals(
+            UndoLog.objects.filter(action__startswith="hostinfo_addvalue").count(), 51
+        )
+
+    ###########################################################################
+    def test_manyhosts_atomic(self):
+        """Test that nothing is deleted if any of the hosts fail"""
+        namespace = self.parser.parse_args(["key_dv", "host_delval", "badhost"])
+        with self.assertRaises(HostinfoException) as cm:
+            self.cmd.handle(namespace)
+        self.assertEquals(cm.exception.msg, "Unknown host: badhost")
+        self.assertEquals(KeyValue.objects.filter(keyid=self.ak).count(), 1)
+
     ###########################################################################
     def test_badhost(self):
         """Test deleting from a host that doesn't exists"""
@@ -1373,6 +1518,216 @@ class test_cmd_import(TestCase):
         key.delete()
         newkey.delete()
 
+    ###########################################################################
+    def writeXML(self, xml):
+        tmpf = tempfile.NamedTemporaryFile(delete=False, suffix=".xml")
+        tmpf.write(xml)
+        tmpf.close()
+        self.addCleanup(os.unlink, tmpf.name)
+        return tmpf.name
+
+    ###########################################################################
+    def manyHosts(self, prefix, num):
+        hosts = [
+            b"""<host> <hostname>%s%02d</hostname> <aliaslist>
+            <alias>%s%02d-alias</alias> </aliaslist> <data>
+            <confitem key="imanykey" origin="src">v%d</confitem>
+            <confitem key="imanylist">a</confitem>
+            <confitem key="imanylist">b</confitem> </data> </host>"""
+            % (prefix, i, prefix, i, i % 3)
+            for i in range(num)
+        ]
+        return self.writeXML(
+            b"""<hostinfo> <key> <name>imanykey</name> <type>single</type> </key>
+            <key> <name>imanylist</name> <type>list</type> </key>
+            %s </hostinfo>"""
+            % b"".join(hosts)
+        )
+
+    ###########################################################################
+    def test_bulk_import(self):
+        """Test that the hosts are imported in bulk"""
+        fname = self.manyHosts(b"ibulk", 40)
+        namespace = self.parser.parse_args([fname])
+        with self.assertNumQueries(46):
+            self.assertEqual(self.cmd.handle(namespace), (None, 0))
+        hosts = Host.objects.filter(hostname__startswith="ibulk")
+        self.assertEqual(hosts.count(), 40)
+        self.assertEqual(Host.history.filter(hostname__startswith="ibulk").count(), 40)
+        alias = HostAlias.objects.get(alias="ibulk07-alias")
+        self.assertEqual(alias.hostid.hostname, "ibulk07")
+        kv = KeyValue.objects.get(hostid__hostname="ibulk05", keyid__key="imanykey")
+        self.assertEqual((kv.value, kv.origin), ("v2", "src"))
+        self.assertEqual(KeyValue.objects.filter(keyid__key="imanylist").count(), 80)
+        self.assertEqual(
+            UndoLog.objects.filter(action__startswith="hostinfo_deletehost").count(),
+            40,
+        )
+
+        # Importing it again only changes what is different
+        kv.value = "changed"
+        kv.save()
+        with patch("sys.stderr", new=StringIO()) as errout:
+            self.cmd.handle(self.parser.parse_args(["-v", fname]))
+        self.assertIn("Replacing ibulk05: imanykey=v2", errout.getvalue())
+        self.assertNotIn("Appending", errout.getvalue())
+        self.assertNotIn("New host", errout.getvalue())
+        self.assertEqual(Host.objects.filter(hostname__startswith="ibulk").count(), 40)
+
+    ###########################################################################
+    def test_batches(self):
+        """Test importing a few hosts at a time"""
+        fname = self.manyHosts(b"ibatch", 5)
+        namespace = self.parser.parse_args(["--batch", "2", "--progress", fname])
+        with patch("sys.stderr", new=StringIO()) as errout:
+            self.cmd.handle(namespace)
+        progress = [line.split()[1] for line in errout.getvalue().splitlines()]
+        self.assertEqual(progress, ["2", "4", "5"])
+        self.assertEqual(Host.objects.filter(hostname__startswith="ibatch").count(), 5)
+
+    ###########################################################################
+    def test_checkpoint(self):
+        """Test carrying on from where an earlier import got to"""
+        fname = self.manyHosts(b"ickpt", 5)
+        checkpoint = fname + ".ckpt"
+        with open(checkpoint, "w") as cpfh:
+            json.dump({"xmlfile": os.path.abspath(fname), "hosts": 3}, cpfh)
+        namespace = self.parser.parse_args(["--checkpoint", checkpoint, fname])
+        self.cmd.handle(namespace)
+        hosts = Host.objects.filter(hostname__startswith="ickpt")
+        self.assertEqual(
+            sorted(hosts.values_list("hostname", flat=True)), ["ickpt03", "ickpt04"]
+        )
+        self.assertFalse(os.path.exists(checkpoint))
+
+    ###########################################################################
+    def test_checkpoint_written(self):
+        """Test that the checkpoint is written after each batch"""
+        fname = self.manyHosts(b"ickwr", 3)
+        checkpoint = fname + ".ckpt"
+        self.addCleanup(lambda: os.path.exists(checkpoint) and os.unlink(checkpoint))
+        namespace = self.parser.parse_args(
+            ["--batch", "2", "--checkpoint", checkpoint, fname]
+        )
+        states = []
+        original = self.cmd.writeCheckpoint
+
+        def record():
+            original()
+            with open(checkpoint) as cpfh:
+                states.append(json.load(cpfh)["hosts"])
+
+        with patch.object(self.cmd, "writeCheckpoint", record):
+            self.cmd.handle(namespace)
+        self.assertEqual(states, [2, 3])
+
+    ###########################################################################
+    def test_checkpoint_otherfile(self):
+        fname = self.manyHosts(b"ickof", 1)
+        checkpoint = fname + ".ckpt"
+        self.addCleanup(os.unlink, checkpoint)
+        with open(checkpoint, "w") as cpfh:
+            json.dump({"xmlfile": "/elsewhere.xml", "hosts": 3}, cpfh)
+        namespace = self.parser.parse_args(["--checkpoint", checkpoint, fname])
+        with self.assertRaises(HostinfoException) as cm:
+            self.cmd.handle(namespace)
+        self.assertEqual(
+            cm.exception.msg, "Checkpoint %s is for /elsewhere.xml" % checkpoint
+        )
+
+    ###########################################################################
+    def test_kidding(self):
+        fname = self.manyHosts(b"ikid", 2)
+        AllowedKey(key="imanykey", validtype=1).save()
+        AllowedKey(key="imanylist", validtype=2).save()
+        Host(hostname="ikid00").save()
+        namespace = self.parser.parse_args(["-k", "-v", fname])
+        with patch("sys.stderr", new=StringIO()) as errout:
+            self.cmd.handle(namespace)
+        self.assertIn("Creating ikid00: imanykey=v0", errout.getvalue())
+        self.assertIn("Creating ikid01: imanykey=v1", errout.getvalue())
+        self.assertFalse(Host.objects.filter(hostname="ikid01").exists())
+        self.assertFalse(HostAlias.objects.filter(alias__startswith="ikid").exists())
+        self.assertFalse(KeyValue.objects.filter(hostid__hostname="ikid00").exists())
+
+    ###########################################################################
+    def test_bad_values(self):
+        """Test that values that can't be set are skipped"""
+        key = AllowedKey(key="ibadrest", validtype=1, restrictedFlag=True)
+        key.save()
+        other = Host(hostname="ibadother")
+        other.save()
+        HostAlias(hostid=other, alias="ibadalias").save()
+        fname = self.writeXML(
+            b"""<hostinfo> <host> <hostname>ibadhost</hostname>
+            <aliaslist> <alias>ibadalias</alias> </aliaslist> <data>
+            <confitem key="ibadrest">nope</confitem>
+            <confitem key="ibadnokey">val</confitem> </data> </host>
+            <host> <hostname>ibadhost2</hostname> </host> </hostinfo>"""
+        )
+        namespace = self.parser.parse_args([fname])
+        with patch("sys.stderr", new=StringIO()) as errout:
+            self.assertEqual(self.cmd.handle(namespace), (None, 1))
+        self.assertEqual(
+            errout.getvalue().splitlines(),
+            [
+                "Alias ibadalias of ibadhost is already used by ibadother - ignoring",
+                "Trying to change a restricted value: ibadhost:ibadrest=nope"
+                " - ignoring",
+                "Couldn't set ibadhost:ibadnokey=val: "
+                "Must use an existing key, not ibadnokey - ignoring",
+            ],
+        )
+        self.assertTrue(Host.objects.filter(hostname="ibadhost2").exists())
+
+    ###########################################################################
+    def test_second_pass_failures(self):
+        """Values that fail once the others have been skipped are reported"""
+        fname = self.manyHosts(b"ipass", 2)
+        apply = KeyValueBatch.apply
+        calls = []
+
+        def failingApply(batch, write=True):
+            results = apply(batch, write)
+            calls.append(len(results))
+            if len(calls) == 1:
+                results[0] = HostinfoException("First failure")
+            elif len(calls) == 2:
+                results[0] = HostinfoException("Second failure")
+            return results
+
+        namespace = self.parser.parse_args([fname])
+        with patch("sys.stderr", new=StringIO()) as errout:
+            with patch.object(KeyValueBatch, "apply", failingApply):
+                self.assertEqual(self.cmd.handle(namespace), (None, 1))
+        errors = errout.getvalue().splitlines()
+        self.assertEqual(len(errors), 2)
+        self.assertIn("First failure - ignoring", errors[0])
+        self.assertIn("Second failure - ignoring", errors[1])
+        self.assertEqual(calls, [6, 5, 4])
+        self.assertEqual(KeyValue.objects.filter(hostid__hostname="ipass01").count(), 3)
+
+    ###########################################################################
+    def test_badxml(self):
+        fname = self.writeXML(b"<hostinfo><host></hostinfo>")
+        namespace = self.parser.parse_args([fname])
+        with self.assertRaises(HostinfoException) as cm:
+            self.cmd.handle(namespace)
+        self.assertTrue(cm.exception.msg.startswith("Couldn't parse %s:" % fname))
+
+    ###########################################################################
+    def test_keytype_change(self):
+        AllowedKey(key="ikeytype", validtype=1).save()
+        fname = self.writeXML(
+            b"<hostinfo><key><name>ikeytype</name><type>list</type></key></hostinfo>"
+        )
+        namespace = self.parser.parse_args([fname])
+        with self.assertRaises(HostinfoException) as cm:
+            self.cmd.handle(namespace)
+        self.assertEqual(
+            cm.exception.msg, "Changing key types currently unsupported: ikeytype"
+        )
+
 
 ###############################################################################
 class test_cmd_listalias(TestCase):
@@ -1873,5 +2228,217 @@ class test_run_from_cmdline(TestCase):
         errout = sys.stderr.getvalue()
         self.assertIn("No such hostinfo command notexists", errout)
 
+    ###########################################################################
+    def test_writeoutput(self):
+        """Streamed output is printed the same as a string would be"""
+        for chunks in (
+            ["  \n", " a", "\n", "b \n", " ", "\n\n"],
+            ["\n\n"],
+            ["x"],
+            ["", "a\tb\t", "\t"],
+        ):
+            out = StringIO()
+            writeOutput(iter(chunks), out)
+            expected = StringIO()
+            writeOutput("".join(chunks), expected)
+            self.assertEqual(out.getvalue(), expected.getvalue())
+        out = StringIO()
+        writeOutput(iter([]), out)
+        writeOutput(None, out)
+        self.assertEqual(out.getvalue(), "")
+
+
+###############################################################################
+class test_cliserver(TestCase):
+    ###########################################################################
+    def setUp(self):
+        clearAKcache()
+        self.client, self.server = socket.socketpair()
+        self.host = Host(hostname="clihost")
+        self.host.save()
+        self.ak = AllowedKey(key="clikey", validtype=1)
+        self.ak.save()
+
+    ###########################################################################
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    ###########################################################################
+    def replies(self):
+        self.server.close()
+        msgs = []
+        while True:
+            msg = readFrame(self.client)
+            if msg is None:
+                return msgs
+            msgs.append(msg)
+
+    ###########################################################################
+    def runLocal(self, argv):
+        oldargv, oldout, olderr = sys.argv, sys.stdout, sys.stderr
+        sys.argv, sys.stdout, sys.stderr = argv, StringIO(), StringIO()
+        try:
+            retval = run_from_cmdline()
+            return sys.stdout.getvalue(), sys.stderr.getvalue(), retval
+        finally:
+            sys.argv, sys.stdout, sys.stderr = oldargv, oldout, olderr
+
+    ###########################################################################
+    def test_sameoutput(self):
+        """Output is the same as running the command directly"""
+        KeyValue(hostid=self.host, keyid=self.ak, value="v1").save()
+        argv = ["/usr/local/bin/hostinfo", "--showall", "clikey=v1"]
+        local = self.runLocal(argv)
+        retval = runCommand(self.server, {"argv": argv}, "someone")
+        msgs = self.replies()
+        out = "".join(m["stdout"] for m in msgs if "stdout" in m)
+        err = "".join(m["stderr"] for m in msgs if "stderr" in m)
+        self.assertEqual((out, err, retval), local)
+        self.assertIn("clihost", out)
+
+    ###########################################################################
+    def test_errors(self):
+        """Errors and exit codes are passed back"""
+        argv = ["hostinfo_addvalue", "clikey=1", "nohost"]
+        self.assertEqual(runCommand(self.server, {"argv": argv}, "someone"), 1)
+        retval = runCommand(self.server, {"argv": ["hostinfo_addvalue"]}, "someone")
+        self.assertEqual(retval, 2)
+        msgs = self.replies()
+        self.assertEqual(msgs[0], {"stderr": "Unknown host: nohost\n"})
+        self.assertIn("usage: hostinfo_addvalue", msgs[1]["stderr"])
+
+    ###########################################################################
+    def test_user(self):
+        """Changes are done as the client's user"""
+        argv = ["hostinfo_addvalue", "clikey=v2", "clihost"]
+        self.assertEqual(runCommand(self.server, {"argv": argv}, "fred"), 0)
+        undo = UndoLog.objects.get(action__startswith="hostinfo_deletevalue")
+        self.assertEqual(undo.user, "fred")
+        self.assertEqual(KeyValue.objects.get(keyid=self.ak).value, "v2")
+        argv = ["hostinfo_addhost", "clihost2"]
+        self.assertEqual(runCommand(self.server, {"argv": argv}, "fred"), 0)
+        self.assertEqual(Host.objects.get(hostname="clihost2").origin, "fred")
+        argv = ["hostinfo_undolog"]
+        self.assertEqual(runCommand(self.server, {"argv": argv}, "fred"), 0)
+        out = "".join(m.get("stdout", "") for m in self.replies())
+        self.assertIn("hostinfo_deletehost --lethal clihost2", out)
+
+    ###########################################################################
+    def test_peer_user(self):
+        """The user comes from the socket, not from what the client says"""
+        me = pwd.getpwuid(os.getuid()).pw_name
+        self.assertEqual(peerUser(self.server), me)
+        argv = ["hostinfo_addvalue", "clikey=v3", "clihost"]
+        sendFrame(self.client, {"argv": argv, "user": "mallory"})
+        CommandHandler(self.server, None, types.SimpleNamespace(clienttimeout=5))
+        self.assertEqual(self.replies(), [{"exit": 0}])
+        undo = UndoLog.objects.get(action__startswith="hostinfo_deletevalue")
+        self.assertEqual(undo.user, me[:20])
+
+    ###########################################################################
+    def test_other_process(self):
+        """Each command sees key changes made by other processes"""
+        getAK("clikey")
+        # Without the signals here, as in another process
+        AllowedKey.objects.filter(id=self.ak.id).update(readonlyFlag=True)
+        Generation.bump(AK_GENERATION)
+        argv = ["hostinfo_addvalue", "clikey=v4", "clihost"]
+        sendFrame(self.client, {"argv": argv})
+        CommandHandler(self.server, None, types.SimpleNamespace(clienttimeout=5))
+        self.assertEqual(self.replies()[-1], {"exit": 3})  # Readonly
+        self.assertFalse(KeyValue.objects.filter(keyid=self.ak).exists())
+
+    ###########################################################################
+    def test_shared_cache(self):
+        """Settings that need a shared cache stop the server starting"""
+        with override_settings(HOSTINFO_QUERY_CACHE_TIMEOUT=60):
+            self.assertEqual(
+                unsharedCacheSettings(), ["HOSTINFO_QUERY_CACHE_TIMEOUT"]
+            )
+            with self.assertRaises(CommandError):
+                call_command("cli_server", "--socket", "/nonexistent/cli.sock")
+        self.assertEqual(unsharedCacheSettings(), [])
+
+    ###########################################################################
+    def test_local(self):
+        """Commands that use the client's files are sent back to it"""
+        sendFrame(self.client, {"argv": ["/usr/bin/hostinfo_import", "/etc/shadow"]})
+        CommandHandler(self.server, None, types.SimpleNamespace(clienttimeout=5))
+        self.assertEqual(self.replies(), [{"local": True}])
+
+    ###########################################################################
+    def test_timeout(self):
+        """Clients that don't answer are dropped"""
+        server = types.SimpleNamespace(clienttimeout=0.1)
+        CommandHandler(self.server, None, server)  # Never sends a command
+        self.server.settimeout(0.1)
+        with self.assertRaises(OSError):
+            CommandInput(self.server).read()
+
+    ###########################################################################
+    def test_stdin(self):
+        """Stdin is only fetched from the client if it is read"""
+        sendFrame(self.client, {"stdin": "line1\nline2\n"})
+        stdin = CommandInput(self.server)
+        self.assertEqual(stdin.readline(), "line1\n")
+        self.assertEqual(stdin.read(), "line2\n")
+        self.assertEqual(self.replies(), [{"stdin": True}])
+
+    ###########################################################################
+    def test_server(self):
+        """Commands are run through the socket, and locally without it"""
+        path = os.path.join(tempfile.mkdtemp(), "cli.sock")
+        self.assertIsNone(runRemote(["hostinfo"], path))
+        server = CommandServer(path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        # The client runs in its own process as it would for real
+        client = (
+            "import sys; from host.cliclient import runRemote; "
+            "sys.exit(runRemote(['notexists'], sys.argv[1]))"
+        )
+        try:
+            self.assertTrue(serverRunning(path))
+            proc = subprocess.run(
+                [sys.executable, "-c", client, path],
+                cwd=os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+                capture_output=True,
+                text=True,
+            )
+            self.assertEqual(proc.returncode, 255)
+            self.assertEqual(proc.stderr, "No such hostinfo command notexists\n")
+            self.assertIsNone(runRemote(["hostinfo_import", "file.xml"], path))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertFalse(os.path.exists(path))
+
+
+###############################################################################
+class test_startup(TestCase):
+    ###########################################################################
+    def test_cli_settings(self):
+        """The commands don't load the web parts of django"""
+        from hostinfo import cli_settings
+
+        self.assertIn("host", cli_settings.INSTALLED_APPS)
+        self.assertNotIn("debug_toolbar", cli_settings.INSTALLED_APPS)
+        self.assertNotIn("django.contrib.admin", cli_settings.INSTALLED_APPS)
+
+    ###########################################################################
+    def test_profile_startup(self):
+        olderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            retval = profileStartup(["-c", "import json"])
+            output = sys.stderr.getvalue()
+        finally:
+            sys.stderr = olderr
+        self.assertEqual(retval, 0)
+        self.assertIn("  json\n", output)
+        self.assertIn("Total time", output)
+
 
 # EOF
@@ -19,12 +19,15 @@
 
 import json
 
-from django.test import TestCase
-from django.test.client import Client
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.test.client import Client, RequestFactory
 
 from host.models import Host, HostAlias, AllowedKey, RestrictedValue, Links
-from host.models import clearAKcache
+from host.models import clearAKcache, getMatches, parseQualifiers, UndoLog
 from host.models import addKeytoHost, KeyValue
+from host.rest_views import HostBulkSerialize, HostSerialize
 
 
 ###############################################################################
@@ -70,6 +73,64 @@ class test_restHost_keylist(TestCase):
         self.assertEqual(ans["vallist"], [["val", 1, 100.0]])
 
 
+###############################################################################
+class test_restKeyStats(TestCase):
+    """ Top values of keys through REST """
+    def setUp(self):
+        clearAKcache()
+        self.client = Client()
+        self.hosts = [Host(hostname="hostrks%d" % i) for i in range(3)]
+        for host in self.hosts:
+            host.save()
+        self.key = AllowedKey(key="rkskey", validtype=1)
+        self.key.save()
+        self.key2 = AllowedKey(key="rkskey2", validtype=1)
+        self.key2.save()
+        for host, value in zip(self.hosts, ("a", "b", "b")):
+            KeyValue(hostid=host, keyid=self.key, value=value).save()
+
+    ###########################################################################
+    def tearDown(self):
+        for host in self.hosts:
+            host.delete()
+        self.key.delete()
+        self.key2.delete()
+
+    ###########################################################################
+    def test_key(self):
+        response = self.client.get("/api/keystats/rkskey/?top=1")
+        self.assertEqual(response.status_code, 200)
+        ans = json.loads(response.content.decode())
+        self.assertEqual(ans["result"], "ok")
+        self.assertEqual(ans["total"], 3)
+        self.assertEqual(len(ans["keys"]), 1)
+        self.assertEqual(ans["keys"][0]["key"], "rkskey")
+        self.assertEqual(ans["keys"][0]["numdef"], 3)
+        self.assertEqual(ans["keys"][0]["values"], [{"value": "b", "count": 2}])
+        response = self.client.get(f"/api/keystats/{self.key.id}/")
+        ans = json.loads(response.content.decode())
+        self.assertEqual(
+            ans["keys"][0]["values"],
+            [{"value": "b", "count": 2}, {"value": "a", "count": 1}],
+        )
+
+    ###########################################################################
+    def test_allkeys(self):
+        with self.assertNumQueries(4):
+            response = self.client.get("/api/keystats/")
+        ans = json.loads(response.content.decode())
+        keys = {k["key"]: k for k in ans["keys"]}
+        self.assertEqual(keys["rkskey2"]["numdef"], 0)
+        self.assertEqual(keys["rkskey2"]["numundef"], 3)
+        self.assertEqual(keys["rkskey2"]["values"], [])
+        self.assertEqual(len(keys["rkskey"]["values"]), 2)
+
+    ###########################################################################
+    def test_badtop(self):
+        response = self.client.get("/api/keystats/rkskey/?top=lots")
+        self.assertEqual(response.status_code, 406)
+
+
 ###############################################################################
 class test_restHost_query(TestCase):
     """ Query through REST interface """
@@ -166,6 +227,435 @@ class test_restHost_query(TestCase):
         self.assertIn("badkey", ans["error"])
 
 
+###############################################################################
+class test_bulkSerialize(TestCase):
+    """HostBulkSerialize must give the same answer as HostSerialize"""
+
+    def setUp(self):
+        clearAKcache()
+        self.request = RequestFactory().get("/api/query/rbkey.defined/")
+        self.key = AllowedKey(key="rbkey", validtype=2)
+        self.key.save()
+        self.key2 = AllowedKey(key="rbkey2", validtype=1)
+        self.key2.save()
+        for num, hostname in enumerate(["rbhost", "rb:h~ost", "rbhôst"]):
+            host = Host(hostname=hostname, origin=f"origin{num}")
+            host.save()
+            for val in range(num + 1):
+                KeyValue(hostid=host, keyid=self.key, value=f"v{val}").save()
+            KeyValue(hostid=host, keyid=self.key2, value="single").save()
+            HostAlias(hostid=host, alias=f"{hostname}alias").save()
+            Links(hostid=host, url=f"http://{num}", tag=f"tag{num}").save()
+
+    ###########################################################################
+    def test_same(self):
+        hosts = Host.objects.all()
+        for sargs in (
+            {},
+            {"keys": ["*"]},
+            {"keys": ["rbkey2"], "origin": True},
+            {"aliases": True, "links": True, "dates": True},
+        ):
+            expected = [HostSerialize(host, self.request, **sargs) for host in hosts]
+            self.assertEqual(
+                HostBulkSerialize(hosts, self.request, **sargs), expected, sargs
+            )
+
+    ###########################################################################
+    def test_queries(self):
+        hosts = list(Host.objects.all())
+        sargs = {"keys": ["*"], "aliases": True, "links": True}
+        HostBulkSerialize(hosts, self.request, **sargs)
+        with self.assertNumQueries(3):
+            HostBulkSerialize(hosts, self.request, **sargs)
+
+    ###########################################################################
+    def test_query(self):
+        response = self.client.get("/api/query/rbkey.defined/?keys=rbkey")
+        ans = json.loads(response.content.decode())
+        self.assertEqual(ans["result"], "3 matching hosts")
+        self.assertEqual(
+            [h["hostname"] for h in ans["hosts"]], ["rb:h~ost", "rbhost", "rbhôst"]
+        )
+        self.assertEqual(len(ans["hosts"][2]["keyvalues"]["rbkey"]), 3)
+        hostid = Host.objects.get(hostname="rbhôst").id
+        self.assertTrue(ans["hosts"][2]["url"].endswith(f"/api/host/{hostid}/"))
+
+
+###############################################################################
+class test_restPaging(TestCase):
+    """Keyset pagination of the host lists"""
+
+    def setUp(self):
+        clearAKcache()
+        self.key = AllowedKey(key="rpkey", validtype=1)
+        self.key.save()
+        self.hosts = []
+        for num in range(5):
+            host = Host(hostname=f"rphost{4 - num}")
+            host.save()
+            KeyValue(hostid=host, keyid=self.key, value=f"{num % 2}").save()
+            self.hosts.append(host)
+
+    ###########################################################################
+    def walk(self, url):
+        """Follow the next links, return the hostnames and number of pages"""
+        hostnames = []
+        pages = 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ans = json.loads(response.content.decode())
+            self.assertEqual(ans["result"].split()[0], str(len(ans["hosts"])))
+            hostnames.extend(h["hostname"] for h in ans["hosts"])
+            url = ans["next"]
+            pages += 1
+        return hostnames, pages
+
+    ###########################################################################
+    def test_hostlist(self):
+        hostnames, pages = self.walk("/api/host/?limit=2")
+        self.assertEqual(hostnames, [h.hostname for h in self.hosts])
+        self.assertEqual(pages, 3)
+        hostnames, pages = self.walk("/api/host/?limit=5")
+        self.assertEqual(len(hostnames), 5)
+        self.assertEqual(pages, 1)
+        hostnames, _ = self.walk(f"/api/host/?limit=2&after={self.hosts[3].id}")
+        self.assertEqual(hostnames, ["rphost0"])
+
+    ###########################################################################
+    def test_unpaginated(self):
+        response = self.client.get("/api/host/")
+        ans = json.loads(response.content.decode())
+        self.assertEqual(ans["result"], "5 hosts")
+        self.assertEqual(ans["hosts"][0]["hostname"], "rphost0")
+        self.assertNotIn("next", ans)
+
+    ###########################################################################
+    def test_query(self):
+        hostnames, pages = self.walk("/api/query/rpkey=0/?limit=1&keys=rpkey")
+        self.assertEqual(hostnames, ["rphost4", "rphost2", "rphost0"])
+        self.assertEqual(pages, 3)
+        response = self.client.get("/api/query/rpkey=0/?limit=1&keys=rpkey")
+        ans = json.loads(response.content.decode())
+        self.assertIn("keys=rpkey", ans["next"])
+        self.assertEqual(ans["hosts"][0]["keyvalues"]["rpkey"][0]["value"], "0")
+
+    ###########################################################################
+    def stream(self, url, **extra):
+        response = self.client.get(url, **extra)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        body = b"".join(response.streaming_content).decode()
+        return response, [json.loads(line) for line in body.splitlines()]
+
+    ###########################################################################
+    def test_stream(self):
+        """Streamed hosts are the same as the ones in the JSON document"""
+        url = "/api/query/rpkey=0/?keys=*&dates=1"
+        ans = json.loads(self.client.get(url).content.decode())
+        _, hosts = self.stream(url + "&stream=1")
+        self.assertEqual(hosts, ans["hosts"])
+        _, hosts = self.stream(url, HTTP_ACCEPT="application/x-ndjson")
+        self.assertEqual(hosts, ans["hosts"])
+        _, hosts = self.stream("/api/host/?stream=1")
+        self.assertEqual([h["hostname"] for h in hosts][:2], ["rphost0", "rphost1"])
+        self.assertEqual(len(hosts), 5)
+
+    ###########################################################################
+    def test_stream_pages(self):
+        response, hosts = self.stream("/api/host/?stream=1&limit=3")
+        hostnames = [h["hostname"] for h in hosts]
+        self.assertEqual(hostnames, ["rphost4", "rphost3", "rphost2"])
+        after = self.hosts[2].id
+        self.assertIn(f"after={after}", response["Link"])
+        self.assertTrue(response["Link"].endswith('>; rel="next"'))
+        response, hosts = self.stream(f"/api/host/?stream=1&limit=3&after={after}")
+        self.assertEqual(len(hosts), 2)
+        self.assertFalse(response.has_header("Link"))
+
+    ###########################################################################
+    def test_bad_limit(self):
+        response = self.client.get("/api/host/?limit=lots")
+        self.assertEqual(response.status_code, 406)
+        response = self.client.get("/api/query/rpkey=0/?after=x")
+        self.assertEqual(response.status_code, 406)
+
+
+###############################################################################
+@override_settings(HOSTINFO_CONDITIONAL_REQUESTS=True)
+class test_restConditional(TestCase):
+    """ETag and Last-Modified on the read APIs"""
+
+    def setUp(self):
+        clearAKcache()
+        self.host = Host(hostname="rchost")
+        self.host.save()
+        self.key = AllowedKey(key="rckey", validtype=1)
+        self.key.save()
+        self.kv = KeyValue(hostid=self.host, keyid=self.key, value="val")
+        self.kv.save()
+
+    ###########################################################################
+    def test_not_modified(self):
+        for url in (
+            "/api/host/rchost/",
+            "/api/host/",
+            "/api/query/rckey=val/",
+            "/api/keylist/rckey/",
+        ):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response["ETag"]
+            self.assertTrue(response.has_header("Last-Modified"))
+            with self.assertNumQueries(0):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304, url)
+
+    ###########################################################################
+    def test_changed(self):
+        url = "/api/query/rckey=val/"
+        etag = self.client.get(url)["ETag"]
+        self.kv.value = "other"
+        self.kv.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        ans = json.loads(response.content.decode())
+        self.assertEqual(ans["hosts"], [])
+
+    ###########################################################################
+    def test_stream(self):
+        """The streamed and plain responses have different ETags"""
+        url = "/api/query/rckey=val/"
+        etag = self.client.get(url)["ETag"]
+        response = self.client.get(url + "?stream=1", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertIn("Accept", response["Vary"])
+
+    ###########################################################################
+    @override_settings(HOSTINFO_CONDITIONAL_REQUESTS=False)
+    def test_disabled(self):
+        """Without a shared cache nothing is sent"""
+        response = self.client.get("/api/query/rckey=val/")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header("ETag"))
+        self.assertFalse(response.has_header("Last-Modified"))
+
+
+###############################################################################
+class test_restBatch(TestCase):
+    """Many changes in one request"""
+
+    def setUp(self):
+        clearAKcache()
+        self.single = AllowedKey(key="rbsingle", validtype=1)
+        self.single.save()
+        self.list = AllowedKey(key="rblist", validtype=2)
+        self.list.save()
+        self.restr = AllowedKey(key="rbrestr", validtype=1, restrictedFlag=True)
+        self.restr.save()
+        RestrictedValue(keyid=self.restr, value="good").save()
+        self.ro = AllowedKey(key="rbro", validtype=1, readonlyFlag=True)
+        self.ro.save()
+        self.hosts = []
+        for num in range(4):
+            host = Host(hostname=f"rbh{num}")
+            host.save()
+            self.hosts.append(host)
+        KeyValue(hostid=self.hosts[0], keyid=self.single, value="old").save()
+        HostAlias(hostid=self.hosts[1], alias="rbalias").save()
+
+    ###########################################################################
+    def batch(self, ops, status=200):
+        response = self.client.post(
+            "/api/batch/", json.dumps(ops), content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status)
+        return json.loads(response.content.decode())
+
+    ###########################################################################
+    def values(self, key):
+        kvs = KeyValue.objects.filter(keyid=key).order_by("hostid__hostname", "value")
+        return [(kv.hostid.hostname, kv.value) for kv in kvs]
+
+    ###########################################################################
+    def test_batch(self):
+        undos = UndoLog.objects.count()
+        ans = self.batch(
+            [
+                {"op": "update", "host": "rbh0", "key": "rbsingle", "value": "New"},
+                {"op": "add", "host": "rbalias", "key": "rbsingle", "value": "b"},
+                {"op": "add", "host": "rbh2", "key": "rbsingle", "value": "c"},
+                {"op": "add", "host": "rbh0", "key": "rbsingle", "value": "new"},
+                {"op": "append", "host": "rbh0", "key": "rblist", "value": "x"},
+                {"op": "append", "host": "rbh0", "key": "rblist", "value": "y"},
+                {"op": "append", "host": "rbh0", "key": "rblist", "value": "y"},
+                {"op": "add", "host": "rbh3", "key": "rbrestr", "value": "good"},
+                {"op": "add", "host": "rbh3", "alias": "rbalias3"},
+                {"op": "add", "host": "rbh3", "link": "doc", "url": "http://a"},
+                {"op": "update", "host": "rbh3", "link": "doc", "url": "http://b"},
+            ]
+        )
+        self.assertEqual(ans["result"], "ok")
+        self.assertEqual(
+            ans["statuses"],
+            [
+                "updated",
+                "created",
+                "created",
+                "duplicate",
+                "created",
+                "appended",
+                "duplicate",
+                "created",
+                "created",
+                "created",
+                "updated",
+            ],
+        )
+        self.assertEqual(
+            self.values(self.single),
+            [("rbh0", "new"), ("rbh1", "b"), ("rbh2", "c")],
+        )
+        self.assertEqual(self.values(self.list), [("rbh0", "x"), ("rbh0", "y")])
+        self.assertEqual(self.values(self.restr), [("rbh3", "good")])
+        self.assertEqual(HostAlias.objects.get(alias="rbalias3").hostid, self.hosts[3])
+        self.assertEqual(Links.objects.get(tag="doc").url, "http://b")
+        self.assertEqual(UndoLog.objects.count(), undos + 6)
+        self.assertTrue(
+            UndoLog.objects.filter(
+                action="hostinfo_replacevalue rbsingle=new old rbh0"
+            ).exists()
+        )
+        kv = KeyValue.objects.get(hostid=self.hosts[0], keyid=self.single)
+        self.assertEqual([h.history_type for h in kv.history.all()], ["~", "+"])
+        self.assertEqual(kv.history.first().value, "new")
+        self.assertEqual(
+            KeyValue.objects.get(hostid=self.hosts[2]).history.first().history_type, "+"
+        )
+
+    ###########################################################################
+    def test_delete(self):
+        KeyValue(hostid=self.hosts[1], keyid=self.list, value="x").save()
+        KeyValue(hostid=self.hosts[1], keyid=self.list, value="y").save()
+        kvid = KeyValue.objects.get(hostid=self.hosts[0], keyid=self.single).id
+        ans = self.batch(
+            [
+                {"op": "delete", "host": "rbh0", "key": "rbsingle"},
+                {"op": "delete", "host": "rbh1", "key": "rblist", "value": "x"},
+                {"op": "add", "host": "rbh2", "key": "rbsingle", "value": "z"},
+                {"op": "delete", "host": "rbh2", "key": "rbsingle", "value": "z"},
+                {"op": "delete", "host": "rbh1", "alias": "rbalias"},
+            ]
+        )
+        self.assertEqual(
+            ans["statuses"], ["deleted", "deleted", "created", "deleted", "deleted"]
+        )
+        self.assertEqual(self.values(self.single), [])
+        self.assertEqual(self.values(self.list), [("rbh1", "y")])
+        self.assertFalse(HostAlias.objects.filter(alias="rbalias").exists())
+        history = KeyValue.history.filter(id=kvid).order_by("-history_id")
+        self.assertEqual([h.history_type for h in history], ["-", "+"])
+        self.assertEqual(history[0].value, "old")
+
+    ###########################################################################
+    def test_failure(self):
+        """Nothing is changed if anything fails"""
+        ans = self.batch(
+            [
+                {"op": "update", "host": "rbh0", "key": "rbsingle", "value": "new"},
+                {"op": "add", "host": "rbh1", "alias": "rbalias1"},
+                {"op": "add", "host": "rbh1", "key": "rbrestr", "value": "bad"},
+                {"op": "add", "host": "rbh1", "key": "rbro", "value": "x"},
+                {"op": "add", "host": "rbh0", "key": "rbsingle", "value": "other"},
+                {"op": "append", "host": "rbh0", "key": "rbsingle", "value": "x"},
+                {"op": "add", "host": "nohost", "key": "rbsingle", "value": "x"},
+                {"op": "add", "host": "rbh1", "key": "nokey", "value": "x"},
+                {"op": "delete", "host": "rbh1", "key": "rbsingle"},
+                {"op": "add", "host": "rbh1", "key": "rbsingle"},
+                {"op": "frobnicate", "host": "rbh1", "key": "rbsingle"},
+            ],
+            status=406,
+        )
+        self.assertEqual(ans["result"], "failed")
+        statuses = ans["statuses"]
+        self.assertEqual(statuses[:2], ["aborted", "aborted"])
+        self.assertIn("restricted", statuses[2])
+        self.assertIn("readonly", statuses[3])
+        self.assertIn("already has a value", statuses[4])
+        self.assertIn("Can only append", statuses[5])
+        self.assertIn("Unknown host", statuses[6])
+        self.assertIn("nokey", statuses[7])
+        self.assertIn("doesn't have key", statuses[8])
+        self.assertIn("Missing", statuses[9])
+        self.assertIn("Unknown operation", statuses[10])
+        self.assertTrue(all(s.startswith("failed") for s in statuses[2:]))
+        self.assertEqual(self.values(self.single), [("rbh0", "old")])
+        self.assertFalse(HostAlias.objects.filter(alias="rbalias1").exists())
+
+        ans = self.batch(
+            [
+                {"op": "update", "host": "rbh0", "key": "rbsingle", "value": "new"},
+                {"op": "add", "host": "rbh3", "alias": "rbalias"},
+            ],
+            status=406,
+        )
+        self.assertEqual(ans["statuses"][0], "aborted")
+        self.assertEqual(self.values(self.single), [("rbh0", "old")])
+
+    ###########################################################################
+    def test_order(self):
+        """The operations are done in the order they are given"""
+        ans = self.batch(
+            [
+                {"op": "add", "host": "rbalias", "key": "rbsingle", "value": "a"},
+                {"op": "delete", "host": "rbh1", "alias": "rbalias"},
+                {"op": "add", "host": "rbh2", "alias": "rbalias"},
+                {"op": "add", "host": "rbalias", "key": "rblist", "value": "b"},
+            ]
+        )
+        self.assertEqual(ans["statuses"], ["created", "deleted", "created", "created"])
+        self.assertIn(("rbh1", "a"), self.values(self.single))
+        self.assertEqual(self.values(self.list), [("rbh2", "b")])
+
+    ###########################################################################
+    def test_bad_body(self):
+        self.batch({"something": "else"}, status=406)
+        response = self.client.post("/api/batch/", "[", content_type="application/json")
+        self.assertEqual(response.status_code, 406)
+
+    ###########################################################################
+    def test_queries(self):
+        """The number of queries doesn't depend on the number of hosts"""
+        for num in range(4, 40):
+            Host(hostname=f"rbh{num}").save()
+        counts = []
+        for hosts in (range(0, 1), range(1, 10), range(10, 40)):
+            ops = []
+            for num in hosts:
+                for key, value in (("rblist", "v"), ("rbrestr", "good")):
+                    ops.append(
+                        {"op": "add", "host": f"rbh{num}", "key": key, "value": value}
+                    )
+            with CaptureQueriesContext(connection) as ctx:
+                ans = self.batch(ops)
+            self.assertEqual(ans["result"], "ok")
+            counts.append(len(ctx.captured_queries))
+        self.assertEqual(counts[1], counts[2])
+        self.assertEqual(len(self.values(self.list)), 40)
+
+    ###########################################################################
+    @override_settings(HOSTINFO_QUERY_CACHE_TIMEOUT=60)
+    def test_invalidation(self):
+        """Bulk changes invalidate the query cache"""
+        quals = parseQualifiers(["rblist=v"])
+        self.assertEqual(getMatches(quals), [])
+        self.batch([{"op": "append", "host": "rbh1", "key": "rblist", "value": "v"}])
+        self.assertEqual(getMatches(quals), [self.hosts[1].id])
+
+
 ###############################################################################
 class test_restHost(TestCase):
     def setUp(self):
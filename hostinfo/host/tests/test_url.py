@@ -23,6 +23,7 @@ from django.contrib.auth.models import User
 
 from host.models import Host, HostAlias, KeyValue, RestrictedValue, Links
 from host.models import clearAKcache, AllowedKey
+from host.views import csvRows
 
 
 ###############################################################################
@@ -779,9 +780,36 @@ class test_url_csv(TestCase):
             response["Content-Disposition"], "attachment; filename=allhosts.csv"
         )
         self.assertEqual(
-            response.content, b"hostname,csvkey\r\nhostcsv1,\r\nhostcsv2,val\r\n"
+            b"".join(response.streaming_content),
+            b"hostname,csvkey\r\nhostcsv1,\r\nhostcsv2,val\r\n",
         )
 
+    ###########################################################################
+    def test_csv_criteria(self):
+        kv = KeyValue(hostid=self.host2, keyid=self.key, value="aval")
+        kv.save()
+        response = self.client.get("/hostinfo/csv/hostcsv2/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response["Content-Disposition"], "attachment; filename=hostcsv2.csv"
+        )
+        self.assertEqual(
+            b"".join(response.streaming_content),
+            b'hostname,csvkey\r\nhostcsv2,"aval,val"\r\n',
+        )
+        kv.delete()
+
+    ###########################################################################
+    def test_csv_chunks(self):
+        """Hosts are ordered by name across chunks"""
+        host0 = Host(hostname="hostcsv0")
+        host0.save()
+        rows = csvRows([self.host2.id, host0.id], chunksize=1)
+        self.assertEqual(
+            "".join(rows), "hostname,csvkey\r\nhostcsv0,\r\nhostcsv2,val\r\n"
+        )
+        host0.delete()
+
 
 ###############################################################################
 class test_url_hostwikitable(TestCase):
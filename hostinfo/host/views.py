@@ -22,36 +22,30 @@ import operator
 import time
 from collections import defaultdict
 
-from django.http import HttpResponse, HttpResponseRedirect
+from django.db.models import Exists, OuterRef
+from django.http import HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import render
 
-from .models import Host, KeyValue, AllowedKey, calcKeylistVals
+from .models import Host, HostAlias, KeyValue, AllowedKey, calcKeylistVals
 from .models import RestrictedValue, HostinfoException
-from .models import Links, getHostList, getAliases, getAK
+from .models import Links, getHostList, getAK, getMatches, parseQualifiers
+from .models import getRevAK
+
+# Number of hosts to load details for at a time
+HOST_CHUNK = 500
 
 
 ################################################################################
 def get_rev_akcache():
     """ Reverse AllowedKey Cache """
-    revcache = {}
-    for aks in AllowedKey.objects.all():
-        revcache[aks.id] = aks.key
-    return revcache
+    return getRevAK()
 
 
 ################################################################################
-def hostviewrepr(host, printers=None, revcache=None):
-    """Return a list of KeyValue objects per key for a host
+def buildHostview(kvlist, printers, revcache):
+    """Convert the KeyValues of a single host into the hostview format
     E.g.  (('keyA',[KVobj]), ('keyB', [KVobj, KVobj, KVobj]), ('keyC',[]))
     """
-    if printers is None:
-        printers = []
-    if revcache is None:
-        revcache = {}
-    if not revcache:
-        revcache = get_rev_akcache()
-
-    kvlist = KeyValue.objects.filter(hostid__hostname=host)
     kvdict = defaultdict(list)
     for kv in kvlist:
         kvdict[revcache[kv.keyid_id]].append(kv)
@@ -64,10 +58,67 @@ def hostviewrepr(host, printers=None, revcache=None):
         tmp = kvdict.get(pr, [])
         tmp.sort(key=lambda x: x.value)
         output.append((pr, tmp))
-
     return output
 
 
+################################################################################
+def hostviewrepr(host, printers=None, revcache=None):
+    """Return a list of KeyValue objects per key for a host
+    E.g.  (('keyA',[KVobj]), ('keyB', [KVobj, KVobj, KVobj]), ('keyC',[]))
+    """
+    if printers is None:
+        printers = []
+    if not revcache:
+        revcache = get_rev_akcache()
+
+    kvlist = KeyValue.objects.filter(hostid__hostname=host)
+    return buildHostview(kvlist, printers, revcache)
+
+
+################################################################################
+def materializeHosts(hostlist, printers=None, links=False, chunksize=HOST_CHUNK):
+    """Generate the details of each host in hostlist - a tuple of
+    (host, hostview, aliases, links). The KeyValues, aliases and (if
+    requested) links are loaded for chunksize hosts at a time rather
+    than per host.
+    """
+    if printers is None:
+        printers = []
+    revcache = get_rev_akcache()
+    keyids = [k for k, v in revcache.items() if v in printers]
+    for chunkstart in range(0, len(hostlist), chunksize):
+        chunk = hostlist[chunkstart : chunkstart + chunksize]
+        hostids = [h.id for h in chunk]
+
+        kvs = defaultdict(list)
+        kvqs = KeyValue.objects.filter(hostid__in=hostids)
+        if printers:
+            kvqs = kvqs.filter(keyid__in=keyids)
+        for kv in kvqs:
+            kvs[kv.hostid_id].append(kv)
+
+        aliases = defaultdict(list)
+        for hostid, alias in HostAlias.objects.filter(hostid__in=hostids).values_list(
+            "hostid", "alias"
+        ):
+            aliases[hostid].append(alias)
+
+        hostlinks = defaultdict(list)
+        if links:
+            for hostid, url, tag in Links.objects.filter(
+                hostid__in=hostids
+            ).values_list("hostid", "url", "tag"):
+                hostlinks[hostid].append((url, tag))
+
+        for host in chunk:
+            yield (
+                host,
+                buildHostview(kvs[host.id], printers, revcache),
+                aliases[host.id],
+                hostlinks[host.id],
+            )
+
+
 ################################################################################
 def handlePost(request):
     """ POST call handling """
@@ -92,8 +143,11 @@ def handlePost(request):
 
 
 ################################################################################
-def getLinks(hostid=None, hostname=None):
-    """Take either a hostname or a hostid and return the links for that host"""
+def getLinks(hostid=None, hostname=None, links=None):
+    """Take either a hostname or a hostid and return the links for that host
+    If links have already been loaded they are used instead"""
+    if links is not None:
+        return links
     if hostid:
         return [(_.url, _.tag) for _ in Links.objects.filter(hostid=hostid)]
     if hostname:
@@ -102,9 +156,9 @@ def getLinks(hostid=None, hostname=None):
 
 
 ################################################################################
-def getWebLinks(hostid=None, hostname=None):
+def getWebLinks(hostid=None, hostname=None, links=None):
     weblinks = []
-    for url, tag in getLinks(hostid, hostname):
+    for url, tag in getLinks(hostid, hostname, links):
         weblinks.append(f'<a class="foreignlink" href="{url}">{tag}</a>')
     return weblinks
 
@@ -156,19 +210,18 @@ def hostData(user, criteria=None, options="", printers=None, order=None, linker=
         hl = orderHostList(hl, order)
     else:
         hl = sorted(hl, key=operator.attrgetter("hostname"))
-    revcache = get_rev_akcache()
 
     data = []
-    for host in hl:
+    for host, hostview, aliases, links in materializeHosts(
+        hl, printers=printers, links=linker is not None
+    ):
         tmp = {
             "hostname": host.hostname,
-            "hostview": hostviewrepr(
-                host.hostname, printers=printers, revcache=revcache
-            ),
-            "aliases": getAliases(host.hostname),
+            "hostview": hostview,
+            "aliases": aliases,
         }
         if linker:
-            tmp["links"] = linker(hostid=host.id)
+            tmp["links"] = linker(hostid=host.id, links=links)
         data.append(tmp)
 
     d = {
@@ -244,7 +297,20 @@ def doHostcmp(request, criturl="", options=""):
 
 
 ################################################################################
-def orderHostList(hostlist, order):
+def orderValue(ak, values):
+    """Work out what to sort a host on from its (numvalue, value) pairs
+    for the key. Hosts without a value come first, numeric keys sort
+    numerically and anything else sorts on the comma joined values.
+    """
+    if not values:
+        return (0, "")
+    if ak.numericFlag and all(nv is not None for nv, _ in values):
+        return (1, sorted([nv for nv, _ in values]))
+    return (2, ",".join(sorted([v for _, v in values])))
+
+
+################################################################################
+def orderHostList(hostlist, order, chunksize=HOST_CHUNK):
     """Order a hostlist by the order specified"""
     NEGATIVE = -1
     direct = 0
@@ -252,27 +318,20 @@ def orderHostList(hostlist, order):
         direct = NEGATIVE
         order = order[1:]
 
-    tmp = []
     ak = getAK(key=order)
-    for host in hostlist:
-        kv = KeyValue.objects.filter(keyid=ak, hostid=host)
-        if len(kv) == 0:
-            val = ""
-        elif len(kv) == 1:
-            if ak.numericFlag:
-                val = kv[0].numvalue
-            else:
-                val = kv[0].value
-        else:
-            if ak.numericFlag:
-                val = ",".join([key.numvalue for key in kv])
-            else:
-                val = ",".join([key.value for key in kv])
-        tmp.append((val, host))
-    tmp.sort(key=lambda x: x[0])
+    values = defaultdict(list)
+    for chunkstart in range(0, len(hostlist), chunksize):
+        chunk = hostlist[chunkstart : chunkstart + chunksize]
+        for hostid, numvalue, value in (
+            KeyValue.objects.filter(keyid=ak, hostid__in=[h.id for h in chunk])
+            .order_by()
+            .values_list("hostid", "numvalue", "value")
+        ):
+            values[hostid].append((numvalue, value))
+
+    hostlist = sorted(hostlist, key=lambda h: orderValue(ak, values[h.id]))
     if direct == NEGATIVE:
-        tmp.reverse()
-    hostlist = [h for v, h in tmp]
+        hostlist.reverse()
     return hostlist
 
 
@@ -280,10 +339,10 @@ def orderHostList(hostlist, order):
 def doCsvreport(_, criturl=""):
     """ CSV report"""
     criteria = criteriaFromWeb(criturl)
-    hl = getHostList(criteria)
+    hostids = getMatches(parseQualifiers(criteria))
     if not criturl:
         criturl = "allhosts"
-    return csvDump(hl, f"{criturl}.csv")
+    return csvDump(hostids, f"{criturl}.csv", allhosts=not criteria)
 
 
 ################################################################################
@@ -301,39 +360,79 @@ def criteriaFromWeb(criteria):
 
 
 ################################################################################
-def csvDump(hostlist, filename):
-    """ Dump output in CSV format """
-    response = HttpResponse(content_type="text/csv")
-    response["Content-Disposition"] = f"attachment; filename={filename}"
+class Echo:
+    """Pseudo-buffer so that csv.writer hands back what it writes"""
 
-    # Convert list of hosts into all required data
-    revcache = get_rev_akcache()
-    data = []
-    for host in hostlist:
-        data.append(
-            (host.hostname, hostviewrepr(host.hostname, revcache=revcache), None)
+    def write(self, value):
+        """Return the line rather than storing it"""
+        return value
+
+
+################################################################################
+def csvHeaders(hostids, allhosts=False, chunksize=HOST_CHUNK):
+    """Return the keys that the hosts have values for in sorted order"""
+    keys = AllowedKey.objects.order_by("key")
+    if allhosts:
+        used = KeyValue.objects.filter(keyid=OuterRef("pk"))
+        return list(keys.filter(Exists(used)).values_list("key", flat=True))
+
+    keyids = set()
+    for chunkstart in range(0, len(hostids), chunksize):
+        chunk = hostids[chunkstart : chunkstart + chunksize]
+        keyids.update(
+            KeyValue.objects.filter(hostid__in=chunk)
+            .order_by()
+            .values_list("keyid", flat=True)
+            .distinct()
         )
-    data.sort(key=lambda x: x[0])
-
-    # Grab all the headings
-    hdrs = []
-    hdrdict = {"hostname": "hostname"}  # Need this for the first row of headers
-    for host, details, _ in data:
-        for t, val in details:
-            if t not in hdrs:
-                hdrs.append(t)
-            hdrdict[t] = t
-    hdrs.sort()
-    hdrs.insert(0, "hostname")
-    writer = csv.DictWriter(response, hdrs)
-    writer.writerow(hdrdict)
-
-    # Finally write the data
-    for host, details, _ in data:
-        d = {"hostname": host}
-        for t, val in details:
-            d[t] = ",".join([k.value for k in val])
-        writer.writerow(d)
+    return list(keys.filter(id__in=keyids).values_list("key", flat=True))
+
+
+################################################################################
+def csvRows(hostids, allhosts=False, chunksize=HOST_CHUNK):
+    """Generate the lines of the CSV output for the hosts, ordered by
+    hostname. Only the values of chunksize hosts are held in memory at
+    a time.
+    """
+    writer = csv.writer(Echo())
+    headers = csvHeaders(hostids, allhosts)
+    columns = {key: num for num, key in enumerate(headers)}
+    yield writer.writerow(["hostname"] + headers)
+
+    ids = sorted(hostids)
+    ordered = []
+    for chunkstart in range(0, len(ids), chunksize):
+        ordered.extend(
+            Host.objects.filter(id__in=ids[chunkstart : chunkstart + chunksize])
+            .order_by()
+            .values_list("id", "hostname")
+        )
+    ordered.sort(key=operator.itemgetter(1))
+    revcache = get_rev_akcache()
+    for chunkstart in range(0, len(ordered), chunksize):
+        chunk = ordered[chunkstart : chunkstart + chunksize]
+        values = defaultdict(lambda: defaultdict(list))
+        for hostid, keyid, value in (
+            KeyValue.objects.filter(hostid__in=[h for h, _ in chunk])
+            .order_by()
+            .values_list("hostid", "keyid", "value")
+            .iterator(chunk_size=chunksize)
+        ):
+            values[hostid][revcache[keyid]].append(value)
+        for hostid, hostname in chunk:
+            row = [hostname] + [""] * len(headers)
+            for key, vals in values[hostid].items():
+                row[columns[key] + 1] = ",".join(sorted(vals))
+            yield writer.writerow(row)
+
+
+################################################################################
+def csvDump(hostids, filename, allhosts=False):
+    """ Stream output in CSV format """
+    response = StreamingHttpResponse(
+        csvRows(hostids, allhosts), content_type="text/csv"
+    )
+    response["Content-Disposition"] = f"attachment; filename={filename}"
     return response
 
 
@@ -0,0 +1,16 @@
+"""
+Django settings for the hostinfo command line tools.
+
+Everything comes from settings.py but only the apps that the commands need
+are loaded, which saves a lot of the start up time of each command.
+"""
+
+from .settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    "django.contrib.auth",
+    "django.contrib.contenttypes",
+    "simple_history",
+    "host",
+]
+MIDDLEWARE = []
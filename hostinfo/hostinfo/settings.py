@@ -70,6 +70,7 @@ MIDDLEWARE = [
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "simple_history.middleware.HistoryRequestMiddleware",
+    "host.middleware.QueryCacheMiddleware",
 ]
 if DEBUG:
     MIDDLEWARE.insert(0, "debug_toolbar.middleware.DebugToolbarMiddleware")
@@ -92,6 +93,17 @@ DATABASES = {
     }
 }
 
+# Used to share the key metadata between processes. If you run more than
+# one worker process use a cache that they can all see (e.g. memcached or
+# django.core.cache.backends.filebased.FileBasedCache) so that they don't
+# each have to load it. The settings below that say so need it to be shared.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "hostinfo",
+    }
+}
+
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
@@ -128,6 +140,23 @@ USE_TZ = False
 
 HOSTINFO_REPORT_DIR = "/tmp/reports"
 
+# Bytes of memory each process may use to answer simple queries from an in
+# memory index instead of the database - 0 to disable. Needs the shared
+# CACHES above, and ./manage.py warm_value_index to load it.
+HOSTINFO_VALUE_INDEX_MEMORY = 0
+
+# Seconds to cache the hosts that match a query for - 0 to disable. Needs the
+# shared CACHES above. Clients can skip it with a nocache parameter or a
+# "Cache-Control: no-cache" header, and ./manage.py query_cache_stats shows
+# how well it is doing.
+HOSTINFO_QUERY_CACHE_TIMEOUT = 0
+
+# Send ETag and Last-Modified headers from the read APIs so that clients can
+# ask if anything has changed without the query being run. Needs the shared
+# CACHES above, otherwise processes answer "Not Modified" for changes made by
+# the others.
+HOSTINFO_CONDITIONAL_REQUESTS = False
+
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
@@ -22,113 +22,100 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, sys, getopt, time
+import json
+import os
+import sys
+import getopt
+import time
+from urllib.request import urlopen
 
-verbFlag=False
-numvals=10
-outfile=None
-datestampFlag=True
+verbFlag = False
+numvals = 10
+outfile = None
+datestampFlag = True
+url = os.environ.get("HOSTINFO_URL", "http://localhost")
 
 reportname = "generic report"
 reportdesc = "Report on stuff"
 
+
 ################################################################################
 def Verbose(msg):
     if verbFlag:
-    	sys.stderr.write("%s\n" % msg)
+        sys.stderr.write("%s\n" % msg)
+
 
 ################################################################################
 def usage():
     sys.stderr.write("Usage: %s\n" % sys.argv[0])
-    sys.stderr.write("   [--numvals=<int>]\tNumber of vals to print for each key (default %d)\n" % numvals)
+    sys.stderr.write(
+        "   [--numvals=<int>]\tNumber of vals to print for each key (default %d)\n"
+        % numvals
+    )
     sys.stderr.write("   [--outfile=<file>]\tWhere to put the output. Default stdout\n")
     sys.stderr.write("   [--nodatestamp]\tDon't datestamp the output file\n")
+    sys.stderr.write(
+        "   [--url=<url>]\tWhere hostinfo is. Default $HOSTINFO_URL or %s\n" % url
+    )
+
 
-################################################################################
-def getKeys():
-    keylist=[]
-    f=os.popen('hostinfo_showkey')
-    for line in f:
-    	keylist.append(line.strip().split()[0])
-    f.close()
-    return keylist
-    	
 ################################################################################
 def output(str):
     if outfile:
-    	if datestampFlag:
-	    datestr=time.strftime('%Y%m%d')
-	    filename='%s_%s' % (outfile, datestr)
-    	f=open(filename,'a')
-	f.write("%s\n" % str)
-	f.close()
+        filename = outfile
+        if datestampFlag:
+            datestr = time.strftime("%Y%m%d")
+            filename = "%s_%s" % (outfile, datestr)
+        with open(filename, "a") as f:
+            f.write("%s\n" % str)
     else:
-    	print str
+        print(str)
 
-################################################################################
-def countDict(d):
-    """ Return a list of the top 'numvals' values in the dictionary d
-    """
-    l=[]
-    for k,v in d.items():
-	l.append((v,k))
-    l.sort()
-    l.reverse()
-    return  list(l[:numvals])
 
 ################################################################################
-def getStats(key, numrecords):
-    """ Get the basic statistics for the key
-    """
-    count=0
-    d={}
-    f=os.popen('hostinfo -p %s %s.defined' % (key,key))
-    for line in f:
-    	count+=1
-	val=line[line.find('=')+1:].strip()
-	d[val]=d.get(val,0)+1
-    f.close()
-    ans=countDict(d)
-    output("%s:%d:%d:%s" % (key, count, numrecords-count, ans))
+def getKeyStats():
+    """Get the statistics of every key in one go - hostinfo keeps them
+    counted so this doesn't have to go through every host"""
+    apiurl = "%s/api/keystats/?top=%d" % (url.rstrip("/"), numvals)
+    Verbose("Getting %s" % apiurl)
+    with urlopen(apiurl) as f:
+        return json.loads(f.read().decode())
 
-################################################################################
-def getRecordCount():
-    count=0
-    f=os.popen('hostinfo')
-    for line in f:
-    	count+=1
-    f.close()
-    return count
 
 ################################################################################
 def main():
-    keylist=getKeys()
-    numrecords=getRecordCount()
-    for key in keylist:
-    	getStats(key, numrecords)
+    stats = getKeyStats()
+    for key in stats["keys"]:
+        ans = [(v["count"], v["value"]) for v in key["values"]]
+        output("%s:%d:%d:%s" % (key["key"], key["numdef"], key["numundef"], ans))
+
 
 ################################################################################
-if __name__=="__main__":
+if __name__ == "__main__":
     try:
-    	opts,args=getopt.getopt(sys.argv[1:], "vh",["numvals=", "outfile=", "nodatestamp"])
-    except getopt.GetoptError,err:
-    	sys.stderr.write("Error: %s\n" % str(err))
-    	usage()
-	sys.exit(1)
-
-    for o,a in opts:
-    	if o=="-v":
-	    verbFlag=True
-    	if o=="-h":
-	    usage()
-	    sys.exit(0)
-	if o=="--numvals":
-	    numvals=int(a)
-	if o=="--outfile":
-	    outfile=a
-	if o=="--nodatestamp":
-	    datestampFlag=False
+        opts, args = getopt.getopt(
+            sys.argv[1:], "vh", ["numvals=", "outfile=", "nodatestamp", "url="]
+        )
+    except getopt.GetoptError as err:
+        sys.stderr.write("Error: %s\n" % str(err))
+        usage()
+        sys.exit(1)
+
+    for o, a in opts:
+        if o == "-v":
+            verbFlag = True
+        if o == "-h":
+            usage()
+            sys.exit(0)
+        if o == "--numvals":
+            numvals = int(a)
+        if o == "--outfile":
+            outfile = a
+        if o == "--nodatestamp":
+            datestampFlag = False
+        if o == "--url":
+            url = a
 
     main()
 
-#EOF
+# EOF